@@ -0,0 +1,256 @@
+"""Benchmark offline del pipeline de swap, etapa por etapa.
+
+Genera templates sintéticos a partir de las escenas (template_scenes/) en
+varios tamaños y cantidades de frames, y mide por separado:
+
+- face_decode: abrir, orientar y reducir la foto (load_face),
+- template_decode: decodificar el GIF y armar su paleta (decode_template),
+- composite: ajustar la cara a cada caja, igualar su tono, rotarla según
+  las anotaciones y mezclarla en todos los frames,
+- quantize: paleta del swap y mapeo de los píxeles de la cara a índices,
+- encode: escribir el GIF (y los demás formatos pedidos con --formats).
+
+No necesita el servidor ni el pool de workers. Uso:
+
+    python bench.py --output bench.json
+    python bench.py --baseline bench_base.json          # correr y comparar
+    python bench.py --input bench.json --baseline bench_base.json
+
+Con --baseline se marcan como regresión las etapas cuya mediana empeoró más
+de --threshold (relativo) y de --min-delta-ms (absoluto); en ese caso el
+proceso termina con código 1, útil para CI.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from compositor import (
+    available_formats, composite_faces, decode_template, encode_frames, encode_gif, face_boxes_for,
+    face_pixels, fit_faces, load_face, template_tone, warp_faces
+)
+from gif_encoder import PaletteMapper, index_swap_frames, iter_indexed_gif, swap_palette
+from scenes import SceneLibrary, normalize_params, render_scene, save_scene_gif
+
+BASE_DIR = Path(__file__).parent
+SCENES_DIR = BASE_DIR / "template_scenes"
+
+DEFAULT_SCENES = ["soccer_celebration", "dancer", "singer"]
+DEFAULT_SIZES = [200, 400, 800]
+DEFAULT_FRAMES = [8, 32]
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.15
+DEFAULT_MIN_DELTA_MS = 0.5
+FACE_SIZE = (1024, 768)
+
+
+# ---------- datos sintéticos ----------
+
+def synthetic_face(size=FACE_SIZE, seed=0):
+    """JPEG con degradado y ruido, parecido en peso a una foto de celular"""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width]
+    base = np.stack([xs * 255 // width, ys * 255 // height, (xs + ys) * 255 // (width + height)], axis=-1)
+    noise = rng.integers(-24, 24, size=base.shape)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def synthetic_template(library, scene_id, side, n_frames, directory):
+    """GIF de la escena a ``side`` px con ``n_frames`` frames (repitiendo el ciclo)"""
+    scene = library.get(scene_id)
+    params = normalize_params(scene, {"size": str(side)})
+    frames, face_boxes = render_scene(scene, params)
+    frames = [frames[i % len(frames)] for i in range(n_frames)]
+    face_boxes = [face_boxes[i % len(face_boxes)] for i in range(n_frames)]
+    path = Path(directory) / f"{scene_id}_{side}_{n_frames}.gif"
+    save_scene_gif(scene, params, frames, face_boxes, path)
+    return path
+
+
+# ---------- medición ----------
+
+def _time(fn, repeat):
+    """Mediana, mínimo y media en ms de ``repeat`` llamadas; devuelve (stats, último resultado)"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": round(statistics.median(samples), 3),
+        "min_ms": round(min(samples), 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+    }, result
+
+
+def bench_case(template_path, face_bytes, repeat, formats=("gif",)):
+    """Tiempos por etapa de un template"""
+    results = {}
+    results["face_decode"], face_image = _time(lambda: load_face(face_bytes), repeat)
+    results["template_decode"], template = _time(lambda: decode_template(template_path), repeat)
+    annotated, angles = face_boxes_for(template_path, template)
+
+    def composite():
+        fitted = fit_faces(face_image, annotated, tone=template_tone(template.frames[0], annotated[0]))
+        faces, boxes, keys = warp_faces(fitted, annotated, angles)
+        return faces, boxes, composite_faces(template.frames, face_image, boxes, faces, keys)
+
+    results["composite"], (fitted, boxes, frames) = _time(composite, repeat)
+
+    if template.index_frames is not None:
+        def quantize():
+            # Un mapper nuevo por corrida, como en cada swap real
+            palette = swap_palette(template.palette_colors, face_pixels(fitted))
+            return palette, index_swap_frames(frames, template.index_frames, boxes, PaletteMapper(palette))
+
+        results["quantize"], (palette, indices) = _time(quantize, repeat)
+        results["encode"], data = _time(
+            lambda: b"".join(iter_indexed_gif(indices, palette, template.durations, template.loop)), repeat
+        )
+    else:
+        # Sin paleta compartible Pillow cuantiza y codifica en un solo paso
+        results["encode"], data = _time(
+            lambda: encode_gif(frames, template.durations, template.loop), repeat
+        )
+    results["encode"]["bytes"] = len(data)
+
+    for output_format in formats:
+        if output_format == "gif":
+            continue
+        stats, data = _time(
+            lambda: encode_frames(frames, template.durations, template.loop, output_format), repeat
+        )
+        results[f"encode_{output_format}"] = {**stats, "bytes": len(data)}
+    return results
+
+
+def run(scene_ids, sizes, frame_counts, repeat, formats):
+    face_bytes = synthetic_face()
+    cases = {}
+    with tempfile.TemporaryDirectory() as directory:
+        library = SceneLibrary(SCENES_DIR, directory)
+        library.load()
+        for scene_id in scene_ids:
+            for side in sizes:
+                for n_frames in frame_counts:
+                    name = f"{scene_id}@{side}x{n_frames}"
+                    path = synthetic_template(library, scene_id, side, n_frames, directory)
+                    cases[name] = bench_case(path, face_bytes, repeat, formats)
+                    total = sum(stage["median_ms"] for stage in cases[name].values())
+                    print(f"{name:<32} {total:9.2f} ms", file=sys.stderr)
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "cases": cases,
+    }
+
+
+# ---------- comparación ----------
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, min_delta_ms=DEFAULT_MIN_DELTA_MS):
+    """Etapas que empeoraron respecto de la línea base: lista de dicts"""
+    regressions = []
+    for name, stages in current["cases"].items():
+        base_stages = baseline["cases"].get(name)
+        if base_stages is None:
+            continue
+        for stage, stats in stages.items():
+            base = base_stages.get(stage)
+            if base is None:
+                continue
+            before, after = base["median_ms"], stats["median_ms"]
+            if after - before > min_delta_ms and after > before * (1 + threshold):
+                regressions.append({
+                    "case": name,
+                    "stage": stage,
+                    "baseline_ms": before,
+                    "current_ms": after,
+                    "change": round(after / before - 1, 3) if before else None,
+                })
+    return regressions
+
+
+def print_comparison(baseline, current, regressions):
+    flagged = {(r["case"], r["stage"]) for r in regressions}
+    for name, stages in current["cases"].items():
+        base_stages = baseline["cases"].get(name, {})
+        for stage, stats in stages.items():
+            base = base_stages.get(stage)
+            if base is None:
+                print(f"{name:<32} {stage:<18} {stats['median_ms']:9.2f} ms   (nuevo)")
+                continue
+            change = (stats["median_ms"] / base["median_ms"] - 1) * 100 if base["median_ms"] else 0.0
+            mark = "  REGRESIÓN" if (name, stage) in flagged else ""
+            print(f"{name:<32} {stage:<18} {base['median_ms']:9.2f} -> {stats['median_ms']:9.2f} ms "
+                  f"({change:+6.1f}%){mark}")
+
+
+def _csv(value, cast=str):
+    return [cast(item) for item in value.split(",") if item.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark por etapa del pipeline de swap")
+    parser.add_argument("--scenes", type=_csv, default=DEFAULT_SCENES)
+    parser.add_argument("--sizes", type=lambda v: _csv(v, int), default=DEFAULT_SIZES,
+                        help="lado mayor de los templates, separado por comas")
+    parser.add_argument("--frames", type=lambda v: _csv(v, int), default=DEFAULT_FRAMES,
+                        help="cantidad de frames, separado por comas")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--formats", type=_csv, default=["gif"],
+                        help="formatos a codificar además de GIF (webp, apng, ...)")
+    parser.add_argument("--output", help="escribir los resultados en este JSON")
+    parser.add_argument("--input", help="no correr: usar estos resultados ya guardados")
+    parser.add_argument("--baseline", help="JSON de referencia para detectar regresiones")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--min-delta-ms", type=float, default=DEFAULT_MIN_DELTA_MS)
+    args = parser.parse_args(argv)
+
+    unknown = [f for f in args.formats if f not in available_formats()]
+    if unknown:
+        parser.error(f"formatos no disponibles: {', '.join(unknown)}")
+
+    if args.input:
+        current = json.loads(Path(args.input).read_text(encoding="utf-8"))
+    else:
+        current = run(args.scenes, args.sizes, args.frames, max(1, args.repeat), args.formats)
+    if args.output:
+        Path(args.output).write_text(json.dumps(current, indent=2), encoding="utf-8")
+    elif not args.baseline:
+        print(json.dumps(current, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(baseline, current, args.threshold, args.min_delta_ms)
+        print_comparison(baseline, current, regressions)
+        if regressions:
+            print(f"{len(regressions)} regresiones (umbral {args.threshold:.0%})")
+            return 1
+        print("Sin regresiones")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,679 @@
+"""Motor de composición de caras en CPU.
+
+Decodifica el template una sola vez a un arreglo NumPy (frames, alto, ancho, 3),
+pega la cara del usuario con una máscara elíptica difuminada sobre todos los
+frames en una sola operación vectorizada y vuelve a codificar el GIF.
+iter_swap hace lo mismo frame a frame, para enviar el GIF mientras se genera.
+
+La mezcla es en punto fijo: la máscara se guarda como uint16 en escala
+ALPHA_ONE (256) y, por cada cara y tamaño, se precalculan la cara ya
+multiplicada por la máscara y el complemento de la máscara. Cada frame
+cuesta entonces una multiplicación, una suma y un corrimiento en uint16.
+Antes de mezclar, el tono de la cara se acerca al del template (la zona de
+la caja en el primer frame) con una tabla por canal.
+
+Si las anotaciones traen rotación, la cara se gira en cada frame alrededor
+del centro de su caja. Las coordenadas de muestreo (bilineales, con pesos en
+punto fijo) dependen sólo del tamaño de la cara y del ángulo, así que se
+guardan en un LRU: los renders siguientes de un template sólo juntan píxeles
+y mezclan, sin volver a calcular la transformación.
+"""
+import io
+import math
+import os
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageOps, ImageSequence, features
+
+from face_annotations import load_face_track
+from gif_encoder import (
+    IndexedGifEncoder, PaletteMapper, build_template_palette, index_swap_frames,
+    iter_indexed_gif, swap_palette
+)
+
+# Presupuesto de latencia por etapa en milisegundos (template de 200x200)
+STAGE_BUDGET_MS = {
+    "face_decode": 40.0,
+    "template_fetch": 40.0,
+    "composite": 15.0,
+    "encode": 120.0,
+}
+
+DEFAULT_DURATION_MS = 100
+
+# Lado máximo de la foto ya normalizada: las cajas de cara son mucho más chicas
+FACE_MAX_SIDE = 512
+
+# Máscaras de mezcla: opacidad total en punto fijo y tamaños que se guardan
+ALPHA_ONE = 256
+MASK_CACHE_SIZE = int(os.getenv("MASK_CACHE_SIZE", "64"))
+
+# Cuánto se acerca el tono de la cara al del template (0 = nada) y límites de la ganancia
+FACE_TONE_MATCH = float(os.getenv("FACE_TONE_MATCH", "0.35"))
+TONE_GAIN_RANGE = (0.8, 1.25)
+
+# Rotación de la cara: paso al que se redondean los ángulos y grillas que se guardan
+ANGLE_STEP = 0.5
+# Inclinación máxima que se aplica desde anotaciones del detector (son estimaciones)
+MAX_DETECTED_TILT = 10.0
+WARP_CACHE_SIZE = int(os.getenv("WARP_CACHE_SIZE", "128"))
+
+# Formatos de salida: extensión, media type y ajustes de Pillow (priorizando velocidad)
+OUTPUT_FORMATS = {
+    "gif": {"extension": "gif", "media_type": "image/gif"},
+    "webp": {
+        "extension": "webp",
+        "media_type": "image/webp",
+        "pillow": "WEBP",
+        "options": {"quality": 80, "method": 2},
+    },
+    "webp-lossless": {
+        "extension": "webp",
+        "media_type": "image/webp",
+        "pillow": "WEBP",
+        "options": {"lossless": True, "quality": 0, "method": 0},
+    },
+    "apng": {
+        "extension": "png",
+        "media_type": "image/apng",
+        "pillow": "PNG",
+        "options": {"compress_level": 1, "disposal": 0, "blend": 0},
+    },
+}
+DEFAULT_OUTPUT_FORMAT = "gif"
+
+# Niveles de calidad. "preview" reduce el template con vecino más cercano,
+# descarta frames y ajusta la cara con un filtro barato, para responder en
+# decenas de ms; "full" es el render de siempre a resolución nativa.
+QUALITY_TIERS = {
+    "preview": {"max_side": 160, "max_frames": 12, "face_side": 256, "resample": Image.BILINEAR},
+    "standard": {"max_side": 480, "max_frames": None, "face_side": FACE_MAX_SIDE, "resample": Image.LANCZOS},
+    "full": {"max_side": None, "max_frames": None, "face_side": FACE_MAX_SIDE, "resample": Image.LANCZOS},
+}
+DEFAULT_QUALITY = "full"
+
+
+def available_formats():
+    """Formatos de salida que esta instalación de Pillow puede codificar"""
+    return [
+        name for name, spec in OUTPUT_FORMATS.items()
+        if spec.get("pillow") != "WEBP" or features.check("webp")
+    ]
+
+
+class StageTimer:
+    """Mide cuánto tarda cada etapa del pipeline y la compara con su presupuesto"""
+
+    def __init__(self, budget=None):
+        self.budget = STAGE_BUDGET_MS if budget is None else budget
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def over_budget(self):
+        return [
+            name for name, ms in self.timings.items()
+            if ms > self.budget.get(name, float("inf"))
+        ]
+
+    def report(self):
+        return {
+            "timings_ms": {name: round(ms, 2) for name, ms in self.timings.items()},
+            "total_ms": round(sum(self.timings.values()), 2),
+            "over_budget": self.over_budget(),
+        }
+
+
+@dataclass
+class DecodedTemplate:
+    """Frames de un template ya decodificados en RGB"""
+    frames: np.ndarray  # (n_frames, alto, ancho, 3) uint8
+    durations: list
+    loop: int
+    palette: bytes = None  # paleta global del GIF (RGB), si la tiene
+    # Colores exactos del template e índices de cada frame en esa paleta,
+    # para codificar los swaps sin volver a cuantizar (None si no caben)
+    palette_colors: np.ndarray = None  # (k, 3) uint8
+    index_frames: np.ndarray = None  # (n_frames, alto, ancho) uint8
+
+    @property
+    def size(self):
+        return self.frames.shape[2], self.frames.shape[1]
+
+    @property
+    def nbytes(self):
+        total = self.frames.nbytes + (len(self.palette) if self.palette else 0)
+        if self.index_frames is not None:
+            total += self.index_frames.nbytes + self.palette_colors.nbytes
+        return total
+
+
+def decode_template(path):
+    """Decodificar todos los frames del GIF a un único arreglo NumPy"""
+    frames = []
+    durations = []
+    with Image.open(path) as im:
+        default_duration = im.info.get("duration", DEFAULT_DURATION_MS)
+        loop = im.info.get("loop", 0)
+        palette = bytes(im.getpalette() or []) or None
+        for frame in ImageSequence.Iterator(im):
+            frames.append(np.asarray(frame.convert("RGB")))
+            durations.append(frame.info.get("duration", default_duration) or DEFAULT_DURATION_MS)
+    stack = np.stack(frames)
+    stack.flags.writeable = False  # los frames se comparten entre peticiones
+    palette_colors, index_frames = build_template_palette(stack)
+    if index_frames is not None:
+        index_frames.flags.writeable = False
+    return DecodedTemplate(frames=stack, durations=durations, loop=loop, palette=palette,
+                           palette_colors=palette_colors, index_frames=index_frames)
+
+
+def default_face_box(width, height):
+    """Caja (x, y, ancho, alto) por defecto para la cara: centrada, en el tercio superior"""
+    side = max(8, int(min(width, height) * 0.2))
+    x = (width - side) // 2
+    y = max(0, int(height * 0.35) - side // 2)
+    return x, y, side, side
+
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def elliptical_mask(size, feather=0.12):
+    """Máscara elíptica con bordes difuminados, uint16 entre 0 y ALPHA_ONE (compartida, sólo lectura)"""
+    width, height = size
+    mask = Image.new("L", size, 0)
+    inset_x = max(1, int(width * feather / 2))
+    inset_y = max(1, int(height * feather / 2))
+    ImageDraw.Draw(mask).ellipse(
+        [inset_x, inset_y, width - 1 - inset_x, height - 1 - inset_y], fill=255
+    )
+    radius = max(1.0, min(width, height) * feather / 2)
+    mask = mask.filter(ImageFilter.GaussianBlur(radius))
+    alpha = (np.asarray(mask, dtype=np.uint16) * ALPHA_ONE + 127) // 255
+    alpha.flags.writeable = False
+    return alpha
+
+
+@dataclass
+class PreparedFace:
+    """Cara ya normalizada, con el recorte y la máscara listos para algunos tamaños"""
+    image: np.ndarray  # (alto, ancho, 3) uint8, lado máximo FACE_MAX_SIDE
+    fits: dict = field(default_factory=dict)  # (ancho, alto) -> (rgb, máscara)
+
+    @property
+    def nbytes(self):
+        return self.image.nbytes + sum(rgb.nbytes + alpha.nbytes for rgb, alpha in self.fits.values())
+
+
+def load_face(source, max_side=FACE_MAX_SIDE):
+    """Abrir la foto del usuario ya orientada, en RGB y reducida a ``max_side``
+
+    ``source`` puede ser bytes, una ruta, un archivo o una cara ya normalizada
+    (arreglo RGB de normalize_face o PreparedFace). Una foto pasa primero por
+    el tamaño normalizado, así reducirla a ``max_side`` da lo mismo que
+    reducir la cara guardada en /faces.
+    """
+    if isinstance(source, PreparedFace):
+        source = source.image
+    if isinstance(source, np.ndarray):
+        face = Image.fromarray(source)
+    else:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        side = max(max_side, FACE_MAX_SIDE)
+        with Image.open(source) as im:
+            # En JPEG decodificar directamente a escala reducida
+            im.draft("RGB", (side, side))
+            face = ImageOps.exif_transpose(im).convert("RGB")
+        face.thumbnail((side, side), Image.LANCZOS)
+    if max(face.size) > max_side:
+        face.thumbnail((max_side, max_side), Image.LANCZOS)
+    return face
+
+
+def normalize_face(source):
+    """Decodificar la cara una vez como arreglo RGB, para renderizarla en varios templates"""
+    return np.asarray(load_face(source))
+
+
+def preprocess_face(source, sizes=()):
+    """Normalizar la cara y precalcular recorte y máscara para cada tamaño de ``sizes``"""
+    face_image = load_face(source)
+    fits = {(int(w), int(h)): fit_face(face_image, (int(w), int(h))) for w, h in sizes}
+    return PreparedFace(image=np.asarray(face_image), fits=fits)
+
+
+def fit_face(face_image, size, resample=Image.LANCZOS):
+    """Recortar la cara centrada y escalarla al tamaño de la caja, con su máscara"""
+    face = ImageOps.fit(face_image, size, resample, centering=(0.5, 0.4))
+    return np.asarray(face), elliptical_mask(tuple(size))
+
+
+def prepare_face(source, size):
+    """Atajo: abrir la foto y ajustarla a un solo tamaño"""
+    return fit_face(load_face(source), size)
+
+
+def face_boxes_for(template_path, template):
+    """Caja y rotación de la cara en cada frame: anotaciones del template o caja por defecto"""
+    n_frames = len(template.frames)
+    track = load_face_track(template_path)
+    if track is not None:
+        boxes, angles = track.scaled_to(template.size).for_frames(n_frames)
+        if track.source == "detector":
+            angles = np.clip(angles, -MAX_DETECTED_TILT, MAX_DETECTED_TILT)
+        return boxes, angles
+    boxes = np.tile(np.array(default_face_box(*template.size), dtype=np.int32), (n_frames, 1))
+    return boxes, np.zeros(n_frames, dtype=np.float32)
+
+
+@lru_cache(maxsize=WARP_CACHE_SIZE)
+def warp_grid(size, angle):
+    """Muestreo bilineal de una cara de ``size`` rotada ``angle`` grados (antihorario)
+
+    Devuelve (índices, pesos, (ancho, alto) del resultado). Los índices
+    (n, 4) apuntan a la cara con un borde de un píxel en cero, aplanada; los
+    pesos (n, 4) suman ALPHA_ONE. Lo que cae fuera de la cara toma el borde,
+    así que queda con máscara 0.
+    """
+    w, h = size
+    theta = math.radians(angle)
+    cos, sin = math.cos(theta), math.sin(theta)
+    # Caja que contiene la cara rotada (el épsilon evita un píxel de más en 90°)
+    out_w = int(math.ceil(abs(w * cos) + abs(h * sin) - 1e-6))
+    out_h = int(math.ceil(abs(w * sin) + abs(h * cos) - 1e-6))
+
+    # Centro de cada píxel del resultado, relativo al centro, llevado a la cara sin rotar
+    ys, xs = np.mgrid[0:out_h, 0:out_w].astype(np.float64)
+    xs += 0.5 - out_w / 2
+    ys += 0.5 - out_h / 2
+    src_x = xs * cos - ys * sin + w / 2 - 0.5
+    src_y = xs * sin + ys * cos + h / 2 - 0.5
+
+    x0 = np.floor(src_x)
+    y0 = np.floor(src_y)
+    fx = np.round((src_x - x0) * ALPHA_ONE).astype(np.int64)
+    fy = np.round((src_y - y0) * ALPHA_ONE).astype(np.int64)
+    # +1 por el borde; fuera de rango se cae en el borde (cero)
+    cols = [np.clip(x0 + 1 + dx, 0, w + 1).astype(np.int64) for dx in (0, 1)]
+    rows = [np.clip(y0 + 1 + dy, 0, h + 1).astype(np.int64) for dy in (0, 1)]
+    stride = w + 2
+    index = np.stack([rows[0] * stride + cols[0], rows[0] * stride + cols[1],
+                      rows[1] * stride + cols[0], rows[1] * stride + cols[1]], axis=-1)
+
+    w00 = ((ALPHA_ONE - fx) * (ALPHA_ONE - fy) + ALPHA_ONE // 2) // ALPHA_ONE
+    w01 = (fx * (ALPHA_ONE - fy) + ALPHA_ONE // 2) // ALPHA_ONE
+    w10 = ((ALPHA_ONE - fx) * fy + ALPHA_ONE // 2) // ALPHA_ONE
+    weights = np.stack([w00, w01, w10, ALPHA_ONE - w00 - w01 - w10], axis=-1)
+
+    index = index.reshape(-1, 4).astype(np.int32)
+    weights = weights.reshape(-1, 4).astype(np.uint32)
+    index.flags.writeable = False
+    weights.flags.writeable = False
+    return index, weights, (out_w, out_h)
+
+
+def warp_face(face_rgb, face_alpha, angle):
+    """Cara (rgb, máscara) rotada ``angle`` grados, con la grilla de warp_grid"""
+    h, w = face_alpha.shape
+    index, weights, (out_w, out_h) = warp_grid((w, h), angle)
+    # rgb y máscara juntos en un solo arreglo con borde, para una sola lectura
+    source = np.zeros((h + 2, w + 2, 4), dtype=np.uint32)
+    source[1:-1, 1:-1, :3] = face_rgb
+    source[1:-1, 1:-1, 3] = face_alpha
+    samples = source.reshape(-1, 4)[index]  # (n, 4 vecinos, 4 canales)
+    warped = (np.einsum("nkc,nk->nc", samples, weights) + ALPHA_ONE // 2) >> 8
+    warped = warped.reshape(out_h, out_w, 4)
+    return warped[..., :3].astype(np.uint8), warped[..., 3].astype(np.uint16)
+
+
+def warp_faces(fitted, boxes, angles):
+    """Caras rotadas según la rotación de cada frame
+
+    Devuelve (caras, cajas, claves): la cara (rgb, máscara) por clave
+    (ancho, alto, ángulo), la caja que ocupa la cara ya rotada en cada frame
+    (mismo centro que la anotada) y la clave de cada frame. Sin rotación la
+    cara y la caja quedan como estaban.
+    """
+    angles = np.round(np.asarray(angles, dtype=np.float64) / ANGLE_STEP) * ANGLE_STEP
+    faces = {}
+    placed = np.array(boxes, dtype=np.int32, copy=True)
+    keys = []
+    for i, ((x, y, w, h), angle) in enumerate(zip(boxes.tolist(), angles.tolist())):
+        key = (w, h, angle)
+        if key not in faces:
+            face_rgb, face_alpha = fitted[w, h]
+            faces[key] = warp_face(face_rgb, face_alpha, angle) if angle else (face_rgb, face_alpha)
+        out_h, out_w = faces[key][1].shape
+        placed[i] = (x + (w - out_w) // 2, y + (h - out_h) // 2, out_w, out_h)
+        keys.append(key)
+    return faces, placed, keys
+
+
+def template_tone(frame, box):
+    """Color medio (float, RGB) del template dentro de la elipse de la caja, o None"""
+    x, y, w, h = (int(v) for v in box)
+    height, width = frame.shape[:2]
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, width), min(y + h, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    alpha = elliptical_mask((w, h))[y0 - y:y1 - y, x0 - x:x1 - x]
+    weight = alpha.sum()
+    if not weight:
+        return None
+    region = frame[y0:y1, x0:x1].reshape(-1, 3).astype(np.float64)
+    return alpha.reshape(-1) @ region / weight
+
+
+def match_tone(face_rgb, face_alpha, tone, strength=FACE_TONE_MATCH):
+    """Acercar el color medio de la cara a ``tone`` con una tabla de 256 valores por canal"""
+    if tone is None or strength <= 0:
+        return face_rgb
+    weight = face_alpha.sum()
+    if not weight:
+        return face_rgb
+    face_mean = face_alpha.reshape(-1) @ face_rgb.reshape(-1, 3).astype(np.float64) / weight
+    gain = 1.0 + strength * (np.asarray(tone) / np.maximum(face_mean, 1.0) - 1.0)
+    # Ganancia en punto fijo (Q8): tabla[c, v] = v * ganancia_c
+    gain_q8 = np.round(np.clip(gain, *TONE_GAIN_RANGE) * 256).astype(np.uint32)
+    table = np.minimum((np.arange(256, dtype=np.uint32)[None] * gain_q8[:, None] + 128) >> 8, 255)
+    table = table.astype(np.uint8)
+    return np.stack([table[c][face_rgb[..., c]] for c in range(3)], axis=-1)
+
+
+def blend_layer(face_rgb, face_alpha):
+    """Términos de la mezcla en punto fijo: (cara * máscara + redondeo, ALPHA_ONE - máscara)
+
+    Se calculan una vez por cara y tamaño; después cada píxel del frame es
+    ``(fondo * inversa + premultiplicada) >> 8``, que entra en uint16.
+    """
+    alpha = face_alpha[:, :, None]
+    premultiplied = face_rgb.astype(np.uint16) * alpha + ALPHA_ONE // 2
+    return premultiplied, ALPHA_ONE - alpha
+
+
+def composite_face(frames, layer, positions, out=None):
+    """Pegar la cara en todos los frames a la vez
+
+    ``layer`` son los términos de blend_layer. ``positions`` es la esquina
+    superior izquierda (x, y) de la cara, una sola para todos los frames o
+    una por frame. La mezcla se hace con indexado avanzado sobre el stack
+    completo, sin bucles por frame.
+    """
+    premultiplied, inverse = layer
+    n_frames, height, width, _ = frames.shape
+    h, w = inverse.shape[:2]
+    positions = np.broadcast_to(np.asarray(positions).reshape(-1, 2), (n_frames, 2))
+    xs = np.clip(positions[:, 0], -w, width)
+    ys = np.clip(positions[:, 1], -h, height)
+    if out is None:
+        out = frames.copy()
+
+    # Si alguna caja se sale del frame, trabajar sobre una copia con margen
+    pad = 0
+    if xs.min() < 0 or ys.min() < 0 or (xs + w).max() > width or (ys + h).max() > height:
+        pad = max(w, h)
+        work = np.pad(out, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+    else:
+        work = out
+
+    frame_idx = np.arange(n_frames)[:, None, None]
+    rows = ((ys + pad)[:, None] + np.arange(h))[:, :, None]
+    cols = ((xs + pad)[:, None] + np.arange(w))[:, None, :]
+
+    region = work[frame_idx, rows, cols].astype(np.uint16)
+    region *= inverse
+    region += premultiplied
+    region >>= 8
+    work[frame_idx, rows, cols] = region
+
+    if pad:
+        out[...] = work[:, pad:pad + height, pad:pad + width]
+    return out
+
+
+def fit_faces(face_image, boxes, known=None, resample=Image.LANCZOS, tone=None):
+    """Cara ajustada (rgb, máscara) para cada tamaño de caja distinto
+
+    ``known`` son ajustes ya calculados (ver PreparedFace) que se reutilizan.
+    Con ``tone`` (ver template_tone) el color de la cara se acerca a ese tono.
+    """
+    known = known or {}
+    fitted = {}
+    for w, h in np.unique(boxes[:, 2:4], axis=0):
+        size = (int(w), int(h))
+        face_rgb, face_alpha = known.get(size) or fit_face(face_image, size, resample)
+        fitted[size] = match_tone(face_rgb, face_alpha, tone), face_alpha
+    return fitted
+
+
+def face_pixels(fitted):
+    """Píxeles visibles de la cara ajustada, para armar la paleta del swap"""
+    return np.concatenate([rgb[alpha > 0] for rgb, alpha in fitted.values()])
+
+
+def composite_faces(frames, face_image, boxes, fitted=None, keys=None):
+    """Componer con cajas por frame que pueden tener tamaños distintos
+
+    Los frames se agrupan por la cara que llevan (``keys``, de warp_faces; si
+    no se pasan, por tamaño de caja): la cara se prepara una vez por grupo y
+    cada grupo se mezcla en una sola operación vectorizada.
+    """
+    fitted = fitted or fit_faces(face_image, boxes)
+    if keys is None:
+        keys = [tuple(size) for size in boxes[:, 2:4].tolist()]
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    out = frames.copy()
+    for key, group in groups.items():
+        layer = blend_layer(*fitted[key])
+        group = np.asarray(group)
+        if len(group) == len(out):
+            composite_face(out, layer, boxes[:, :2], out=out)
+        else:
+            subset = out[group]
+            out[group] = composite_face(subset, layer, boxes[group, :2], out=subset)
+    return out
+
+
+def encode_gif(frames, durations, loop=0):
+    """Codificar el stack de frames RGB como GIF animado"""
+    images = [Image.fromarray(frame) for frame in frames]
+    buffer = io.BytesIO()
+    images[0].save(
+        buffer,
+        format="GIF",
+        save_all=True,
+        append_images=images[1:],
+        duration=list(durations),
+        loop=loop,
+    )
+    return buffer.getvalue()
+
+
+def encode_swap(frames, template, boxes, fitted):
+    """Codificar un swap reutilizando la paleta e índices del template
+
+    Sólo se mapean los píxeles dentro de las cajas de la cara y cada frame se
+    emite como el rectángulo que cambió. Si el template no tiene paleta
+    compartible se cae al codificador de Pillow.
+    """
+    if template.index_frames is None:
+        return encode_gif(frames, template.durations, template.loop)
+    palette = swap_palette(template.palette_colors, face_pixels(fitted))
+    indices = index_swap_frames(frames, template.index_frames, boxes, PaletteMapper(palette))
+    return b"".join(iter_indexed_gif(indices, palette, template.durations, template.loop))
+
+
+def encode_frames(frames, durations, loop=0, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Codificar el stack de frames RGB en WebP o APNG animado"""
+    spec = OUTPUT_FORMATS[output_format]
+    images = [Image.fromarray(frame) for frame in frames]
+    buffer = io.BytesIO()
+    images[0].save(
+        buffer,
+        format=spec["pillow"],
+        save_all=True,
+        append_images=images[1:],
+        duration=list(durations),
+        loop=loop,
+        **spec["options"],
+    )
+    return buffer.getvalue()
+
+
+def _fetch_template(template_path, cache):
+    if cache is not None:
+        return cache.get(template_path)
+    return decode_template(template_path)
+
+
+def reduce_template(template, boxes, angles, quality=DEFAULT_QUALITY):
+    """Template, cajas y rotaciones reducidos al nivel de calidad: (DecodedTemplate, cajas, rotaciones)
+
+    Se achica con vecino más cercano (indexando filas y columnas, sin
+    filtrar), así los índices de paleta siguen valiendo y se conserva el
+    camino rápido del codificador. Los frames descartados suman su duración
+    al frame que queda, para que la animación dure lo mismo.
+    """
+    tier = QUALITY_TIERS[quality]
+    n_frames = len(template.frames)
+    keep = np.arange(n_frames)
+    durations = list(template.durations)
+    if tier["max_frames"] and n_frames > tier["max_frames"]:
+        step = -(-n_frames // tier["max_frames"])
+        keep = keep[::step]
+        durations = [sum(template.durations[i:i + step]) for i in keep]
+
+    width, height = template.size
+    max_side = tier["max_side"]
+    scale = max_side / max(width, height) if max_side and max(width, height) > max_side else 1.0
+    if scale == 1.0 and len(keep) == n_frames:
+        return template, boxes, angles
+
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    rows = np.minimum(((np.arange(new_height) + 0.5) * height / new_height).astype(np.intp), height - 1)
+    cols = np.minimum(((np.arange(new_width) + 0.5) * width / new_width).astype(np.intp), width - 1)
+
+    def pick(stack):
+        if len(keep) < n_frames:
+            stack = stack.take(keep, axis=0)
+        return stack.take(rows, axis=1).take(cols, axis=2)
+
+    index_frames = pick(template.index_frames) if template.index_frames is not None else None
+
+    boxes = boxes[keep]
+    angles = angles[keep]
+    if scale != 1.0:
+        factors = np.array([new_width / width, new_height / height] * 2)
+        boxes = np.round(boxes * factors).astype(np.int32)
+        boxes[:, 2:4] = np.maximum(boxes[:, 2:4], 1)
+    reduced = DecodedTemplate(frames=pick(template.frames), durations=durations, loop=template.loop,
+                              palette=template.palette, palette_colors=template.palette_colors,
+                              index_frames=index_frames)
+    return reduced, boxes, angles
+
+
+def _prepare_swap(face_source, template_path, timer, cache, quality):
+    """Template (ya reducido a ``quality``), cara normalizada y caras listas para mezclar
+
+    Devuelve (template, cara, caras por clave, cajas, clave de cada frame):
+    las cajas y claves son las de warp_faces.
+    """
+    tier = QUALITY_TIERS[quality]
+    with timer.stage("template_fetch"):
+        template = _fetch_template(template_path, cache)
+        boxes, angles = face_boxes_for(template_path, template)
+        template, boxes, angles = reduce_template(template, boxes, angles, quality)
+
+    with timer.stage("face_decode"):
+        face_image = load_face(face_source, tier["face_side"])
+
+    with timer.stage("composite"):
+        tone = template_tone(template.frames[0], boxes[0])
+        # Los ajustes precalculados sólo valen para la cara entera y con LANCZOS,
+        # así un face_id da lo mismo que subir la foto
+        known = getattr(face_source, "fits", None)
+        if tier["face_side"] < FACE_MAX_SIDE or tier["resample"] != Image.LANCZOS:
+            known = None
+        fitted = fit_faces(face_image, boxes, known, tier["resample"], tone)
+        faces, boxes, keys = warp_faces(fitted, boxes, angles)
+    return template, face_image, faces, boxes, keys
+
+
+def render_swap(face_source, template_path, timer=None, cache=None,
+                output_format=DEFAULT_OUTPUT_FORMAT, quality=DEFAULT_QUALITY):
+    """Pipeline completo: decodificar, componer y codificar. Devuelve los bytes del archivo
+
+    Si se pasa un ``cache`` (ver template_cache.TemplateCache) los frames del
+    template se toman de ahí en lugar de decodificarlos en cada petición.
+    ``output_format`` es una de las claves de OUTPUT_FORMATS y ``quality``
+    una de QUALITY_TIERS.
+    """
+    timer = timer or StageTimer()
+    template, face_image, faces, boxes, keys = _prepare_swap(face_source, template_path, timer, cache, quality)
+
+    with timer.stage("composite"):
+        frames = composite_faces(template.frames, face_image, boxes, faces, keys)
+
+    with timer.stage("encode"):
+        if output_format == "gif":
+            data = encode_swap(frames, template, boxes, faces)
+        else:
+            data = encode_frames(frames, template.durations, template.loop, output_format)
+
+    return data
+
+
+def iter_swap(face_source, template_path, timer=None, cache=None, quality=DEFAULT_QUALITY):
+    """Igual que render_swap, pero genera el GIF por partes
+
+    El encabezado con la paleta sale apenas se decodificó la cara, y cada
+    frame sale en cuanto se compone, así el primer byte no espera a toda la
+    animación. Los bytes son los mismos que los de render_swap.
+    """
+    timer = timer or StageTimer()
+    template, face_image, faces, boxes, keys = _prepare_swap(face_source, template_path, timer, cache, quality)
+
+    if template.index_frames is None:
+        # Sin paleta compartible Pillow necesita todos los frames juntos
+        with timer.stage("composite"):
+            frames = composite_faces(template.frames, face_image, boxes, faces, keys)
+        with timer.stage("encode"):
+            data = encode_gif(frames, template.durations, template.loop)
+        yield data
+        return
+
+    with timer.stage("encode"):
+        palette = swap_palette(template.palette_colors, face_pixels(faces))
+        mapper = PaletteMapper(palette)
+        encoder = IndexedGifEncoder(template.size, palette, template.loop)
+        chunk = encoder.header()
+    yield chunk
+
+    with timer.stage("composite"):
+        layers = {key: blend_layer(face_rgb, face_alpha) for key, (face_rgb, face_alpha) in faces.items()}
+
+    for i in range(len(template.frames)):
+        frame_slice = slice(i, i + 1)
+        with timer.stage("composite"):
+            layer = layers[keys[i]]
+            frame = composite_face(template.frames[frame_slice], layer, boxes[frame_slice, :2])
+        with timer.stage("encode"):
+            indices = index_swap_frames(frame, template.index_frames[frame_slice],
+                                        boxes[frame_slice], mapper)
+            chunk = encoder.frame(indices[0], template.durations[i])
+        yield chunk
+
+    yield encoder.trailer()
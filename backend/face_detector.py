@@ -0,0 +1,184 @@
+"""Detector de regiones de cabeza en CPU para templates sin anotaciones.
+
+Trabaja sobre el stack completo de frames en una sola pasada NumPy: segmenta
+tonos de piel en YCbCr, ajusta una elipse por momentos (centro, tamaño y
+rotación) a los píxeles de piel de cada frame y suaviza la pista en el tiempo.
+Se ejecuta una vez por versión del template y el resultado se guarda como
+sidecar ``.faces.json``, así el swap nunca paga la detección. Si no encuentra
+ninguna cara lo anota en ``.noface`` con la versión, para no repetirla en
+cada arranque.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from face_annotations import FaceTrack, annotation_path, load_face_track, write_face_track
+from template_index import file_version
+
+# Rango de piel en YCbCr (ampliado para cubrir tonos claros tipo "beige")
+CB_RANGE = (77.0, 135.0)
+CR_RANGE = (128.0, 175.0)
+MIN_SKIN_FRACTION = 0.002
+# Por debajo de esta excentricidad la cabeza se considera sin rotación
+MIN_ELONGATION = 1.15
+NO_FACE_SUFFIX = ".noface"
+
+
+def template_version(path):
+    """Versión del archivo en disco (la misma que usa el índice de templates)"""
+    stat = Path(path).stat()
+    return file_version(stat.st_size, stat.st_mtime_ns)
+
+
+def no_face_path(gif_path):
+    """Marca de "sin cara" del template: guarda la versión en la que no se encontró"""
+    gif_path = Path(gif_path)
+    return gif_path.with_name(gif_path.stem + NO_FACE_SUFFIX)
+
+
+def _no_face_version(gif_path):
+    try:
+        return no_face_path(gif_path).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+
+
+def skin_mask(frames):
+    """Máscara booleana de piel para todos los frames (n, alto, ancho)"""
+    rgb = frames.astype(np.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    cb = 128.0 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128.0 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    return (
+        (cb >= CB_RANGE[0]) & (cb <= CB_RANGE[1])
+        & (cr >= CR_RANGE[0]) & (cr <= CR_RANGE[1])
+        & (r > b + 10.0)
+    )
+
+
+def _moments(mask, xs, ys, center=None, radius=None):
+    """Centroide y covarianza de los píxeles de la máscara, por frame"""
+    weights = mask.astype(np.float32)
+    if center is not None:
+        # Segunda pasada: sólo píxeles cerca del centro (descarta ruido lejano)
+        dx = xs[None, None, :] - center[:, 0, None, None]
+        dy = ys[None, :, None] - center[:, 1, None, None]
+        near = (dx * dx + dy * dy) <= (radius[:, None, None] ** 2)
+        weights = weights * near
+    count = weights.sum(axis=(1, 2))
+    safe = np.maximum(count, 1.0)
+    col_sum = weights.sum(axis=1)  # (n, ancho)
+    row_sum = weights.sum(axis=2)  # (n, alto)
+    mx = (col_sum * xs).sum(axis=1) / safe
+    my = (row_sum * ys).sum(axis=1) / safe
+    vxx = (col_sum * xs * xs).sum(axis=1) / safe - mx * mx
+    vyy = (row_sum * ys * ys).sum(axis=1) / safe - my * my
+    vxy = np.einsum("nyx,y,x->n", weights, ys, xs) / safe - mx * my
+    return count, np.stack([mx, my], axis=1), vxx, vyy, vxy
+
+
+def _fill_missing(values, valid):
+    """Interpolar linealmente los frames sin detección a partir de sus vecinos"""
+    idx = np.arange(len(values))
+    filled = values.copy()
+    for col in range(values.shape[1]):
+        filled[:, col] = np.interp(idx, idx[valid], values[valid, col])
+    return filled
+
+
+def _smooth(values, window=3):
+    """Media móvil a lo largo de los frames (repite los extremos)"""
+    if len(values) < window:
+        return values
+    half = window // 2
+    padded = np.pad(values, ((half, half), (0, 0)), mode="edge")
+    kernel = np.ones(window, dtype=np.float32) / window
+    return np.stack(
+        [np.convolve(padded[:, col], kernel, mode="valid") for col in range(values.shape[1])],
+        axis=1,
+    )
+
+
+def head_tilt(vxx, vyy, vxy):
+    """Inclinación (grados, eje y hacia abajo) de la elipse de covarianza
+
+    El eje mayor se mide desde el eje x; una cabeza derecha (más alta que
+    ancha) tiene el eje mayor vertical, así que su inclinación se mide desde
+    la vertical. Las elipses casi circulares no tienen rotación definida.
+    """
+    angles = np.degrees(0.5 * np.arctan2(2.0 * vxy, vxx - vyy))
+    upright = vyy > vxx
+    angles = np.where(upright, angles - np.where(angles > 0, 90.0, -90.0), angles)
+    spread = np.sqrt((vxx - vyy) ** 2 + 4.0 * vxy ** 2)
+    major = vxx + vyy + spread
+    minor = np.maximum(vxx + vyy - spread, 1e-6)
+    return np.where(major / minor >= MIN_ELONGATION ** 2, angles, 0.0).astype(np.float64)
+
+
+def detect_face_track(frames, max_side=160):
+    """Detectar la cabeza en todos los frames; devuelve FaceTrack o None"""
+    n_frames, height, width, _ = frames.shape
+    step = max(1, int(np.ceil(max(height, width) / max_side)))
+    small = frames[:, ::step, ::step]
+    mask = skin_mask(small)
+
+    ys = (np.arange(mask.shape[1], dtype=np.float32) + 0.5) * step
+    xs = (np.arange(mask.shape[2], dtype=np.float32) + 0.5) * step
+
+    count, center, vxx, vyy, _ = _moments(mask, xs, ys)
+    radius = 2.5 * np.sqrt(np.maximum(vxx + vyy, 1.0))
+    count, center, vxx, vyy, vxy = _moments(mask, xs, ys, center, radius)
+
+    min_pixels = MIN_SKIN_FRACTION * mask.shape[1] * mask.shape[2]
+    valid = count >= max(min_pixels, 4)
+    if not valid.any():
+        return None
+
+    # Para una elipse uniforme, el semieje es 2 * desviación estándar
+    sizes = 4.0 * np.sqrt(np.maximum(np.stack([vxx, vyy], axis=1), 1.0))
+    angles = head_tilt(vxx, vyy, vxy)
+    # Sin saltos de 180° entre frames antes de interpolar y promediar
+    angles[valid] = np.unwrap(angles[valid], period=180.0)
+
+    track = np.concatenate([center, sizes, angles[:, None]], axis=1)
+    track = _smooth(_fill_missing(track, valid))
+    track[:, 4] = (track[:, 4] + 90.0) % 180.0 - 90.0
+
+    w = np.clip(track[:, 2], 4, width)
+    h = np.clip(track[:, 3], 4, height)
+    boxes = np.stack([
+        np.round(track[:, 0] - w / 2),
+        np.round(track[:, 1] - h / 2),
+        np.round(w),
+        np.round(h),
+    ], axis=1).astype(np.int32)
+    # La rotación de la imagen va en sentido antihorario (eje y hacia abajo)
+    rotation = (np.round(-track[:, 4], 1) + 0.0).astype(np.float32)
+    return FaceTrack(width, height, boxes, rotation, source="detector")
+
+
+def ensure_face_annotations(template_path, cache):
+    """Garantizar que el template tenga sidecar de anotaciones vigente
+
+    Si ya existe uno escrito a mano o por el generador se respeta; si es de
+    una detección sobre una versión anterior del GIF, se vuelve a detectar.
+    Devuelve el FaceTrack resultante (o None si no se encontró ninguna cara).
+    """
+    version = template_version(template_path)
+    track = load_face_track(template_path)
+    if track is not None and (track.source != "detector" or track.template_version == version):
+        return track
+    if _no_face_version(template_path) == version:
+        return None
+
+    template = cache.get(template_path)
+    track = detect_face_track(template.frames)
+    if track is None:
+        # Sin cara en esta versión: no dejar la detección de la anterior
+        annotation_path(template_path).unlink(missing_ok=True)
+        no_face_path(template_path).write_text(version, encoding="utf-8")
+        return None
+    track = track.with_version(version)
+    write_face_track(template_path, track)
+    no_face_path(template_path).unlink(missing_ok=True)
+    return track
@@ -0,0 +1,115 @@
+"""Caras subidas una vez y reutilizadas por id.
+
+POST /faces decodifica la foto, la orienta, la normaliza y precalcula recorte
+y máscara para los tamaños de caja del catálogo; el resultado queda aquí en
+memoria bajo un ``face_id``. Los swaps pueden mandar ese id en lugar de volver
+a subir la imagen, y se saltean todo el preprocesado.
+
+El id se deriva del contenido, así que subir la misma foto dos veces devuelve
+el mismo id. Las entradas vencen FACE_TTL_SECONDS después de su último uso y
+el total se acota a FACE_STORE_MAX_MB con desalojo LRU.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+DEFAULT_MAX_BYTES = int(float(os.getenv("FACE_STORE_MAX_MB", "128")) * 1024 * 1024)
+DEFAULT_TTL_SECONDS = float(os.getenv("FACE_TTL_SECONDS", "1800"))
+
+
+def face_id_for(face_hash):
+    """Id público de una cara a partir del hash de sus bytes"""
+    return face_hash.hex()[:32]
+
+
+@dataclass
+class StoredFace:
+    face_id: str
+    face_hash: bytes  # sha256 de los bytes subidos (entra en la clave del resultado)
+    prepared: object  # compositor.PreparedFace
+    expires_at: float
+
+    @property
+    def nbytes(self):
+        return self.prepared.nbytes
+
+
+class FaceStore:
+    """LRU en memoria de caras preprocesadas, acotado por bytes y con expiración"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bytes_in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, face_id):
+        """La cara guardada (renovando su vencimiento), o None si no existe o venció"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            stored = self._entries.get(face_id)
+            if stored is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(face_id)
+            stored.expires_at = now + self.ttl_seconds
+            self.hits += 1
+            return stored
+
+    def put(self, face_hash, prepared):
+        """Guardar una cara preprocesada; devuelve su StoredFace"""
+        now = time.time()
+        face_id = face_id_for(face_hash)
+        stored = StoredFace(face_id, face_hash, prepared, now + self.ttl_seconds)
+        with self._lock:
+            self._prune(now)
+            previous = self._entries.pop(face_id, None)
+            if previous is not None:
+                self.bytes_in_use -= previous.nbytes
+            if stored.nbytes > self.max_bytes:
+                return stored
+            self._entries[face_id] = stored
+            self.bytes_in_use += stored.nbytes
+            while self.bytes_in_use > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes_in_use -= evicted.nbytes
+                self.evictions += 1
+        return stored
+
+    def _prune(self, now):
+        # Con TTL renovado en cada uso, el orden LRU es también el de vencimiento
+        while self._entries:
+            face_id, stored = next(iter(self._entries.items()))
+            if stored.expires_at > now:
+                break
+            del self._entries[face_id]
+            self.bytes_in_use -= stored.nbytes
+            self.expirations += 1
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.time())
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes_in_use": self.bytes_in_use,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Instancia compartida por la app
+face_store = FaceStore()
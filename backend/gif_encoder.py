@@ -0,0 +1,227 @@
+"""Codificador GIF que reutiliza la paleta del template y sólo emite lo que cambia.
+
+En un swap sólo cambia la región de la cara: el resto de cada frame es
+idéntico al template, que ya está cuantizado. Por eso:
+
+1. La paleta del template (sus colores exactos, calculados una vez al
+   decodificarlo) se reutiliza tal cual y se completa con unos pocos colores
+   de la cara.
+2. Los índices del template se copian sin tocar; sólo los píxeles de la
+   región de la cara se mapean, con una tabla RGB -> índice (18 bits) que se
+   llena sólo para los colores que aparecen.
+3. Cada frame se emite como el sub-rectángulo que cambió respecto al anterior,
+   con transparencia en los píxeles iguales (disposal = 1), lo que además
+   deja corridas largas que LZW comprime muy bien.
+
+Si el template tiene demasiados colores para compartir paleta (p. ej. un GIF
+fotográfico con paletas locales) el compositor usa el codificador de Pillow.
+"""
+import struct
+
+import numpy as np
+from PIL import GifImagePlugin, Image
+
+# Máximo de colores del template para reservar al menos el resto a la cara
+MAX_TEMPLATE_COLORS = 192
+PALETTE_SIZE = 256
+LUT_BITS = 6  # bits por canal de la tabla RGB -> índice
+UNIQUE_PROBE = 16384  # píxeles nuevos que se miran antes de contar los de todo el frame
+
+
+def pack_rgb(pixels):
+    """Empaquetar colores RGB (..., 3) en enteros de 24 bits"""
+    pixels = pixels.astype(np.uint32)
+    return (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+
+def build_template_palette(frames):
+    """Paleta exacta del template e índices por frame, o (None, None)
+
+    Devuelve ``(colores (k, 3) uint8, índices (n, alto, ancho) uint8)`` si el
+    template cabe en MAX_TEMPLATE_COLORS colores. Los colores se numeran
+    frame a frame con una tabla de 24 bits (sin ordenar todos los píxeles) y
+    se abandona en cuanto hay demasiados.
+    """
+    slots = np.zeros(1 << 24, dtype=np.uint8)  # color -> número de aparición + 1 (0 = no visto)
+    found = []
+    count = 0
+    indices = np.empty(frames.shape[:3], dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        keys = pack_rgb(frame)
+        seen = slots[keys]
+        missing = seen == 0
+        if missing.any():
+            new = keys[missing]
+            # Un frame fotográfico ya se pasa en sus primeros píxeles: no ordenar todo
+            if count + len(np.unique(new[:UNIQUE_PROBE])) > MAX_TEMPLATE_COLORS:
+                return None, None
+            new = np.unique(new)
+            if count + len(new) > MAX_TEMPLATE_COLORS:
+                return None, None
+            slots[new] = np.arange(count + 1, count + len(new) + 1)
+            count += len(new)
+            found.append(new)
+            seen[missing] = slots[keys[missing]]
+        indices[i] = seen
+
+    # Paleta ordenada por color, como con np.unique: la salida no cambia
+    keys = np.concatenate(found)
+    order = np.argsort(keys)
+    rank = np.zeros(PALETTE_SIZE, dtype=np.uint8)
+    rank[order + 1] = np.arange(count)
+    indices = rank[indices]
+    unique = keys[order]
+    colors = np.stack([(unique >> 16) & 255, (unique >> 8) & 255, unique & 255], axis=1)
+    return colors.astype(np.uint8), indices
+
+
+class PaletteMapper:
+    """Mapeo RGB -> índice de paleta con tabla de 18 bits llenada a demanda"""
+
+    def __init__(self, palette):
+        self.palette = palette.astype(np.int32)
+        self.keys = pack_rgb(palette)
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+        self.lut = np.full(1 << (3 * LUT_BITS), -1, dtype=np.int16)
+
+    def map(self, pixels):
+        """Índices para ``pixels`` (m, 3): exactos si el color está en la paleta"""
+        if not len(pixels):
+            return np.zeros(0, dtype=np.uint8)
+        keys = pack_rgb(pixels)
+        pos = np.searchsorted(self.sorted_keys, keys)
+        pos = np.minimum(pos, len(self.sorted_keys) - 1)
+        exact = self.sorted_keys[pos] == keys
+        result = self.order[pos].astype(np.int16)
+        if not exact.all():
+            result[~exact] = self._nearest(pixels[~exact])
+        return result.astype(np.uint8)
+
+    def _nearest(self, pixels):
+        shift = 8 - LUT_BITS
+        q = pixels.astype(np.int32) >> shift
+        bins = (q[:, 0] << (2 * LUT_BITS)) | (q[:, 1] << LUT_BITS) | q[:, 2]
+        missing = np.unique(bins[self.lut[bins] < 0])
+        if len(missing):
+            # Centro de cada celda de la tabla contra toda la paleta
+            mask = (1 << LUT_BITS) - 1
+            centers = np.stack([
+                (missing >> (2 * LUT_BITS)) & mask,
+                (missing >> LUT_BITS) & mask,
+                missing & mask,
+            ], axis=1) * (1 << shift) + (1 << shift) // 2
+            dist = ((centers[:, None, :] - self.palette[None, :, :]) ** 2).sum(axis=2)
+            self.lut[missing] = dist.argmin(axis=1)
+        return self.lut[bins]
+
+
+def face_region_mask(shape, boxes):
+    """Máscara (n, alto, ancho) de los píxeles dentro de la caja de cada frame"""
+    n_frames, height, width = shape
+    rows = np.arange(height)[None, :, None]
+    cols = np.arange(width)[None, None, :]
+    x, y, w, h = (boxes[:, i, None, None] for i in range(4))
+    return (rows >= y) & (rows < y + h) & (cols >= x) & (cols < x + w)
+
+
+def swap_palette(template_colors, face_pixels):
+    """Paleta del swap: los colores del template más los de la cara cuantizados
+
+    Siempre deja libre al menos un índice, que se usa como transparente.
+    """
+    template_keys = np.sort(pack_rgb(template_colors))
+    keys = pack_rgb(face_pixels)
+    pos = np.minimum(np.searchsorted(template_keys, keys), len(template_keys) - 1)
+    foreign = face_pixels[template_keys[pos] != keys]
+
+    n_face_colors = PALETTE_SIZE - len(template_colors) - 1
+    face_colors = np.zeros((0, 3), dtype=np.uint8)
+    if len(foreign) and n_face_colors > 0:
+        sample = Image.fromarray(np.ascontiguousarray(foreign.reshape(1, -1, 3)))
+        quantized = sample.quantize(colors=n_face_colors, method=Image.Quantize.MEDIANCUT)
+        used = len(np.unique(np.asarray(quantized)))
+        face_colors = np.array(quantized.getpalette()[:3 * used], dtype=np.uint8).reshape(-1, 3)
+    return np.concatenate([template_colors, face_colors])
+
+
+def index_swap_frames(frames, template_indices, boxes, mapper):
+    """Índices de los frames compuestos: los del template, salvo en las cajas de la cara"""
+    region = face_region_mask(template_indices.shape, boxes)
+    indices = template_indices.copy()
+    indices[region] = mapper.map(frames[region])
+    return indices
+
+
+def _header(size, palette, loop):
+    width, height = size
+    table = np.zeros((PALETTE_SIZE, 3), dtype=np.uint8)
+    table[:len(palette)] = palette
+    chunks = [
+        b"GIF89a",
+        struct.pack("<HHBBB", width, height, 0xF7, 0, 0),  # tabla global de 256 colores
+        table.tobytes(),
+    ]
+    if loop is not None:
+        chunks.append(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+    return b"".join(chunks)
+
+
+def _frame_bytes(pixels, offset, duration, transparency=None, disposal=1):
+    im = Image.fromarray(np.ascontiguousarray(pixels), "L")
+    params = {"duration": duration, "disposal": disposal}
+    if transparency is not None:
+        params["transparency"] = transparency
+    return b"".join(GifImagePlugin.getdata(im, offset=offset, **params))
+
+
+class IndexedGifEncoder:
+    """Escribe un GIF indexado frame a frame, para poder enviarlo mientras se genera
+
+    Cada frame después del primero sólo lleva el rectángulo que cambió,
+    con los píxeles iguales marcados como transparentes.
+    """
+
+    def __init__(self, size, palette, loop=0):
+        self.size = size
+        self.palette = palette
+        self.loop = loop
+        self.transparent_index = min(len(palette), PALETTE_SIZE - 1)
+        self._previous = None
+
+    def header(self):
+        return _header(self.size, self.palette, self.loop)
+
+    def frame(self, indices, duration):
+        previous, self._previous = self._previous, indices
+        if previous is None:
+            return _frame_bytes(indices, (0, 0), duration)
+
+        changed = indices != previous
+        rows = np.flatnonzero(changed.any(axis=1))
+        if not len(rows):
+            # Frame idéntico: un pixel transparente mantiene el tiempo
+            pixel = np.full((1, 1), self.transparent_index, dtype=np.uint8)
+            return _frame_bytes(pixel, (0, 0), duration, self.transparent_index)
+        cols = np.flatnonzero(changed.any(axis=0))
+        y0, y1 = rows[0], rows[-1] + 1
+        x0, x1 = cols[0], cols[-1] + 1
+        crop = indices[y0:y1, x0:x1].copy()
+        crop[~changed[y0:y1, x0:x1]] = self.transparent_index
+        return _frame_bytes(crop, (int(x0), int(y0)), duration, self.transparent_index)
+
+    def trailer(self):
+        return b";"
+
+
+def iter_indexed_gif(index_frames, palette, durations, loop=0):
+    """Generar el GIF por partes: primero el encabezado, luego cada frame"""
+    encoder = None
+    for indices, duration in zip(index_frames, durations):
+        if encoder is None:
+            height, width = indices.shape
+            encoder = IndexedGifEncoder((width, height), palette, loop)
+            yield encoder.header()
+        yield encoder.frame(indices, duration)
+    if encoder is not None:
+        yield encoder.trailer()
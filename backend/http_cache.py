@@ -0,0 +1,190 @@
+"""Respuestas de archivos con caché HTTP: ETag fuerte, 304 y rangos de bytes.
+
+- Los resultados se nombran con el hash de su contenido y los templates se
+  piden con ``?v=<versión>``: esas URLs no cambian nunca de contenido, así que
+  se sirven con ``Cache-Control: immutable`` y el navegador no vuelve a pedirlas.
+- Todo lo demás se sirve con ``no-cache``: el navegador revalida con
+  If-None-Match y recibe un 304 sin cuerpo si no cambió.
+- ``Range: bytes=...`` devuelve 206 para reanudar descargas cortadas (la
+  versión de Starlette que usamos no lo soporta en FileResponse).
+- negotiate_media_type elige el formato de salida según el header Accept.
+"""
+import os
+import re
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, QueryParams
+
+from template_index import file_version
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def file_etag(stat_result):
+    """ETag fuerte a partir del tamaño y la fecha de modificación"""
+    return f'"{file_version(stat_result.st_size, stat_result.st_mtime_ns)}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Comparación débil de If-None-Match (como pide la RFC 9110)"""
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def parse_range(header, size):
+    """(inicio, fin inclusivo) de un Range de un solo tramo
+
+    Devuelve None si el header no aplica o es inválido (se responde el
+    archivo completo, como pide la RFC 9110) y lanza ValueError sólo si el
+    rango está bien formado pero no se puede satisfacer.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Sufijo: los últimos N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("rango vacío")
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        # "bytes=50-10" no es un rango válido: se ignora
+        return None
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        raise ValueError("rango fuera del archivo")
+    return start, end
+
+
+def _read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def cached_file_response(request_headers, path, stat_result=None, etag=None,
+                         cache_control=REVALIDATE, media_type=None, filename=None,
+                         status_code=200):
+    """Servir un archivo respetando If-None-Match, Range e If-Range"""
+    stat_result = stat_result or os.stat(path)
+    etag = etag or file_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    size = stat_result.st_size
+    range_header = request_headers.get("range")
+    if_range = request_headers.get("if-range")
+    # If-Range con otro ETag: el archivo cambió, mandar la versión completa
+    if range_header and status_code == 200 and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            if filename:
+                headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+            return StreamingResponse(
+                _read_range(path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers=headers,
+            )
+
+    return FileResponse(
+        path,
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+        filename=filename,
+        stat_result=stat_result,
+    )
+
+
+def parse_accept(header):
+    """Lista de (media range, q) de un header Accept"""
+    ranges = []
+    for part in (header or "").split(","):
+        media_range, *params = [piece.strip() for piece in part.split(";")]
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((media_range.lower(), q))
+    return ranges
+
+
+def negotiate_media_type(accept_header, offered):
+    """El media type de ``offered`` (en orden de preferencia) que mejor acepta el cliente
+
+    Un tipo nombrado explícitamente gana sobre uno aceptado por comodín con
+    el mismo q. Devuelve None si el cliente no acepta ninguno.
+    """
+    ranges = parse_accept(accept_header) or [("*/*", 1.0)]
+    best, best_rank = None, None
+    for position, media_type in enumerate(offered):
+        kind = media_type.split("/")[0]
+        matches = [
+            (specificity, q) for media_range, q in ranges
+            for specificity, pattern in ((2, media_type), (1, f"{kind}/*"), (0, "*/*"))
+            if media_range == pattern
+        ]
+        if not matches:
+            continue
+        specificity, q = max(matches)
+        if q <= 0:
+            continue
+        rank = (q, specificity, -position)
+        if best_rank is None or rank > best_rank:
+            best, best_rank = media_type, rank
+    return best
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles con ETag fuerte, Range e ``immutable`` para URLs versionadas
+
+    Si la URL trae ``?v=`` y coincide con la versión actual del archivo, la
+    respuesta es inmutable; si no, el navegador revalida en cada uso.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        version = file_version(stat_result.st_size, stat_result.st_mtime_ns)
+        requested = QueryParams(scope.get("query_string", b"")).get("v")
+        return cached_file_response(
+            request_headers,
+            full_path,
+            stat_result=stat_result,
+            cache_control=IMMUTABLE if requested == version else REVALIDATE,
+            status_code=status_code,
+        )
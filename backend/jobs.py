@@ -0,0 +1,210 @@
+"""Trabajos asíncronos de render.
+
+POST /jobs devuelve un id al instante y el render corre en segundo plano, así
+el cliente no mantiene la conexión abierta durante todo el proceso (detrás de
+proxies con keep-alive corto los GIFs largos se cortaban). Los trabajos corren
+con concurrencia acotada y sus registros expiran después de JOB_TTL_SECONDS.
+"""
+import asyncio
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("JOB_MAX_CONCURRENCY", "4"))
+DEFAULT_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "200"))
+DEFAULT_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    """Hay demasiados trabajos pendientes"""
+
+
+@dataclass
+class Job:
+    id: str
+    created_at: float
+    expires_at: float
+    status: str = QUEUED
+    progress: float = 0.0
+    started_at: float = None
+    finished_at: float = None
+    result: dict = None
+    error: str = None
+    error_status: int = None
+    _done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    async def wait(self):
+        await self._done.wait()
+        return self
+
+    def to_public(self):
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": round(self.progress, 2),
+            "created_at": self.created_at,
+            "expires_at": self.expires_at,
+        }
+        if self.started_at:
+            data["queue_ms"] = round((self.started_at - self.created_at) * 1000, 2)
+        if self.finished_at and self.started_at:
+            data["run_ms"] = round((self.finished_at - self.started_at) * 1000, 2)
+        if self.status == DONE:
+            data.update(self.result or {})
+        if self.status == FAILED:
+            data["error"] = self.error
+        return data
+
+
+class JobManager:
+    """Registro de trabajos en memoria con concurrencia acotada y expiración"""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_queued=DEFAULT_MAX_QUEUED, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.ttl_seconds = ttl_seconds
+        self._jobs = {}
+        self._active_by_key = {}
+        self._tasks = set()
+        self._semaphore = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.coalesced = 0
+
+    def _sem(self):
+        # Se crea dentro del event loop que lo va a usar
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def active(self, key):
+        """Trabajo en curso con la misma clave de resultado, si lo hay"""
+        job = self._active_by_key.get(key)
+        if job is not None:
+            self.coalesced += 1
+        return job
+
+    def busy(self, key):
+        """Si hay un trabajo en curso con esa clave (sin contarlo como coalescido)"""
+        return key in self._active_by_key
+
+    def submit(self, work, on_finish=None, key=None):
+        """Encolar ``work(job)``, una corrutina que devuelve el dict de resultado
+
+        ``on_finish`` (opcional) se llama al terminar, haya salido bien o no;
+        sirve para limpiar archivos temporales del trabajo. Si se pasa ``key``
+        y ya hay un trabajo en curso con esa clave, se devuelve ese mismo en
+        lugar de renderizar dos veces.
+        """
+        if key is not None:
+            job = self.active(key)
+            if job is not None:
+                return job
+        self.prune()
+        pending = sum(1 for job in self._jobs.values() if not job.finished)
+        if pending >= self.max_queued:
+            raise QueueFullError("Hay demasiados trabajos en cola, intenta más tarde")
+
+        now = time.time()
+        job = Job(id=uuid.uuid4().hex, created_at=now, expires_at=now + self.ttl_seconds)
+        self._jobs[job.id] = job
+        self.submitted += 1
+        if key is not None:
+            self._active_by_key[key] = job
+
+        task = asyncio.create_task(self._run(job, work, on_finish, key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def finished_job(self, result):
+        """Registrar un trabajo que ya está resuelto (p. ej. acierto de caché)"""
+        self.prune()
+        now = time.time()
+        job = Job(
+            id=uuid.uuid4().hex,
+            created_at=now,
+            expires_at=now + self.ttl_seconds,
+            status=DONE,
+            progress=1.0,
+            started_at=now,
+            finished_at=now,
+            result=result,
+        )
+        job._done.set()
+        self._jobs[job.id] = job
+        return job
+
+    async def _run(self, job, work, on_finish, key=None):
+        try:
+            async with self._sem():
+                job.status = RUNNING
+                job.started_at = time.time()
+                job.progress = 0.1
+                job.result = await work(job)
+                job.status = DONE
+                job.progress = 1.0
+                self.completed += 1
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(getattr(e, "detail", None) or e)
+            job.error_status = getattr(e, "status_code", 500)
+            self.failed += 1
+        finally:
+            job.finished_at = time.time()
+            if key is not None:
+                self._active_by_key.pop(key, None)
+            # El registro vive TTL segundos desde que terminó
+            job.expires_at = job.finished_at + self.ttl_seconds
+            if on_finish is not None:
+                try:
+                    on_finish()
+                except Exception as e:
+                    print(f"Error limpiando el trabajo {job.id}: {e}")
+            job._done.set()
+
+    def get(self, job_id):
+        self.prune()
+        return self._jobs.get(job_id)
+
+    def prune(self):
+        """Eliminar los trabajos terminados cuyo registro ya expiró"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job.expires_at <= now
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.expired += len(expired)
+
+    def stats(self):
+        statuses = [job.status for job in self._jobs.values()]
+        return {
+            "queued": statuses.count(QUEUED),
+            "running": statuses.count(RUNNING),
+            "tracked": len(statuses),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "coalesced": self.coalesced,
+            "max_concurrency": self.max_concurrency,
+        }
+
+
+# Instancia compartida por la app
+job_manager = JobManager()
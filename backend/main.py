@@ -1,13 +1,45 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import itertools
+import threading
 import os
-import uuid
+import json
 from pathlib import Path
-import shutil
-import math
-from PIL import Image, ImageDraw
+from collections import Counter
+import time
+import re
+from PIL import UnidentifiedImageError
+
+from compositor import (
+    DEFAULT_OUTPUT_FORMAT, DEFAULT_QUALITY, OUTPUT_FORMATS, QUALITY_TIERS, StageTimer, available_formats,
+    decode_template, default_face_box, iter_swap, normalize_face, preprocess_face
+)
+from template_cache import template_cache
+from template_index import TemplateIndex, read_template_entry
+from face_annotations import (
+    annotation_path, load_face_track, parse_face_annotations, write_face_track
+)
+from face_detector import ensure_face_annotations
+from worker_pool import JobTimeoutError, render_to_file, swap_pool
+from jobs import FAILED, QueueFullError, job_manager
+from result_cache import ResultCache, face_digest, persist_stream, result_key, template_render_version
+from output_retention import OutputRetention
+from http_cache import (
+    IMMUTABLE, REVALIDATE, CachedStaticFiles, cached_file_response, etag_matches, negotiate_media_type
+)
+from thumbnails import PREVIEW, STATIC, ThumbnailStore
+from face_store import face_id_for, face_store
+from readiness import Readiness
+from profiling import ProfileStore, ProfiledIterator, REQUESTED, is_admin, profile_reason, profiled_call
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, observe_stages, registry
+from scenes import VARIANT_ID, SceneError, SceneLibrary, normalize_params, render_scene_frame
+from uploads import (
+    MAX_FACE_BYTES, MAX_TEMPLATE_BYTES, MULTIPART_OVERHEAD, UploadLimitMiddleware,
+    UploadRejected, read_limited, read_small, spool_to_disk
+)
 
 # ✅ PRIMERO definir la app, LUEGO los endpoints
 app = FastAPI(title="GIF Face Swap API", version="1.0.0")
@@ -21,235 +53,195 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cortar las subidas demasiado grandes antes de parsear el multipart
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={
+        "/simple-swap": MAX_FACE_BYTES + MULTIPART_OVERHEAD,
+        "/jobs": MAX_FACE_BYTES + MULTIPART_OVERHEAD,
+        "/stream-swap": MAX_FACE_BYTES + MULTIPART_OVERHEAD,
+        "/batch-swap": MAX_FACE_BYTES + MULTIPART_OVERHEAD,
+        "/faces": MAX_FACE_BYTES + MULTIPART_OVERHEAD,
+        "/upload-template": MAX_TEMPLATE_BYTES + 2 * MULTIPART_OVERHEAD,
+    }
+)
+
+# Peticiones y latencia por ruta para /metrics (el más externo: ve también los 413)
+app.add_middleware(MetricsMiddleware)
+
 # Configurar directorios (compatible con Windows)
 BASE_DIR = Path(__file__).parent
 UPLOAD_DIR = BASE_DIR / "uploads"
 OUTPUT_DIR = BASE_DIR / "outputs" 
 TEMPLATES_DIR = BASE_DIR / "templates"
+DERIVED_DIR = BASE_DIR / "derived"
 
 # Crear directorios si no existen
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 TEMPLATES_DIR.mkdir(exist_ok=True)
+DERIVED_DIR.mkdir(exist_ok=True)
+
+# Escenas declarativas (template_scenes/*.json) y sus variantes renderizadas a pedido
+scene_library = SceneLibrary(BASE_DIR / "template_scenes", DERIVED_DIR / "scenes")
+scene_library.load()
+DEFAULT_SCENES = ["soccer_celebration", "dancer", "singer"]
+SIMPLE_DEMO_SCENES = ["demo_colors", "demo_moving"]
+
+# Catálogo de templates (se construye al arrancar)
+DEMO_CATEGORIES = {scene["id"]: scene["category"] for scene in scene_library.describe()}
+template_index = TemplateIndex(
+    TEMPLATES_DIR,
+    DERIVED_DIR / "template_index.json",
+    default_categories=DEMO_CATEGORIES
+)
+
+# Miniaturas del catálogo, una por versión de template
+thumbnail_store = ThumbnailStore(DERIVED_DIR / "thumbnails")
+
+# Resultados direccionados por contenido (hash de cara + template + parámetros)
+result_cache = ResultCache(OUTPUT_DIR)
+
+# Perfiles de cProfile pedidos por un admin o por muestreo (ver profiling.py)
+profile_store = ProfileStore(DERIVED_DIR / "profiles")
+
+# Límite de espacio y antigüedad para OUTPUT_DIR (barrido en segundo plano)
+output_retention = OutputRetention(OUTPUT_DIR)
+
+# Nombre de los resultados direccionados por contenido (ver result_cache.py)
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]+$")
+
+# Media type de cada extensión de salida, para /download
+MEDIA_TYPES = {spec["extension"]: spec["media_type"] for spec in OUTPUT_FORMATS.values()}
+
+# Máximo de templates por petición a /batch-swap
+BATCH_MAX_TEMPLATES = 50
+
+# Cuántos tamaños de caja distintos precalcular para cada cara de /faces
+FACE_PREP_MAX_SIZES = 8
+
+# Cuántos templates precargar en cada worker del pool al arrancar
+WARM_TEMPLATE_LIMIT = 20
+
+# Arranque: vivo desde el principio, listo cuando termina el precalentamiento
+readiness = Readiness()
+prewarm_task = None
+
+# Un solo render de las demos a la vez (arranque y /create-demos)
+template_build_lock = threading.Lock()
 
 # Montar directorio estático para templates
-app.mount("/templates", StaticFiles(directory=TEMPLATES_DIR), name="templates")
+# (con ETag, 304 y Range; inmutable si se pide con ?v=<versión>)
+app.mount("/templates", CachedStaticFiles(directory=TEMPLATES_DIR), name="templates")
 
 # ========== FUNCIONES AUXILIARES ==========
-def create_soccer_celebration():
-    """Crear GIF de celebración de futbol"""
+def create_scene_template(scene_id):
+    """Renderizar una escena con sus parámetros por defecto como template del catálogo"""
     try:
-        frames = []
-        size = (200, 200)
-        
-        # Crear 4 frames de animación
-        for i in range(4):
-            img = Image.new('RGB', size, 'green')  # Campo de futbol verde
-            draw = ImageDraw.Draw(img)
-            
-            # Dibujar líneas del campo
-            draw.rectangle([10, 10, 190, 190], outline='white', width=2)
-            draw.line([100, 10, 100, 190], fill='white', width=2)
-            draw.ellipse([80, 80, 120, 120], outline='white', width=2)
-            
-            # Figura animada (personaje)
-            body_color = 'blue' if i % 2 == 0 else 'darkblue'
-            
-            # Cabeza
-            head_y = 70 + (i * 5)  # Movimiento vertical
-            draw.ellipse([90, head_y, 110, head_y+20], fill='beige', outline='black')
-            
-            # Brazos (movimiento de celebración)
-            arm_angle = i * 20
-            draw.line([95, 90, 85 - arm_angle//10, 70], fill=body_color, width=3)
-            draw.line([105, 90, 115 + arm_angle//10, 70], fill=body_color, width=3)
-            
-            # Cuerpo
-            draw.rectangle([95, 90, 105, 130], fill=body_color)
-            
-            # Piernas
-            leg_offset = (i - 1) * 8
-            draw.line([100, 130, 90 + leg_offset, 160], fill='darkblue', width=3)
-            draw.line([100, 130, 110 - leg_offset, 160], fill='darkblue', width=3)
-            
-            # Pelota
-            ball_x = 120 + (i * 15)
-            draw.ellipse([ball_x, 140, ball_x+10, 150], fill='white')
-            
-            frames.append(img)
-        
-        # Guardar GIF
-        output_path = TEMPLATES_DIR / "soccer_celebration.gif"
-        frames[0].save(
-            output_path,
-            save_all=True,
-            append_images=frames[1:],
-            duration=200,  # ms entre frames
-            loop=0,        # loop infinito
-            optimize=True
-        )
+        scene_library.render_to(scene_id, normalize_params(scene_library.get(scene_id), {}),
+                                TEMPLATES_DIR / f"{scene_id}.gif")
         return True
     except Exception as e:
-        print(f"Error creando soccer celebration: {e}")
+        print(f"Error creando {scene_id}: {e}")
         return False
 
-def create_dancer_gif():
-    """Crear GIF de bailarín"""
+# ========== CICLO DE VIDA ==========
+
+@app.on_event("startup")
+async def build_template_index():
+    """Construir templates que falten e índice, levantar el pool y lanzar el precalentamiento"""
+    with readiness.step("templates"):
+        template_index.load()
+        # Sólo se crean las demos que no están en disco (una vez, bajo lock)
+        await run_in_threadpool(build_demo_templates, DEFAULT_SCENES)
+    print(f"Índice de templates listo: {len(template_index)} templates")
+    
+    # Levantar el pool de procesos con los templates más usados precargados
+    _, warm = template_index.query(limit=WARM_TEMPLATE_LIMIT)
+    swap_pool.start(TEMPLATES_DIR / entry.file_name for entry in warm)
+    
+    # Las miniaturas no bloquean el arranque; el resto se precalienta antes de estar listo
+    asyncio.get_running_loop().run_in_executor(None, generate_thumbnails)
+    global prewarm_task
+    prewarm_task = asyncio.create_task(prewarm([TEMPLATES_DIR / entry.file_name for entry in warm]))
+
+async def prewarm(warm_paths):
+    """Anotaciones, caché de frames y workers calientes; después la instancia está lista"""
     try:
-        frames = []
-        size = (200, 200)
-        
-        for i in range(6):
-            img = Image.new('RGB', size, 'purple')
-            draw = ImageDraw.Draw(img)
-            
-            # Cabeza
-            head_x = 100 + (i-2) * 3  # Movimiento lateral suave
-            draw.ellipse([head_x-15, 50, head_x+15, 80], fill='beige')
-            
-            # Ojos
-            draw.ellipse([head_x-8, 60, head_x-4, 64], fill='black')
-            draw.ellipse([head_x+4, 60, head_x+8, 64], fill='black')
-            
-            # Boca (sonrisa que cambia)
-            mouth_y = 72 if i % 2 == 0 else 74
-            draw.arc([head_x-6, mouth_y, head_x+6, mouth_y+4], 0, 180, fill='red', width=2)
-            
-            # Cuerpo
-            body_color = 'red' if i % 3 == 0 else 'darkred'
-            draw.rectangle([head_x-10, 80, head_x+10, 120], fill=body_color)
-            
-            # Brazos de bailarín
-            arm_angle = i * 30
-            arm1_x = 80 + int(20 * math.sin(math.radians(arm_angle)))
-            arm2_x = 120 - int(20 * math.sin(math.radians(arm_angle)))
-            
-            draw.line([head_x-10, 90, arm1_x, 70], fill=body_color, width=4)
-            draw.line([head_x+10, 90, arm2_x, 70], fill=body_color, width=4)
-            
-            # Piernas bailando
-            leg_offset = int(15 * math.sin(math.radians(arm_angle * 2)))
-            draw.line([head_x-5, 120, head_x-15, 150 + leg_offset], fill='blue', width=4)
-            draw.line([head_x+5, 120, head_x+15, 150 - leg_offset], fill='blue', width=4)
-            
-            frames.append(img)
-        
-        output_path = TEMPLATES_DIR / "dancer.gif"
-        frames[0].save(
-            output_path,
-            save_all=True,
-            append_images=frames[1:],
-            duration=150,
-            loop=0,
-            optimize=True
-        )
-        return True
+        with readiness.step("annotations"):
+            await run_in_threadpool(annotate_templates)
+        with readiness.step("frame_cache") as step:
+            step["templates"] = await run_in_threadpool(warm_template_cache, warm_paths)
+        with readiness.step("workers") as step:
+            step["workers"] = await swap_pool.warm()
     except Exception as e:
-        print(f"Error creando dancer: {e}")
-        return False
+        readiness.mark_failed(e)
+        return
+    readiness.mark_ready()
 
-def create_singer_gif():
-    """Crear GIF de cantante"""
-    try:
-        frames = []
-        size = (200, 200)
-        
-        for i in range(5):
-            img = Image.new('RGB', size, 'darkblue')
-            draw = ImageDraw.Draw(img)
-            
-            # Micrófono
-            draw.ellipse([140, 60, 160, 80], fill='gray')
-            draw.line([150, 80, 150, 120], fill='gray', width=3)
-            
-            # Cabeza del cantante
-            draw.ellipse([80, 50, 120, 90], fill='beige')
-            
-            # Boca cantando (abre y cierra)
-            mouth_open = i % 2 == 0
-            if mouth_open:
-                # Boca abierta (cantando)
-                draw.ellipse([95, 75, 105, 85], fill='red')
+@app.on_event("startup")
+async def start_output_retention():
+    """Registrar los resultados existentes y lanzar el barrido periódico"""
+    output_retention.start()
+
+@app.on_event("shutdown")
+async def stop_swap_pool():
+    if prewarm_task is not None:
+        prewarm_task.cancel()
+    swap_pool.shutdown()
+
+@app.on_event("shutdown")
+async def stop_output_retention():
+    await output_retention.stop()
+
+def build_demo_templates(scene_ids, force=False):
+    """Crear los templates de demostración que falten (o todos con ``force``)
+
+    Corre bajo un lock: peticiones simultáneas no renderizan dos veces lo
+    mismo. Devuelve (todo bien, ids creados).
+    """
+    with template_build_lock:
+        created = []
+        ok = True
+        for scene_id in scene_ids:
+            if not force and (TEMPLATES_DIR / f"{scene_id}.gif").exists():
+                continue
+            if create_scene_template(scene_id):
+                created.append(scene_id)
             else:
-                # Boca cerrada
-                draw.line([95, 80, 105, 80], fill='red', width=2)
-            
-            # Ojos
-            draw.ellipse([88, 60, 92, 64], fill='black')
-            draw.ellipse([108, 60, 112, 64], fill='black')
-            
-            # Cuerpo
-            draw.rectangle([85, 90, 115, 130], fill='gold')
-            
-            # Brazos
-            arm_move = i * 5
-            draw.line([85, 100, 65 - arm_move, 110], fill='gold', width=4)
-            draw.line([115, 100, 135 + arm_move, 90], fill='gold', width=4)
-            
-            # Notas musicales que aparecen
-            if i >= 2:
-                for note_i in range(i-1):
-                    note_x = 50 + note_i * 20
-                    draw.ellipse([note_x, 40, note_x+8, 48], fill='white')
-                    draw.line([note_x+8, 44, note_x+15, 35], fill='white', width=2)
-            
-            frames.append(img)
-        
-        output_path = TEMPLATES_DIR / "singer.gif"
-        frames[0].save(
-            output_path,
-            save_all=True,
-            append_images=frames[1:],
-            duration=300,
-            loop=0,
-            optimize=True
-        )
-        return True
-    except Exception as e:
-        print(f"Error creando singer: {e}")
-        return False
+                ok = False
+        if created:
+            template_index.refresh()
+        return ok, created
 
-def create_simple_demo_gifs():
-    """Crear GIFs simples de demostración"""
-    try:
-        # GIF 1: Colores cambiantes
-        frames1 = []
-        colors = ['red', 'green', 'blue', 'yellow', 'purple', 'orange']
-        for color in colors:
-            img = Image.new('RGB', (150, 150), color)
-            frames1.append(img)
-        
-        demo1_path = TEMPLATES_DIR / "demo_colors.gif"
-        frames1[0].save(
-            demo1_path,
-            save_all=True,
-            append_images=frames1[1:],
-            duration=300,
-            loop=0
-        )
-        
-        # GIF 2: Círculo moviéndose
-        frames2 = []
-        for i in range(8):
-            img = Image.new('RGB', (150, 150), 'white')
-            draw = ImageDraw.Draw(img)
-            x = 30 + (i * 15)
-            draw.ellipse([x, 60, x+30, 90], fill='blue')
-            frames2.append(img)
-        
-        demo2_path = TEMPLATES_DIR / "demo_moving.gif"
-        frames2[0].save(
-            demo2_path,
-            save_all=True,
-            append_images=frames2[1:],
-            duration=200,
-            loop=0
-        )
-        
-        return True
-    except Exception as e:
-        print(f"Error creando demos simples: {e}")
-        return False
+def warm_template_cache(paths):
+    """Decodificar los templates más usados en el caché de este proceso"""
+    warmed = 0
+    for path in paths:
+        try:
+            template_cache.get(path)
+            warmed += 1
+        except Exception as e:
+            print(f"No se pudo precargar {path}: {e}")
+    return warmed
+
+def annotate_templates():
+    """Generar anotaciones (una vez por versión) para todo el catálogo"""
+    _, entries = template_index.query()
+    for entry in entries:
+        try:
+            ensure_face_annotations(TEMPLATES_DIR / entry.file_name, template_cache)
+        except Exception as e:
+            print(f"Error detectando cara en {entry.file_name}: {e}")
+
+def generate_thumbnails():
+    """Generar las miniaturas que falten para la versión actual de cada template"""
+    _, entries = template_index.query()
+    for entry in entries:
+        try:
+            thumbnail_store.ensure_all(TEMPLATES_DIR / entry.file_name, entry.version)
+        except Exception as e:
+            print(f"Error generando miniaturas de {entry.file_name}: {e}")
 
 # ========== ENDPOINTS ==========
 
@@ -259,166 +251,918 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "version": "1.0.0"}
+    """Estado completo: arranque, cachés, pool y colas"""
+    return {
+        "status": "healthy" if readiness.ready else readiness.state,
+        "version": "1.0.0",
+        "readiness": readiness.stats(),
+        "template_cache": template_cache.stats(),
+        "swap_pool": swap_pool.stats(),
+        "jobs": job_manager.stats(),
+        "result_cache": result_cache.stats(),
+        "outputs": output_retention.stats(),
+        "faces": face_store.stats(),
+        "profiling": profile_store.stats()
+    }
+
+@app.get("/health/live")
+async def health_live():
+    """El proceso responde (no dice nada de los cachés)"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def health_ready(response: Response):
+    """200 sólo cuando templates, índice y cachés están precalentados"""
+    if not readiness.ready:
+        response.status_code = 503
+    return {
+        **readiness.stats(),
+        "templates": len(template_index),
+        "template_cache": {key: value for key, value in template_cache.stats().items()
+                           if key in ("entries", "bytes_in_use")},
+        "warmed_workers": swap_pool.warmed_workers,
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return Response(registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+@registry.collector
+def collect_metrics():
+    """Estado de cachés, pool, trabajos y OUTPUT_DIR, leído al exportar"""
+    caches = {
+        "template": template_cache.stats(),
+        "result": result_cache.stats(),
+        "face": face_store.stats(),
+    }
+    pool = swap_pool.stats()
+    jobs = job_manager.stats()
+    outputs = output_retention.stats()
+    # El caché de templates es el del proceso principal: en modo procesos
+    # los renders usan el de cada worker, que no se ve desde acá
+    labels = {name: (("cache", name),) for name in caches}
+    labels["template"] += (("process", "main"),)
+    return [
+        ("gifswap_cache_hits_total", "counter",
+         "Aciertos por caché (el de templates sólo cuenta el proceso principal)",
+         {labels[name]: stats["hits"] for name, stats in caches.items()}),
+        ("gifswap_cache_misses_total", "counter", "Fallos por caché",
+         {labels[name]: stats["misses"] for name, stats in caches.items()}),
+        ("gifswap_cache_hit_ratio", "gauge", "Proporción de aciertos desde el arranque",
+         {labels[name]: stats["hit_ratio"] for name, stats in caches.items()}),
+        ("gifswap_template_cache_bytes", "gauge", "Bytes de frames decodificados en el proceso principal",
+         {labels["template"][1:]: caches["template"]["bytes_in_use"]}),
+        ("gifswap_pool_workers", "gauge", "Workers del pool de procesos (0 en modo threads)", pool["workers"]),
+        ("gifswap_pool_in_flight", "gauge", "Trabajos enviados al pool y no terminados", pool["in_flight"]),
+        ("gifswap_pool_queue_depth", "gauge", "Trabajos esperando un worker libre", pool["queue_depth"]),
+        ("gifswap_pool_jobs_total", "counter", "Trabajos del pool por resultado",
+         {(("result", key),): pool[key] for key in ("completed", "failed", "timeouts")}),
+        ("gifswap_pool_restarts_total", "counter", "Veces que se recreó el pool", pool["restarts"]),
+        ("gifswap_jobs", "gauge", "Trabajos de swap por estado",
+         {(("status", key),): jobs[key] for key in ("queued", "running")}),
+        ("gifswap_jobs_coalesced_total", "counter", "Peticiones que reutilizaron un render en curso",
+         jobs["coalesced"]),
+        ("gifswap_output_bytes", "gauge", "Bytes ocupados en OUTPUT_DIR", outputs["bytes_in_use"]),
+        ("gifswap_output_files", "gauge", "Archivos en OUTPUT_DIR", outputs["files"]),
+        ("gifswap_output_evictions_total", "counter", "Resultados borrados por retención",
+         outputs["evictions"] + outputs["expirations"]),
+        ("gifswap_ready", "gauge", "1 si terminó el precalentamiento", int(readiness.ready)),
+    ]
 
 @app.get("/gif-templates")
-async def get_gif_templates():
-    """Obtener lista de GIF templates disponibles"""
-    
-    templates = []
-    
-    # Buscar archivos GIF en el directorio de templates
-    for file in TEMPLATES_DIR.glob("*.gif"):
-        template_data = {
-            "id": file.stem,
-            "name": file.stem.replace("_", " ").title(),
-            "thumbnail": f"/templates/{file.name}",
-            "gif_path": f"/templates/{file.name}",
-            "category": "general"
-        }
-        templates.append(template_data)
-    
-    # Si no hay templates, crearlos automáticamente
-    if not templates:
-        print("No hay templates, creando demos automáticamente...")
-        create_soccer_celebration()
-        create_dancer_gif()
-        create_singer_gif()
-        
-        # Buscar nuevamente
-        for file in TEMPLATES_DIR.glob("*.gif"):
-            template_data = {
-                "id": file.stem,
-                "name": file.stem.replace("_", " ").title(),
-                "thumbnail": f"/templates/{file.name}",
-                "gif_path": f"/templates/{file.name}",
-                "category": "general"
-            }
-            templates.append(template_data)
-    
-    return templates
+async def get_gif_templates(
+    request: Request,
+    response: Response,
+    offset: int = 0,
+    limit: int = 100,
+    category: str = None,
+    q: str = None
+):
+    """Obtener lista de GIF templates disponibles (paginada, desde el índice)"""
+    
+    template_index.refresh_if_stale()
+    
+    offset = max(0, offset)
+    limit = min(max(1, limit), 500)
+    
+    etag = template_index.query_etag(offset, limit, category, q)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REVALIDATE})
+    
+    total, page = template_index.query(category=category, prefix=q, offset=offset, limit=limit)
+    response.headers["ETag"] = etag
+    response.headers["X-Total-Count"] = str(total)
+    response.headers["Cache-Control"] = REVALIDATE
+    
+    return [entry.to_public() for entry in page]
 
-@app.get("/create-demos")
-async def create_demos_get():
-    """Endpoint GET para crear demos (fácil desde navegador)"""
+@app.get("/gif-templates/categories")
+async def get_template_categories():
+    """Categorías presentes en el catálogo"""
+    template_index.refresh_if_stale()
+    return template_index.categories()
+
+async def create_demos(force):
+    """Crear las demos (las que falten, o todas con ``force``) y describir el resultado"""
     try:
-        # Crear los GIFs
-        soccer_success = create_soccer_celebration()
-        dancer_success = create_dancer_gif() 
-        singer_success = create_singer_gif()
+        # Crear los GIFs (fuera del event loop)
+        demos_success, created = await run_in_threadpool(build_demo_templates, DEFAULT_SCENES, force)
+        scene_ids = DEFAULT_SCENES
         
-        if soccer_success and dancer_success and singer_success:
-            return {
-                "success": True,
-                "message": "GIFs de demostración creados exitosamente",
-                "templates": [
-                    {"id": "soccer_celebration", "name": "Celebración de Futbol"},
-                    {"id": "dancer", "name": "Bailarín"},
-                    {"id": "singer", "name": "Cantante"}
-                ]
-            }
-        else:
+        if not demos_success:
             # Si fallan los GIFs complejos, crear simples
-            simple_success = create_simple_demo_gifs()
-            if simple_success:
-                return {
-                    "success": True,
-                    "message": "GIFs simples creados exitosamente",
-                    "templates": [
-                        {"id": "demo_colors", "name": "Colores Cambiantes"},
-                        {"id": "demo_moving", "name": "Círculo en Movimiento"}
-                    ]
-                }
-            else:
+            simple_success, created = await run_in_threadpool(build_demo_templates, SIMPLE_DEMO_SCENES, force)
+            if not simple_success:
                 return {"success": False, "error": "No se pudieron crear los GIFs"}
+            scene_ids = SIMPLE_DEMO_SCENES
+        
+        return {
+            "success": True,
+            "message": "GIFs de demostración creados exitosamente" if created else "Los GIFs de demostración ya existían",
+            "created": created,
+            "templates": [{"id": scene_id, "name": scene_library.get(scene_id)["name"]} for scene_id in scene_ids]
+        }
     
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@app.get("/create-demos")
+async def create_demos_get():
+    """Endpoint GET para crear demos (fácil desde navegador); sólo crea las que falten"""
+    return await create_demos(force=False)
+
 @app.post("/create-demo-gifs")
-async def create_demo_gifs():
-    """Endpoint POST para crear demos"""
-    return await create_demos_get()
+async def create_demo_gifs(force: bool = False):
+    """Endpoint POST para crear demos; con ``force`` las vuelve a renderizar"""
+    return await create_demos(force)
 
 @app.post("/upload-template")
-async def upload_template(file: UploadFile = File(...)):
-    """Endpoint para subir nuevos GIF templates (admin)"""
+async def upload_template(
+    file: UploadFile = File(...),
+    category: str = Form(None),
+    annotations: UploadFile = File(None)
+):
+    """Endpoint para subir nuevos GIF templates (admin)
+
+    Opcionalmente acepta un JSON de anotaciones de cara por frame (ver
+    face_annotations.py) que se guarda como sidecar junto al GIF.
+    """
     
-    if not file.filename.lower().endswith('.gif'):
+    # Sólo el nombre, nunca rutas que vengan del cliente
+    filename = Path(file.filename or "").name
+    if not filename.lower().endswith('.gif'):
         raise HTTPException(400, "Solo se permiten archivos GIF")
     
-    # Guardar el template
-    file_path = TEMPLATES_DIR / file.filename
+    annotations_data = None
+    if annotations is not None:
+        try:
+            annotations_data = json.loads(await read_small(annotations))
+        except UploadRejected as e:
+            raise HTTPException(e.status_code, e.detail)
+        except ValueError:
+            raise HTTPException(400, "Las anotaciones deben ser un JSON válido")
+    
+    track = None
     
-    with open(file_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
+    def check_template(tmp_path):
+        # Decodificar el temporal completo y validar las anotaciones contra
+        # él: si algo falla, el template actual y su sidecar quedan intactos
+        nonlocal track
+        try:
+            candidate = read_template_entry(tmp_path)
+            decode_template(tmp_path)
+        except Exception:
+            raise UploadRejected(400, "El archivo no es un GIF válido")
+        if annotations_data is not None:
+            try:
+                track = parse_face_annotations(
+                    annotations_data,
+                    frame_count=candidate.frame_count,
+                    size=(candidate.width, candidate.height)
+                )
+            except ValueError as e:
+                raise UploadRejected(400, f"Anotaciones inválidas: {e}")
     
-    return {"message": f"Template {file.filename} subido exitosamente"}
+    # Guardar el template: por bloques a un temporal y rename atómico
+    file_path = TEMPLATES_DIR / filename
+    try:
+        await spool_to_disk(file, file_path, UPLOAD_DIR, validate=check_template)
+    except UploadRejected as e:
+        raise HTTPException(e.status_code, e.detail)
+    
+    # Liberar la versión anterior si estaba en caché y actualizar el catálogo
+    template_cache.invalidate(file_path)
+    entry = await run_in_threadpool(template_index.update, file_path, category)
+    
+    # Anotaciones de cara: las del usuario, o descartar las de la versión anterior
+    if track is not None:
+        write_face_track(file_path, track)
+    else:
+        # Sin anotaciones: detectar la cara ahora, una sola vez por versión
+        annotation_path(file_path).unlink(missing_ok=True)
+        track = await run_in_threadpool(ensure_face_annotations, file_path, template_cache)
+    
+    await run_in_threadpool(thumbnail_store.ensure_all, file_path, entry.version)
+    
+    return {
+        "message": f"Template {filename} subido exitosamente",
+        "template": entry.to_public(),
+        "face_annotations": track.source if track else None
+    }
 
-@app.post("/simple-swap")
-async def simple_face_swap(
-    user_face: UploadFile = File(...),
-    gif_template: str = Form(...)
-):
-    """Versión simple del cambio de cara - procesamiento básico"""
+async def serve_thumbnail(template_id: str, kind: str, request: Request):
+    entry = template_index.get(template_id)
+    if entry is None:
+        raise HTTPException(404, "Template no encontrado")
+    try:
+        path = await run_in_threadpool(
+            thumbnail_store.ensure, TEMPLATES_DIR / entry.file_name, entry.version, kind
+        )
+    except Exception as e:
+        print(f"Error generando miniatura de {entry.file_name}: {e}")
+        raise HTTPException(500, "No se pudo generar la miniatura")
     
-    # Validar que sea una imagen
+    # Inmutable si se pide la versión actual (como la URL que da el catálogo)
+    current = request.query_params.get("v") == entry.version
+    return cached_file_response(
+        request.headers,
+        path,
+        etag=f'"{entry.version}-{kind}"',
+        cache_control=IMMUTABLE if current else REVALIDATE
+    )
+
+@app.get("/thumbnails/{template_id}")
+async def get_thumbnail(template_id: str, request: Request):
+    """Miniatura estática (primer frame) de un template"""
+    return await serve_thumbnail(template_id, STATIC, request)
+
+@app.get("/thumbnails/{template_id}/preview")
+async def get_thumbnail_preview(template_id: str, request: Request):
+    """Vista previa animada corta y de baja resolución de un template"""
+    return await serve_thumbnail(template_id, PREVIEW, request)
+
+# ========== CARAS ==========
+
+def catalog_face_sizes():
+    """Tamaños de caja de cara más usados por los templates del catálogo"""
+    counts = Counter()
+    _, entries = template_index.query(limit=WARM_TEMPLATE_LIMIT)
+    for entry in entries:
+        track = load_face_track(TEMPLATES_DIR / entry.file_name)
+        if track is not None:
+            boxes = track.scaled_to((entry.width, entry.height)).boxes
+            sizes = {(int(w), int(h)) for w, h in boxes[:, 2:4]}
+        else:
+            sizes = {default_face_box(entry.width, entry.height)[2:]}
+        counts.update(sizes)
+    return [size for size, _ in counts.most_common(FACE_PREP_MAX_SIZES)]
+
+@app.post("/faces", status_code=201)
+async def upload_face(user_face: UploadFile = File(...)):
+    """Subir y preprocesar una cara una sola vez; devuelve un face_id reutilizable
+
+    Los swaps aceptan ese ``face_id`` en lugar de ``user_face``. El id vence
+    si no se usa durante un tiempo (ver face_store.py).
+    """
     if not user_face.content_type.startswith('image/'):
         raise HTTPException(400, "El archivo debe ser una imagen")
+    try:
+        content = await read_limited(user_face)
+    except UploadRejected as e:
+        raise HTTPException(e.status_code, e.detail)
+    
+    face_hash = face_digest(content)
+    stored = face_store.get(face_id_for(face_hash))
+    if stored is None:
+        try:
+            sizes = await run_in_threadpool(catalog_face_sizes)
+            prepared = await run_in_threadpool(preprocess_face, content, sizes)
+        except UnidentifiedImageError:
+            raise HTTPException(400, "No se pudo leer la imagen")
+        stored = face_store.put(face_hash, prepared)
     
-    # Generar ID único para este proceso
-    file_id = str(uuid.uuid4())
-    user_face_path = UPLOAD_DIR / f"{file_id}_face.jpg"
-    output_gif_path = OUTPUT_DIR / f"{file_id}_result.gif"
+    height, width = stored.prepared.image.shape[:2]
+    return {
+        "face_id": stored.face_id,
+        "expires_at": stored.expires_at,
+        "ttl_seconds": face_store.ttl_seconds,
+        "width": width,
+        "height": height,
+        "prepared_sizes": [list(size) for size in stored.prepared.fits]
+    }
+
+# ========== ESCENAS ==========
+
+# Variantes en curso: una segunda petición igual espera a la primera.
+# Cada entrada es [lock, peticiones que lo usan] y se borra con la última
+scene_render_locks = {}
+
+async def render_scene_variant(scene_id, params):
+    """Ruta e id de una variante, renderizándola (frames en paralelo en el pool) si no está en disco"""
+    variant_id = scene_library.variant_id(scene_id, params)
+    path = scene_library.lookup(variant_id)
+    if path is not None:
+        return variant_id, path
+    
+    entry = scene_render_locks.setdefault(variant_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            path = scene_library.lookup(variant_id)
+            if path is not None:
+                return variant_id, path
+            scene = scene_library.get(scene_id)
+            # Cada frame es independiente: se reparten entre los workers
+            results = await asyncio.gather(*(
+                swap_pool.run(render_scene_frame, scene, params, frame)
+                for frame in range(scene["frames"])
+            ))
+            frames = [frame for frame, _ in results]
+            face_boxes = [box for _, box in results]
+            path = await run_in_threadpool(scene_library.store, variant_id, params, frames, face_boxes)
+            return variant_id, path
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del scene_render_locks[variant_id]
+
+@app.get("/scenes")
+async def get_scenes():
+    """Escenas disponibles y los parámetros (colores) que acepta cada una"""
+    return scene_library.describe()
+
+@app.get("/scenes/{scene_id}/render")
+async def render_scene_endpoint(scene_id: str, request: Request):
+    """GIF de una escena con otro tamaño o colores, renderizado la primera vez y cacheado
+
+    Los parámetros van en la query: ``size`` ("320" o "320x240") y los colores
+    de la escena. El id de la variante (header X-Template-Id) sirve como
+    ``gif_template`` en los swaps.
+    """
+    try:
+        scene = scene_library.get(scene_id)
+    except KeyError:
+        raise HTTPException(404, "Escena no encontrada")
+    try:
+        params = normalize_params(scene, dict(request.query_params))
+    except SceneError as e:
+        raise HTTPException(400, str(e))
     
     try:
-        # Guardar imagen del usuario
-        with open(user_face_path, "wb") as buffer:
-            content = await user_face.read()
-            buffer.write(content)
+        variant_id, path = await render_scene_variant(scene_id, params)
+    except JobTimeoutError as e:
+        raise HTTPException(504, str(e))
+    
+    # La clave cambia con la escena y los parámetros: el contenido no cambia nunca
+    response = cached_file_response(
+        request.headers,
+        path,
+        etag=f'"{variant_id}"',
+        cache_control=IMMUTABLE,
+        media_type="image/gif",
+    )
+    response.headers["X-Template-Id"] = variant_id
+    return response
+
+# ========== SWAPS ==========
+
+def catalog_template_path(template_id):
+    """Ruta de un template del catálogo o de una variante de escena ya renderizada, o None"""
+    if VARIANT_ID.match(template_id):
+        return scene_library.lookup(template_id)
+    template_path = TEMPLATES_DIR / f"{template_id}.gif"
+    if template_index.get(template_id) is None or not template_path.exists():
+        return None
+    return template_path
+
+def resolve_template_path(gif_template):
+    """Ruta del template pedido, o el primero del catálogo si no existe"""
+    if VARIANT_ID.match(gif_template):
+        # Las variantes se piden antes a /scenes/{id}/render: no hay fallback
+        template_path = scene_library.lookup(gif_template)
+        if template_path is None:
+            raise HTTPException(404, "Variante no encontrada, vuelve a pedirla a /scenes")
+        return template_path
+    
+    template_path = TEMPLATES_DIR / f"{gif_template}.gif"
+    
+    if not template_path.exists():
+        # Si no existe, usar el primer GIF disponible
+        _, first = template_index.query(limit=1)
+        if first:
+            template_path = TEMPLATES_DIR / first[0].file_name
+        else:
+            raise HTTPException(404, "No hay templates GIF disponibles")
+    
+    return template_path
+
+def choose_output_format(output_format, accept):
+    """Formato pedido explícitamente o, si no, el que prefiera el header Accept"""
+    available = available_formats()
+    if output_format:
+        output_format = output_format.lower()
+        if output_format not in available:
+            raise HTTPException(400, f"Formato de salida no soportado, opciones: {', '.join(available)}")
+        return output_format
+    
+    # Por Accept sólo se elige entre los formatos con pérdida (uno por media type)
+    by_media_type = {}
+    for name in available:
+        by_media_type.setdefault(OUTPUT_FORMATS[name]["media_type"], name)
+    media_type = negotiate_media_type(accept, list(by_media_type))
+    return by_media_type.get(media_type, DEFAULT_OUTPUT_FORMAT)
+
+def choose_quality(quality):
+    """Nivel de calidad pedido (preview, standard o full); full si no se manda"""
+    if not quality:
+        return DEFAULT_QUALITY
+    quality = quality.lower()
+    if quality not in QUALITY_TIERS:
+        raise HTTPException(400, f"Calidad no soportada, opciones: {', '.join(QUALITY_TIERS)}")
+    return quality
+
+def output_params(output_format, quality=DEFAULT_QUALITY):
+    """Parámetros del render que entran en la clave del caché"""
+    params = {}
+    if output_format != DEFAULT_OUTPUT_FORMAT:
+        params["format"] = output_format
+    if quality != DEFAULT_QUALITY:
+        params["quality"] = quality
+    return params or None  # las claves de los GIF en calidad full no cambian
+
+async def render_key(template_path, face_hash, params=None):
+    """Clave del render por contenido: mismo input => mismo archivo"""
+    template_version = await run_in_threadpool(template_render_version, template_path)
+    return result_key(None, template_path.stem, template_version, params, face_hash=face_hash)
+
+async def read_swap_request(user_face: UploadFile, gif_template: str, params=None,
+                            face_id: str = None):
+    """Leer la cara subida (o tomar la de /faces)
+
+    Devuelve (timer, cara, ruta del template, clave del render, hash de la cara).
+    """
+    
+    timer = StageTimer()
+    if face_id:
+        # Cara ya subida y preprocesada con /faces
+        stored = face_store.get(face_id)
+        if stored is None:
+            raise HTTPException(404, "Cara no encontrada o expirada, súbela de nuevo a /faces")
+        face, face_hash = stored.prepared, stored.face_hash
+        template_path = resolve_template_path(gif_template)
+    else:
+        # Validar que sea una imagen
+        if user_face is None:
+            raise HTTPException(400, "Hay que mandar user_face o face_id")
+        if not user_face.content_type.startswith('image/'):
+            raise HTTPException(400, "El archivo debe ser una imagen")
         
-        # Verificar que el template existe
-        template_path = TEMPLATES_DIR / f"{gif_template}.gif"
+        template_path = resolve_template_path(gif_template)
         
-        if not template_path.exists():
-            # Si no existe, usar el primer GIF disponible
-            gif_files = list(TEMPLATES_DIR.glob("*.gif"))
-            if gif_files:
-                template_path = gif_files[0]
-            else:
-                raise HTTPException(404, "No hay templates GIF disponibles")
+        # Leer la cara a memoria (nunca pasa por disco)
+        try:
+            with timer.stage("upload_read"):
+                face = await read_limited(user_face)
+        except UploadRejected as e:
+            raise HTTPException(e.status_code, e.detail)
+        face_hash = face_digest(face)
+    
+    file_id = await render_key(template_path, face_hash, params)
+    return timer, face, template_path, file_id, face_hash
+
+async def submit_swap(user_face: UploadFile, gif_template: str,
+                      output_format: str = DEFAULT_OUTPUT_FORMAT, face_id: str = None,
+                      profile=None, quality: str = DEFAULT_QUALITY, upgrade: bool = False):
+    """Encolar el render (o reutilizar uno existente); devuelve (Job, Job de la mejora o None)
+
+    Con ``upgrade`` y una calidad reducida también se encola, detrás, el
+    render en calidad full: queda con la misma clave que si se pidiera
+    directamente, así que una petición posterior lo encuentra hecho.
+    """
+    
+    timer, content, template_path, file_id, face_hash = await read_swap_request(
+        user_face, gif_template, output_params(output_format, quality), face_id
+    )
+    job = queue_render(timer, content, template_path, file_id, output_format, profile, quality)
+    
+    upgrade_job = None
+    if upgrade and quality != DEFAULT_QUALITY:
+        full_id = await render_key(template_path, face_hash, output_params(output_format))
+        try:
+            upgrade_job = queue_render(StageTimer(), content, template_path, full_id, output_format)
+        except HTTPException as e:
+            # Sin lugar en la cola la vista previa igual sirve; la mejora se pide después
+            print(f"No se pudo encolar la mejora de {file_id}: {e.detail}")
+    return job, upgrade_job
+
+def upgrade_info(job):
+    """Datos del render en calidad full encolado detrás de una vista previa"""
+    if job is None:
+        return {}
+    return {"upgrade": {**job.to_public(), "quality": DEFAULT_QUALITY, "status_url": f"/jobs/{job.id}"}}
+
+def request_profile(request: Request, endpoint: str):
+    """Motivo para perfilar esta petición (pedido por un admin o por muestreo), o None"""
+    try:
+        reason = profile_reason(request.headers, request.query_params, profile_store.sample_rate)
+    except PermissionError as e:
+        raise HTTPException(403, str(e))
+    return (reason, endpoint) if reason else None
+
+def queue_render(timer, face, template_path, file_id, output_format=DEFAULT_OUTPUT_FORMAT,
+                 profile=None, quality=DEFAULT_QUALITY):
+    """Encolar el render de una cara ya leída (bytes o normalizada); devuelve el Job
+
+    ``profile`` es (motivo, endpoint) de request_profile: el render corre
+    bajo cProfile y el resultado trae ``profile_url``. Un perfil pedido a
+    mano renderiza aunque el resultado ya esté en caché, y no se suma a un
+    render igual en curso (que no se está perfilando): responde 409.
+    """
+    
+    spec = OUTPUT_FORMATS[output_format]
+    output_gif_path = result_cache.path_for(file_id, spec["extension"])
+    output = {"format": output_format, "media_type": spec["media_type"], "quality": quality}
+    explicit_profile = profile is not None and profile[0] == REQUESTED
+    
+    # Mismo render ya en curso: esperar ese trabajo en vez de repetirlo
+    if explicit_profile:
+        if job_manager.busy(file_id):
+            raise HTTPException(409, "Ya hay un render igual en curso; pide el perfil cuando termine")
+    else:
+        job = job_manager.active(file_id)
+        if job is not None:
+            return job
+    
+    # Ya renderizado antes: devolverlo sin trabajo
+    if not explicit_profile and result_cache.lookup(file_id, spec["extension"]):
+        output_retention.touch(output_gif_path.name)
+        return job_manager.finished_job({
+            "result_url": f"/download/{output_gif_path.name}",
+            "file_id": file_id,
+            "cached": True,
+            "output": output
+        })
+    
+    async def work(job):
+        # Componer la cara sobre todos los frames del template (en el pool)
+        render_args = (render_to_file, face, template_path, output_gif_path, output_format, quality)
+        if profile is not None:
+            profile_path = profile_store.new_path()
+            render_args = (profiled_call, str(profile_path)) + render_args
+        try:
+            timer.timings.update(await swap_pool.run(*render_args))
+        except UnidentifiedImageError:
+            raise HTTPException(400, "No se pudo leer la imagen")
+        except JobTimeoutError as e:
+            raise HTTPException(504, str(e))
+        except Exception as e:
+            raise HTTPException(500, f"Error procesando: {str(e)}")
+        output_retention.record(output_gif_path)
+        observe_stages(timer.timings)
+        output["bytes"] = output_gif_path.stat().st_size
+        output["encode_ms"] = round(timer.timings.get("encode", 0.0), 2)
         
-        # Copiar el GIF template como resultado (placeholder por ahora)
-        shutil.copy2(template_path, output_gif_path)
+        report = timer.report()
+        if report["over_budget"]:
+            print(f"Swap {file_id} excedió el presupuesto en: {report['over_budget']}")
         
-        return {
-            "success": True,
-            "message": "GIF procesado (modo demo - próximamente IA real)",
+        result = {
             "result_url": f"/download/{output_gif_path.name}",
-            "file_id": file_id
+            "file_id": file_id,
+            "cached": False,
+            "output": output,
+            "timings": report
         }
-        
+        if profile is not None:
+            result["profile_url"] = finish_profile(profile_path, profile, template_path, file_id, report)
+        return result
+    
+    try:
+        return job_manager.submit(work, key=file_id)
+    except QueueFullError as e:
+        raise HTTPException(503, str(e))
+
+def finish_profile(profile_path, profile, template_path, file_id, report):
+    """Guardar la metadata del perfil; devuelve su URL"""
+    reason, endpoint = profile
+    meta = profile_store.finish(profile_path, reason, {
+        "endpoint": endpoint,
+        "template": template_path.stem,
+        "file_id": file_id,
+        "timings_ms": report["timings_ms"],
+    })
+    return f"/profiles/{profile_path.name}" if meta else None
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    user_face: UploadFile = File(None),
+    gif_template: str = Form(...),
+    output_format: str = Form(None),
+    face_id: str = Form(None),
+    quality: str = Form(None),
+    upgrade: bool = Form(False)
+):
+    """Encolar un swap y devolver el id del trabajo sin esperar el render
+
+    La cara va como ``user_face`` o como ``face_id`` de /faces.
+    ``output_format`` (gif, webp, webp-lossless o apng) es opcional; si no
+    se manda, se elige según el header Accept. ``quality`` y ``upgrade``
+    funcionan igual que en /simple-swap.
+    """
+    output_format = choose_output_format(output_format, request.headers.get("accept"))
+    quality = choose_quality(quality)
+    profile = request_profile(request, "/jobs")
+    job, upgrade_job = await submit_swap(user_face, gif_template, output_format, face_id, profile,
+                                         quality, upgrade)
+    return {
+        **job.to_public(),
+        "status_url": f"/jobs/{job.id}",
+        **upgrade_info(upgrade_job)
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Estado, progreso y result_url de un trabajo"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Trabajo no encontrado o expirado")
+    return job.to_public()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, request: Request):
+    """Descargar el GIF de un trabajo terminado"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Trabajo no encontrado o expirado")
+    if job.status == FAILED:
+        raise HTTPException(job.error_status or 500, job.error)
+    if not job.finished:
+        raise HTTPException(409, "El trabajo todavía no terminó")
+    return await download_file(job.result["result_url"].rsplit("/", 1)[-1], request)
+
+@app.post("/simple-swap")
+async def simple_face_swap(
+    request: Request,
+    user_face: UploadFile = File(None),
+    gif_template: str = Form(...),
+    output_format: str = Form(None),
+    face_id: str = Form(None),
+    quality: str = Form(None),
+    upgrade: bool = Form(False)
+):
+    """Versión simple del cambio de cara: encola el trabajo y espera el resultado
+
+    La cara va como ``user_face`` o como ``face_id`` de /faces.
+    ``quality`` es preview (chico, pocos frames, en decenas de ms), standard
+    o full (por defecto). Con ``upgrade`` una vista previa encola además el
+    render full en segundo plano y la respuesta trae su ``status_url``; sin
+    él, el cliente puede pedir quality=full cuando lo necesite.
+    """
+    
+    output_format = choose_output_format(output_format, request.headers.get("accept"))
+    quality = choose_quality(quality)
+    profile = request_profile(request, "/simple-swap")
+    job, upgrade_job = await submit_swap(user_face, gif_template, output_format, face_id, profile,
+                                         quality, upgrade)
+    await job.wait()
+    
+    if job.status == FAILED:
+        raise HTTPException(job.error_status or 500, job.error)
+    
+    return {
+        "success": True,
+        "message": "GIF procesado exitosamente",
+        **job.result,
+        **upgrade_info(upgrade_job)
+    }
+
+def parse_template_ids(templates):
+    """Ids de templates de un campo de formulario: lista JSON o separados por coma"""
+    templates = (templates or "").strip()
+    if templates.startswith("["):
+        try:
+            ids = json.loads(templates)
+        except ValueError:
+            raise HTTPException(400, "La lista de templates no es un JSON válido")
+        if not all(isinstance(template_id, str) for template_id in ids):
+            raise HTTPException(400, "Los ids de templates deben ser texto")
+    else:
+        ids = templates.split(",")
+    ids = list(dict.fromkeys(template_id.strip() for template_id in ids if template_id.strip()))
+    if not ids:
+        raise HTTPException(400, "Hay que indicar al menos un template")
+    if len(ids) > BATCH_MAX_TEMPLATES:
+        raise HTTPException(400, f"Máximo {BATCH_MAX_TEMPLATES} templates por petición")
+    return ids
+
+@app.post("/batch-swap")
+async def batch_face_swap(
+    request: Request,
+    user_face: UploadFile = File(...),
+    templates: str = Form(...),
+    output_format: str = Form(None),
+    quality: str = Form(None)
+):
+    """Una cara en varios templates: devuelve un manifiesto NDJSON a medida que terminan
+
+    La cara se lee, se hashea y se normaliza una sola vez; los renders se
+    reparten en el pool de workers. Cada línea es el resultado de un template
+    (en orden de llegada) y la última resume el lote.
+    """
+    
+    template_ids = parse_template_ids(templates)
+    profile = request_profile(request, "/batch-swap")
+    output_format = choose_output_format(output_format, request.headers.get("accept"))
+    quality = choose_quality(quality)
+    params = output_params(output_format, quality)
+    
+    if not user_face.content_type.startswith('image/'):
+        raise HTTPException(400, "El archivo debe ser una imagen")
+    
+    timer = StageTimer()
+    try:
+        with timer.stage("upload_read"):
+            content = await read_limited(user_face)
+    except UploadRejected as e:
+        raise HTTPException(e.status_code, e.detail)
+    
+    # Decodificar y normalizar la cara una vez para todo el lote
+    try:
+        with timer.stage("face_decode"):
+            face = await run_in_threadpool(normalize_face, content)
+    except UnidentifiedImageError:
+        raise HTTPException(400, "No se pudo leer la imagen")
+    face_hash = face_digest(content)
+    observe_stages(timer.timings)
+    
+    started = time.perf_counter()
+    entries = []
+    pending = {}
+    for template_id in template_ids:
+        template_path = catalog_template_path(template_id)
+        if template_path is None:
+            entries.append({"template": template_id, "status": FAILED, "error": "Template no encontrado"})
+            continue
+        template_version = await run_in_threadpool(template_render_version, template_path)
+        file_id = result_key(None, template_id, template_version, params, face_hash=face_hash)
+        try:
+            job = queue_render(StageTimer(), face, template_path, file_id, output_format, profile, quality)
+        except HTTPException as e:
+            entries.append({"template": template_id, "status": FAILED, "error": e.detail})
+            continue
+        pending[asyncio.ensure_future(job.wait())] = template_id
+    
+    def entry_for(job, template_id):
+        if job.status == FAILED:
+            return {"template": template_id, "status": FAILED, "error": job.error}
+        return {"template": template_id, "status": job.status, "job_id": job.id, **job.result}
+    
+    async def manifest():
+        failed = 0
+        for entry in entries:
+            failed += 1
+            yield json.dumps(entry) + "\n"
+        waiting = set(pending)
+        while waiting:
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                entry = entry_for(future.result(), pending[future])
+                failed += entry["status"] == FAILED
+                yield json.dumps(entry) + "\n"
+        yield json.dumps({
+            "done": True,
+            "total": len(template_ids),
+            "failed": failed,
+            "output_format": output_format,
+            "quality": quality,
+            "face_timings": timer.report()["timings_ms"],
+            "total_ms": round((time.perf_counter() - started) * 1000, 2)
+        }) + "\n"
+    
+    return StreamingResponse(manifest(), media_type="application/x-ndjson")
+
+@app.post("/stream-swap")
+async def stream_face_swap(
+    request: Request,
+    user_face: UploadFile = File(None),
+    gif_template: str = Form(...),
+    face_id: str = Form(None),
+    quality: str = Form(None)
+):
+    """Cambio de cara en streaming: el GIF se envía frame a frame mientras se compone
+
+    El render corre en el threadpool de este proceso (no en el pool de
+    workers) para poder enviar cada bloque apenas sale. El resultado queda
+    guardado igual que el de /simple-swap; su URL va en X-Result-Url.
+    """
+    
+    quality = choose_quality(quality)
+    timer, content, template_path, file_id, _ = await read_swap_request(
+        user_face, gif_template, output_params(DEFAULT_OUTPUT_FORMAT, quality), face_id
+    )
+    output_gif_path = result_cache.path_for(file_id)
+    headers = {
+        "X-Result-Url": f"/download/{output_gif_path.name}",
+        "X-File-Id": file_id
+    }
+    
+    profile = request_profile(request, "/stream-swap")
+    if (profile is None or profile[0] != REQUESTED) and result_cache.lookup(file_id):
+        output_retention.touch(output_gif_path.name)
+        return FileResponse(output_gif_path, media_type="image/gif", headers=headers)
+    
+    # El primer bloque (encabezado y paleta) ya decodifica la cara: si no es
+    # una imagen válida se responde con error antes de empezar el stream
+    chunks = iter_swap(content, template_path, timer, cache=template_cache, quality=quality)
+    if profile is not None:
+        profile_path = profile_store.new_path()
+        chunks = ProfiledIterator(chunks, str(profile_path))
+        headers["X-Profile-Url"] = f"/profiles/{profile_path.name}"
+    try:
+        header = await run_in_threadpool(next, chunks)
+    except UnidentifiedImageError:
+        raise HTTPException(400, "No se pudo leer la imagen")
     except Exception as e:
         raise HTTPException(500, f"Error procesando: {str(e)}")
     
-    finally:
-        # Limpiar archivo temporal de la cara
-        if user_face_path.exists():
-            user_face_path.unlink()
+    def body():
+        yield from persist_stream(itertools.chain([header], chunks), output_gif_path)
+        output_retention.record(output_gif_path)
+        observe_stages(timer.timings)
+        report = timer.report()
+        if report["over_budget"]:
+            print(f"Swap {file_id} excedió el presupuesto en: {report['over_budget']}")
+        if profile is not None:
+            chunks.finish()
+            finish_profile(profile_path, profile, template_path, file_id, report)
+    
+    return StreamingResponse(
+        body(),
+        media_type="image/gif",
+        headers=headers
+    )
+
+# ========== PERFILES ==========
+
+def require_admin(request: Request):
+    token = request.headers.get("x-profile") or request.query_params.get("profile")
+    if not is_admin(token):
+        raise HTTPException(403, "Hace falta el token de administrador")
+
+PROFILE_SORT_KEYS = {"cumulative", "tottime", "calls", "ncalls"}
+
+@app.get("/profiles")
+async def list_profiles(request: Request, limit: int = 50):
+    """Perfiles más recientes con su metadata (admin)"""
+    require_admin(request)
+    return {
+        **profile_store.stats(),
+        "profiles": await run_in_threadpool(profile_store.recent, min(max(1, limit), 500))
+    }
+
+@app.get("/profiles/{name}")
+async def get_profile(name: str, request: Request, format: str = "prof", sort: str = "cumulative",
+                      limit: int = 40):
+    """Descargar un perfil (.prof para pstats/snakeviz) o, con format=text, su resumen (admin)"""
+    require_admin(request)
+    path = profile_store.path_for(name)
+    if path is None:
+        raise HTTPException(404, "Perfil no encontrado")
+    if format == "text":
+        if sort not in PROFILE_SORT_KEYS:
+            raise HTTPException(400, f"sort debe ser uno de: {', '.join(sorted(PROFILE_SORT_KEYS))}")
+        summary = await run_in_threadpool(profile_store.summary, path, sort, min(max(1, limit), 500))
+        return Response(summary, media_type="text/plain; charset=utf-8")
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
 
 @app.get("/download/{filename}")
-async def download_file(filename: str):
-    """Descargar archivo resultante"""
+async def download_file(filename: str, request: Request):
+    """Descargar archivo resultante (con ETag, 304 y descargas por rangos)"""
     file_path = OUTPUT_DIR / filename
     
-    if not file_path.exists():
+    try:
+        stat_result = await run_in_threadpool(os.stat, file_path)
+    except FileNotFoundError:
         raise HTTPException(404, "Archivo no encontrado")
+    output_retention.touch(file_path.name)
+    
+    # Los resultados nombrados por hash nunca cambian de contenido
+    if CONTENT_ADDRESSED_NAME.match(filename):
+        etag, cache_control = f'"{file_path.stem}"', IMMUTABLE
+    else:
+        etag, cache_control = None, REVALIDATE
     
-    return FileResponse(
-        path=file_path,
-        filename=f"custom_gif_{filename}",
-        media_type='image/gif'
+    return cached_file_response(
+        request.headers,
+        file_path,
+        stat_result=stat_result,
+        etag=etag,
+        cache_control=cache_control,
+        media_type=MEDIA_TYPES.get(file_path.suffix.lstrip("."), "image/gif"),
+        filename=f"custom_gif_{filename}"
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,205 @@
+"""Métricas en formato de texto de Prometheus, sin dependencias externas.
+
+- Contadores e histogramas propios: peticiones y latencia por ruta (el
+  middleware) y duración de cada etapa del swap (observe_stages).
+- Valores que ya llevan otros módulos (cachés, pool, OUTPUT_DIR) se leen
+  recién al pedir /metrics, con callbacks registradas con ``collector``:
+  el camino de cada petición no paga nada por ellos.
+
+Observar un valor es buscar el bucket con bisect y sumar bajo un lock.
+"""
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets en segundos: de 5 ms a 30 s (el timeout por defecto de un swap)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+# Etapas del StageTimer que se exportan
+SWAP_STAGES = ("upload_read", "face_decode", "template_fetch", "composite", "encode", "write")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [conteos por bucket (no acumulados), suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labels, (list(c), s, n)) for labels, (c, s, n) in self._series.items())
+        for labels, (counts, total, count) in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = _labels(self.labelnames, labels, [("le", _number(float(bound)))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Métricas propias más colectores que leen el estado de otros módulos al exportar"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Registrar ``fn() -> [(nombre, tipo, ayuda, {etiquetas: valor} o valor)]``"""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"Error leyendo métricas de {collect.__name__}: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if not isinstance(samples, dict):
+                    samples = {(): samples}
+                for labels, value in samples.items():
+                    label_text = "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}" if labels else ""
+                    lines.append(f"{name}{label_text} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "gifswap_http_requests_total", "Peticiones HTTP por ruta, método y código", ("route", "method", "status")
+)
+http_latency = registry.histogram(
+    "gifswap_http_request_duration_seconds", "Duración de las peticiones HTTP hasta el último byte",
+    ("route", "method")
+)
+stage_latency = registry.histogram(
+    "gifswap_stage_duration_seconds", "Duración de cada etapa del swap", ("stage",), STAGE_BUCKETS
+)
+
+
+def observe_stages(timings):
+    """Registrar los tiempos (ms) de un StageTimer"""
+    for stage in SWAP_STAGES:
+        ms = timings.get(stage)
+        if ms is not None:
+            stage_latency.observe(ms / 1000, stage)
+
+
+def _route_template(scope):
+    """Ruta con parámetros sin resolver (/jobs/{job_id}) para no multiplicar series"""
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", None) or "other"
+    endpoint = scope.get("endpoint")
+    app = scope.get("app")
+    if endpoint is None or app is None:
+        return "other"
+    for candidate in getattr(app, "routes", ()):
+        if getattr(candidate, "endpoint", None) is endpoint or getattr(candidate, "app", None) is endpoint:
+            return candidate.path
+    return "other"
+
+
+class MetricsMiddleware:
+    """Middleware ASGI: cuenta y cronometra cada petición HTTP por ruta"""
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = _route_template(scope)
+            method = scope["method"]
+            http_requests.inc(route, method, str(status))
+            http_latency.observe(time.perf_counter() - start, route, method)
@@ -0,0 +1,167 @@
+"""Retención de los resultados en OUTPUT_DIR.
+
+Sin esto los GIFs generados se acumulan para siempre y llenan el disco. Cada
+archivo se registra con su tamaño y su último uso (render, acierto de caché
+o descarga) en memoria, así el barrido no tiene que recorrer el directorio:
+
+- se borran los que llevan más de OUTPUT_MAX_AGE_HOURS sin usarse,
+- y, si el total supera OUTPUT_MAX_MB, los menos usados recientemente.
+
+El barrido corre en una tarea asyncio cada OUTPUT_SWEEP_SECONDS; el borrado
+en sí va al threadpool para no bloquear el event loop.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+
+DEFAULT_MAX_BYTES = int(float(os.getenv("OUTPUT_MAX_MB", "1024")) * 1024 * 1024)
+DEFAULT_MAX_AGE_SECONDS = float(os.getenv("OUTPUT_MAX_AGE_HOURS", "72")) * 3600
+DEFAULT_SWEEP_SECONDS = float(os.getenv("OUTPUT_SWEEP_SECONDS", "60"))
+
+
+def _is_temporary(name):
+    # Los renders se escriben a un temporal y se renombran al terminar
+    return name.startswith(".") or name.endswith(".tmp")
+
+
+class OutputRetention:
+    """Contabilidad en memoria de OUTPUT_DIR con expiración y desalojo LRU"""
+
+    def __init__(self, output_dir, max_bytes=DEFAULT_MAX_BYTES,
+                 max_age_seconds=DEFAULT_MAX_AGE_SECONDS, sweep_seconds=DEFAULT_SWEEP_SECONDS):
+        self.output_dir = Path(output_dir)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.sweep_seconds = sweep_seconds
+        self._entries = OrderedDict()  # nombre -> [bytes, último uso]; orden = LRU
+        self._lock = threading.Lock()
+        self._task = None
+        self.bytes_in_use = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bytes_freed = 0
+        self.sweeps = 0
+
+    def scan(self):
+        """Registrar lo que ya hay en disco (una sola vez, al arrancar)"""
+        found = []
+        for entry in os.scandir(self.output_dir):
+            if entry.is_file() and not _is_temporary(entry.name):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        found.sort()
+        with self._lock:
+            self._entries.clear()
+            self.bytes_in_use = 0
+            for mtime, name, size in found:
+                self._entries[name] = [size, mtime]
+                self.bytes_in_use += size
+        return len(found)
+
+    def record(self, path):
+        """Registrar un archivo recién escrito (o reescrito)"""
+        path = Path(path)
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return
+        with self._lock:
+            previous = self._entries.pop(path.name, None)
+            if previous is not None:
+                self.bytes_in_use -= previous[0]
+            self._entries[path.name] = [size, time.time()]
+            self.bytes_in_use += size
+
+    def touch(self, name):
+        """Marcar un resultado como usado; lo registra si no se conocía"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry[1] = time.time()
+                self._entries.move_to_end(name)
+                return
+        self.record(self.output_dir / name)
+
+    def sweep(self, now=None):
+        """Borrar los resultados vencidos y, si hace falta, los menos usados"""
+        now = time.time() if now is None else now
+        victims = []
+        with self._lock:
+            # El OrderedDict está ordenado por último uso: los vencidos van primero
+            for name, (size, last_used) in list(self._entries.items()):
+                if now - last_used <= self.max_age_seconds:
+                    break
+                victims.append(name)
+                self.expirations += 1
+            for name in victims:
+                self.bytes_in_use -= self._entries.pop(name)[0]
+
+            evicted = []
+            while self.bytes_in_use > self.max_bytes and self._entries:
+                name, (size, _) = self._entries.popitem(last=False)
+                self.bytes_in_use -= size
+                evicted.append(name)
+            self.evictions += len(evicted)
+            victims.extend(evicted)
+            self.sweeps += 1
+
+        for name in victims:
+            path = self.output_dir / name
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"No se pudo borrar {path}: {e}")
+                continue
+            with self._lock:
+                self.bytes_freed += size
+        return len(victims)
+
+    async def _run(self):
+        # Primer recorrido y barrido en el threadpool; después, uno cada sweep_seconds
+        try:
+            await run_in_threadpool(self.scan)
+        except Exception as e:
+            print(f"Error registrando {self.output_dir}: {e}")
+        while True:
+            try:
+                removed = await run_in_threadpool(self.sweep)
+                if removed:
+                    print(f"Retención de outputs: {removed} archivos borrados")
+            except Exception as e:
+                print(f"Error en el barrido de outputs: {e}")
+            await asyncio.sleep(self.sweep_seconds)
+
+    def start(self):
+        """Lanzar la tarea que registra OUTPUT_DIR y lo barre periódicamente"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "bytes_in_use": self.bytes_in_use,
+                "max_bytes": self.max_bytes,
+                "max_age_seconds": self.max_age_seconds,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "bytes_freed": self.bytes_freed,
+                "sweeps": self.sweeps,
+            }
@@ -0,0 +1,159 @@
+"""Perfilado opcional de peticiones de swap con cProfile.
+
+Un admin pide el perfil de una petición concreta con el header
+``X-Profile: <ADMIN_TOKEN>`` (o ``?profile=<ADMIN_TOKEN>``); además, con
+PROFILE_SAMPLE_RATE > 0 se perfila sola esa fracción del tráfico.
+
+El perfil cubre el render, que es donde está el costo: profiled_call envuelve
+la función que corre en el worker (o en el thread, con SWAP_WORKERS=0) y
+escribe el .prof allí mismo. Para /stream-swap ProfiledIterator acumula
+cada bloque en el mismo perfil. Los .prof se guardan en el directorio de
+assets derivados junto a un JSON con el endpoint, el template y los tiempos
+por etapa; se abren con pstats o snakeviz, o se piden como texto a /profiles.
+"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from pathlib import Path
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+DEFAULT_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+DEFAULT_MAX_PROFILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+PROFILE_HEADER = "x-profile"
+PROFILE_QUERY = "profile"
+PROFILE_NAME = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}\.prof$")
+
+# Motivo del perfil
+REQUESTED = "requested"
+SAMPLED = "sampled"
+
+
+def is_admin(token):
+    """El token coincide con ADMIN_TOKEN (sin token configurado nadie es admin)"""
+    return bool(ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def profile_reason(headers, query_params, sample_rate=DEFAULT_SAMPLE_RATE):
+    """REQUESTED, SAMPLED o None para una petición; PermissionError si el token no vale"""
+    token = headers.get(PROFILE_HEADER) or query_params.get(PROFILE_QUERY)
+    if token:
+        if not is_admin(token):
+            raise PermissionError("Token de perfilado inválido")
+        return REQUESTED
+    if sample_rate > 0 and random.random() < sample_rate:
+        return SAMPLED
+    return None
+
+
+def profiled_call(profile_path, fn, *args):
+    """Ejecutar ``fn(*args)`` bajo cProfile y guardar el perfil (corre en el worker)"""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Desde Python 3.12 hay un solo perfilador activo por proceso: seguir sin perfil
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+
+
+class ProfiledIterator:
+    """Iterador que perfila cada ``next`` (aunque cada uno corra en otro thread)"""
+
+    def __init__(self, iterator, profile_path):
+        self.iterator = iterator
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile()
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            self.profiler.enable()
+        except ValueError:
+            return next(self.iterator)  # otro perfil en curso (ver profiled_call)
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.profiler.disable()
+            self.finish()
+            raise
+        finally:
+            self.profiler.disable()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.profiler.dump_stats(self.profile_path)
+
+
+class ProfileStore:
+    """Directorio de perfiles con su metadata, acotado a ``max_files``"""
+
+    def __init__(self, directory, max_files=DEFAULT_MAX_PROFILES, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.captured = {REQUESTED: 0, SAMPLED: 0}
+
+    def new_path(self):
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.prof"
+        return self.directory / name
+
+    def path_for(self, name):
+        """Ruta de un perfil existente, o None (valida el nombre)"""
+        if not PROFILE_NAME.match(name):
+            return None
+        path = self.directory / name
+        return path if path.exists() else None
+
+    def finish(self, profile_path, reason, meta):
+        """Guardar la metadata de un perfil ya escrito y recortar los viejos"""
+        profile_path = Path(profile_path)
+        if not profile_path.exists():
+            return None
+        meta = {"name": profile_path.name, "reason": reason, "created": time.time(), **meta}
+        profile_path.with_suffix(".json").write_text(json.dumps(meta), encoding="utf-8")
+        self.captured[reason] = self.captured.get(reason, 0) + 1
+        self._prune()
+        return meta
+
+    def _prune(self):
+        profiles = sorted(self.directory.glob("*.prof"))
+        for old in profiles[:max(0, len(profiles) - self.max_files)]:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".json").unlink(missing_ok=True)
+
+    def recent(self, limit=50):
+        """Metadata de los perfiles más recientes"""
+        entries = []
+        for meta_path in sorted(self.directory.glob("*.json"), reverse=True)[:limit]:
+            try:
+                entries.append(json.loads(meta_path.read_text(encoding="utf-8")))
+            except (OSError, ValueError):
+                continue
+        return entries
+
+    def summary(self, profile_path, sort="cumulative", limit=40):
+        """Las ``limit`` funciones más costosas del perfil, como texto"""
+        out = io.StringIO()
+        stats = pstats.Stats(str(profile_path), stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def stats(self):
+        return {"sample_rate": self.sample_rate, "captured": dict(self.captured)}
@@ -1,14 +1,27 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse
 import uvicorn
+from starlette.concurrency import run_in_threadpool
+import asyncio
 import os
+import threading
 from pathlib import Path
-import shutil
 import uuid
-from PIL import Image, ImageDraw
-import math
+from PIL import UnidentifiedImageError
+
+from compositor import DEFAULT_QUALITY, QUALITY_TIERS, StageTimer
+from worker_pool import JobTimeoutError, render_to_file, swap_pool
+from jobs import FAILED, QueueFullError, job_manager
+from uploads import MAX_FACE_BYTES, MULTIPART_OVERHEAD, UploadLimitMiddleware, UploadRejected, read_limited
+from template_cache import template_cache
+from template_index import TemplateIndex
+from output_retention import OutputRetention
+from http_cache import IMMUTABLE, REVALIDATE, CachedStaticFiles, cached_file_response
+from thumbnails import PREVIEW, STATIC, ThumbnailStore
+from scenes import SceneLibrary, normalize_params
+from readiness import Readiness
 
 app = FastAPI(title="GIF Face Swap Public App")
 
@@ -21,17 +34,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={path: MAX_FACE_BYTES + MULTIPART_OVERHEAD for path in ("/api/simple-swap", "/api/jobs")},
+)
+
 # Configurar directorios
 BASE_DIR = Path(__file__).parent
 UPLOAD_DIR = BASE_DIR / "uploads"
 OUTPUT_DIR = BASE_DIR / "outputs" 
 TEMPLATES_DIR = BASE_DIR / "templates"
+DERIVED_DIR = BASE_DIR / "derived"
 FRONTEND_DIR = BASE_DIR.parent / "frontend" / "dist"
 
 # Crear directorios si no existen
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 TEMPLATES_DIR.mkdir(exist_ok=True)
+DERIVED_DIR.mkdir(exist_ok=True)
+
+# Catálogo de templates en memoria
+template_index = TemplateIndex(TEMPLATES_DIR, DERIVED_DIR / "template_index.json")
+
+# Escenas de los templates de demostración
+scene_library = SceneLibrary(BASE_DIR / "template_scenes", DERIVED_DIR / "scenes")
+scene_library.load()
+DEMO_SCENES = ["soccer_celebration", "dancer", "singer"]
+template_build_lock = threading.Lock()
+
+# Arranque: lista cuando los cachés están calientes
+readiness = Readiness()
+prewarm_task = None
+WARM_TEMPLATE_LIMIT = 20
+
+# Miniaturas del catálogo
+thumbnail_store = ThumbnailStore(DERIVED_DIR / "thumbnails")
+
+# Límite de espacio y antigüedad para los resultados
+output_retention = OutputRetention(OUTPUT_DIR)
 
 # Servir archivos estáticos del frontend
 if FRONTEND_DIR.exists():
@@ -42,228 +82,248 @@ else:
         return {"message": "Frontend no construido. Ejecuta 'npm run build' en frontend/"}
 
 # Montar directorios estáticos
-app.mount("/templates", StaticFiles(directory=TEMPLATES_DIR), name="templates")
+app.mount("/templates", CachedStaticFiles(directory=TEMPLATES_DIR), name="templates")
 
 # ========== FUNCIONES DE GIFs ==========
-def create_soccer_celebration():
-    """Crear GIF de celebración de futbol"""
-    try:
-        frames = []
-        size = (200, 200)
-        
-        for i in range(4):
-            img = Image.new('RGB', size, 'green')
-            draw = ImageDraw.Draw(img)
-            
-            # Líneas del campo
-            draw.rectangle([10, 10, 190, 190], outline='white', width=2)
-            draw.line([100, 10, 100, 190], fill='white', width=2)
-            draw.ellipse([80, 80, 120, 120], outline='white', width=2)
-            
-            # Personaje
-            body_color = 'blue' if i % 2 == 0 else 'darkblue'
-            head_y = 70 + (i * 5)
-            draw.ellipse([90, head_y, 110, head_y+20], fill='beige', outline='black')
-            
-            # Brazos
-            arm_angle = i * 20
-            draw.line([95, 90, 85 - arm_angle//10, 70], fill=body_color, width=3)
-            draw.line([105, 90, 115 + arm_angle//10, 70], fill=body_color, width=3)
-            
-            # Cuerpo y piernas
-            draw.rectangle([95, 90, 105, 130], fill=body_color)
-            leg_offset = (i - 1) * 8
-            draw.line([100, 130, 90 + leg_offset, 160], fill='darkblue', width=3)
-            draw.line([100, 130, 110 - leg_offset, 160], fill='darkblue', width=3)
-            
-            # Pelota
-            ball_x = 120 + (i * 15)
-            draw.ellipse([ball_x, 140, ball_x+10, 150], fill='white')
-            
-            frames.append(img)
-        
-        output_path = TEMPLATES_DIR / "soccer_celebration.gif"
-        frames[0].save(output_path, save_all=True, append_images=frames[1:], duration=200, loop=0)
-        return True
-    except Exception as e:
-        print(f"Error creando soccer: {e}")
-        return False
+def create_demo_templates():
+    """Renderizar las escenas de demostración que falten, una sola vez (bajo lock)"""
+    with template_build_lock:
+        created = []
+        for scene_id in DEMO_SCENES:
+            output_path = TEMPLATES_DIR / f"{scene_id}.gif"
+            if output_path.exists():
+                continue
+            try:
+                scene = scene_library.get(scene_id)
+                scene_library.render_to(scene_id, normalize_params(scene, {}), output_path)
+                created.append(scene_id)
+            except Exception as e:
+                print(f"Error creando {scene_id}: {e}")
+        if created:
+            template_index.refresh()
+        return created
 
-def create_dancer_gif():
-    """Crear GIF de bailarín"""
-    try:
-        frames = []
-        size = (200, 200)
-        
-        for i in range(6):
-            img = Image.new('RGB', size, 'purple')
-            draw = ImageDraw.Draw(img)
-            
-            head_x = 100 + (i-2) * 3
-            draw.ellipse([head_x-15, 50, head_x+15, 80], fill='beige')
-            draw.ellipse([head_x-8, 60, head_x-4, 64], fill='black')
-            draw.ellipse([head_x+4, 60, head_x+8, 64], fill='black')
-            
-            mouth_y = 72 if i % 2 == 0 else 74
-            draw.arc([head_x-6, mouth_y, head_x+6, mouth_y+4], 0, 180, fill='red', width=2)
-            
-            body_color = 'red' if i % 3 == 0 else 'darkred'
-            draw.rectangle([head_x-10, 80, head_x+10, 120], fill=body_color)
-            
-            arm_angle = i * 30
-            arm1_x = 80 + int(20 * math.sin(math.radians(arm_angle)))
-            arm2_x = 120 - int(20 * math.sin(math.radians(arm_angle)))
-            
-            draw.line([head_x-10, 90, arm1_x, 70], fill=body_color, width=4)
-            draw.line([head_x+10, 90, arm2_x, 70], fill=body_color, width=4)
-            
-            leg_offset = int(15 * math.sin(math.radians(arm_angle * 2)))
-            draw.line([head_x-5, 120, head_x-15, 150 + leg_offset], fill='blue', width=4)
-            draw.line([head_x+5, 120, head_x+15, 150 - leg_offset], fill='blue', width=4)
-            
-            frames.append(img)
-        
-        output_path = TEMPLATES_DIR / "dancer.gif"
-        frames[0].save(output_path, save_all=True, append_images=frames[1:], duration=150, loop=0)
-        return True
-    except Exception as e:
-        print(f"Error creando dancer: {e}")
-        return False
+# ========== ENDPOINTS API ==========
+
+@app.get("/api/health")
+def health():
+    return {
+        "status": "public",
+        "message": "App pública funcionando",
+        "readiness": readiness.stats(),
+        "template_cache": template_cache.stats(),
+        "swap_pool": swap_pool.stats(),
+        "outputs": output_retention.stats(),
+    }
+
+@app.get("/api/health/live")
+def health_live():
+    return {"status": "alive"}
 
-def create_singer_gif():
-    """Crear GIF de cantante"""
+@app.get("/api/health/ready")
+def health_ready(response: Response):
+    """200 sólo cuando templates y cachés están precalentados"""
+    if not readiness.ready:
+        response.status_code = 503
+    return readiness.stats()
+
+@app.on_event("startup")
+async def build_template_index():
+    with readiness.step("templates"):
+        template_index.load()
+        await run_in_threadpool(create_demo_templates)
+    _, warm = template_index.query(limit=WARM_TEMPLATE_LIMIT)
+    warm_paths = [TEMPLATES_DIR / entry.file_name for entry in warm]
+    swap_pool.start(warm_paths)
+    global prewarm_task
+    prewarm_task = asyncio.create_task(prewarm(warm_paths))
+
+async def prewarm(warm_paths):
+    """Caché de frames y workers calientes antes de declararse lista"""
     try:
-        frames = []
-        size = (200, 200)
-        
-        for i in range(5):
-            img = Image.new('RGB', size, 'darkblue')
-            draw = ImageDraw.Draw(img)
-            
-            # Micrófono
-            draw.ellipse([140, 60, 160, 80], fill='gray')
-            draw.line([150, 80, 150, 120], fill='gray', width=3)
-            
-            # Cabeza
-            draw.ellipse([80, 50, 120, 90], fill='beige')
-            
-            # Boca
-            mouth_open = i % 2 == 0
-            if mouth_open:
-                draw.ellipse([95, 75, 105, 85], fill='red')
-            else:
-                draw.line([95, 80, 105, 80], fill='red', width=2)
-            
-            # Ojos
-            draw.ellipse([88, 60, 92, 64], fill='black')
-            draw.ellipse([108, 60, 112, 64], fill='black')
-            
-            # Cuerpo
-            draw.rectangle([85, 90, 115, 130], fill='gold')
-            
-            # Brazos
-            arm_move = i * 5
-            draw.line([85, 100, 65 - arm_move, 110], fill='gold', width=4)
-            draw.line([115, 100, 135 + arm_move, 90], fill='gold', width=4)
-            
-            frames.append(img)
-        
-        output_path = TEMPLATES_DIR / "singer.gif"
-        frames[0].save(output_path, save_all=True, append_images=frames[1:], duration=300, loop=0)
-        return True
+        with readiness.step("frame_cache"):
+            for path in warm_paths:
+                await run_in_threadpool(template_cache.get, path)
+        with readiness.step("workers") as step:
+            step["workers"] = await swap_pool.warm()
     except Exception as e:
-        print(f"Error creando singer: {e}")
-        return False
+        readiness.mark_failed(e)
+        return
+    readiness.mark_ready()
 
-# ========== ENDPOINTS API ==========
+@app.on_event("startup")
+async def start_output_retention():
+    output_retention.start()
 
-@app.get("/api/health")
-def health():
-    return {"status": "public", "message": "App pública funcionando"}
+@app.on_event("shutdown")
+async def stop_swap_pool():
+    global prewarm_task
+    task, prewarm_task = prewarm_task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    swap_pool.shutdown()
+
+@app.on_event("shutdown")
+async def stop_output_retention():
+    await output_retention.stop()
 
 @app.get("/api/gif-templates")
-async def get_gif_templates():
+async def get_gif_templates(offset: int = 0, limit: int = 100, category: str = None, q: str = None):
     """Obtener templates disponibles"""
-    templates = []
-    
-    # Crear templates si no existen
-    if not list(TEMPLATES_DIR.glob("*.gif")):
-        print("Creando templates de demostración...")
-        create_soccer_celebration()
-        create_dancer_gif()
-        create_singer_gif()
+    template_index.refresh_if_stale()
     
-    for file in TEMPLATES_DIR.glob("*.gif"):
-        templates.append({
-            "id": file.stem,
-            "name": file.stem.replace("_", " ").title(),
-            "thumbnail": f"/templates/{file.name}",
-            "gif_path": f"/templates/{file.name}",
-            "category": "general"
-        })
+    _, page = template_index.query(category=category, prefix=q, offset=max(0, offset), limit=min(max(1, limit), 500))
+    templates = [entry.to_public() for entry in page]
     
     print(f"Devolviendo {len(templates)} templates")
     return templates
 
-@app.post("/api/simple-swap")
-async def simple_face_swap(user_face: UploadFile = File(...), gif_template: str = Form(...)):
-    """Procesar GIF con cara del usuario"""
-    
+@app.get("/thumbnails/{template_id}")
+async def get_thumbnail(template_id: str, request: Request, kind: str = STATIC):
+    """Miniatura de un template (kind=preview para la vista previa animada)"""
+    entry = template_index.get(template_id)
+    if entry is None or kind not in (STATIC, PREVIEW):
+        raise HTTPException(404, "Template no encontrado")
+    path = await run_in_threadpool(thumbnail_store.ensure, TEMPLATES_DIR / entry.file_name, entry.version, kind)
+    cache_control = IMMUTABLE if request.query_params.get("v") == entry.version else REVALIDATE
+    return cached_file_response(request.headers, path, etag=f'"{entry.version}-{kind}"', cache_control=cache_control)
+
+@app.get("/thumbnails/{template_id}/preview")
+async def get_thumbnail_preview(template_id: str, request: Request):
+    """Vista previa animada de un template"""
+    return await get_thumbnail(template_id, request, PREVIEW)
+
+def choose_quality(quality):
+    """preview, standard o full (por defecto)"""
+    quality = (quality or DEFAULT_QUALITY).lower()
+    if quality not in QUALITY_TIERS:
+        raise HTTPException(400, f"Calidad no soportada, opciones: {', '.join(QUALITY_TIERS)}")
+    return quality
+
+async def submit_swap(user_face: UploadFile, gif_template: str, quality: str = None, upgrade: bool = False):
+    """Guardar la cara y encolar el render; devuelve (Job, Job de la mejora o None)
+
+    Con ``upgrade`` y una calidad reducida también se encola, detrás, el
+    render en calidad full con la misma cara, sin que el cliente la vuelva
+    a subir.
+    """
     if not user_face.content_type.startswith('image/'):
         raise HTTPException(400, "El archivo debe ser una imagen")
+    quality = choose_quality(quality)
+    
+    # Usar template
+    template_path = TEMPLATES_DIR / f"{gif_template}.gif"
+    if not template_path.exists():
+        _, first = template_index.query(limit=1)
+        if first:
+            template_path = TEMPLATES_DIR / first[0].file_name
+        else:
+            raise HTTPException(404, "No hay templates disponibles")
+    
+    # Leer la imagen a memoria, con límite de tamaño
+    try:
+        content = await read_limited(user_face)
+    except UploadRejected as e:
+        raise HTTPException(e.status_code, e.detail)
     
+    job = queue_render(content, template_path, quality)
+    upgrade_job = None
+    if upgrade and quality != DEFAULT_QUALITY:
+        try:
+            upgrade_job = queue_render(content, template_path, DEFAULT_QUALITY)
+        except HTTPException as e:
+            # Sin lugar en la cola la vista previa igual sirve; la mejora se pide después
+            print(f"No se pudo encolar la mejora: {e.detail}")
+    return job, upgrade_job
+
+def queue_render(content, template_path, quality):
+    """Encolar el render de una cara ya leída; devuelve el Job"""
     file_id = str(uuid.uuid4())
-    user_face_path = UPLOAD_DIR / f"{file_id}_face.jpg"
     output_gif_path = OUTPUT_DIR / f"{file_id}_result.gif"
     
-    try:
-        # Guardar imagen
-        with open(user_face_path, "wb") as buffer:
-            content = await user_face.read()
-            buffer.write(content)
-        
-        # Usar template
-        template_path = TEMPLATES_DIR / f"{gif_template}.gif"
-        if not template_path.exists():
-            gif_files = list(TEMPLATES_DIR.glob("*.gif"))
-            if gif_files:
-                template_path = gif_files[0]
-            else:
-                raise HTTPException(404, "No hay templates disponibles")
-        
-        # Copiar GIF (placeholder)
-        shutil.copy2(template_path, output_gif_path)
-        
+    async def work(job):
+        # Componer la cara sobre el template
+        timer = StageTimer()
+        try:
+            timer.timings = await swap_pool.run(render_to_file, content, template_path, output_gif_path,
+                                                "gif", quality)
+        except UnidentifiedImageError:
+            raise HTTPException(400, "No se pudo leer la imagen")
+        except JobTimeoutError as e:
+            raise HTTPException(504, str(e))
+        except Exception as e:
+            raise HTTPException(500, f"Error: {str(e)}")
+        output_retention.record(output_gif_path)
         return {
-            "success": True,
-            "message": "GIF procesado!",
             "result_url": f"/api/download/{output_gif_path.name}",
+            "quality": quality,
+            "timings": timer.report(),
         }
-        
-    except Exception as e:
-        raise HTTPException(500, f"Error: {str(e)}")
-    finally:
-        if user_face_path.exists():
-            user_face_path.unlink()
+    
+    try:
+        return job_manager.submit(work)
+    except QueueFullError as e:
+        raise HTTPException(503, str(e))
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(user_face: UploadFile = File(...), gif_template: str = Form(...),
+                     quality: str = Form(None)):
+    """Encolar un swap sin mantener la conexión abierta"""
+    job, _ = await submit_swap(user_face, gif_template, quality)
+    return {**job.to_public(), "status_url": f"/api/jobs/{job.id}"}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Consultar el estado de un trabajo"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Trabajo no encontrado o expirado")
+    return job.to_public()
+
+@app.post("/api/simple-swap")
+async def simple_face_swap(user_face: UploadFile = File(...), gif_template: str = Form(...),
+                           quality: str = Form(None), upgrade: bool = Form(False)):
+    """Procesar GIF con cara del usuario (quality=preview para una vista previa rápida)
+
+    Con ``upgrade`` la vista previa encola además el render full y la
+    respuesta trae su ``status_url`` para consultarlo.
+    """
+    job, upgrade_job = await submit_swap(user_face, gif_template, quality, upgrade)
+    await job.wait()
+    if job.status == FAILED:
+        raise HTTPException(job.error_status or 500, job.error)
+    
+    result = {
+        "success": True,
+        "message": "GIF procesado!",
+        **job.result,
+    }
+    if upgrade_job is not None:
+        result["upgrade"] = {**upgrade_job.to_public(), "quality": DEFAULT_QUALITY,
+                             "status_url": f"/api/jobs/{upgrade_job.id}"}
+    return result
 
 @app.get("/api/download/{filename}")
-async def download_file(filename: str):
+async def download_file(filename: str, request: Request):
     """Descargar resultado"""
     file_path = OUTPUT_DIR / filename
     if not file_path.exists():
         raise HTTPException(404, "Archivo no encontrado")
+    output_retention.touch(file_path.name)
     
-    return FileResponse(file_path, filename=f"mi_gif_{filename}")
+    return cached_file_response(request.headers, file_path, filename=f"mi_gif_{filename}")
 
 # Endpoint para crear templates manualmente
 @app.get("/api/create-demos")
 async def create_demos():
-    """Crear templates manualmente"""
+    """Crear los templates de demostración que falten"""
     try:
-        create_soccer_celebration()
-        create_dancer_gif()
-        create_singer_gif()
-        return {"success": True, "message": "Templates creados"}
+        created = await run_in_threadpool(create_demo_templates)
+        return {"success": True, "message": "Templates creados" if created else "Los templates ya existían", "created": created}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -0,0 +1,68 @@
+"""Estado de arranque de la instancia: vivo vs. listo.
+
+Al arrancar se construyen los templates que falten, se carga el índice y se
+precalientan los cachés de frames (en este proceso y en los workers del
+pool). Mientras tanto el proceso está vivo (responde /health/live) pero no
+listo: /health/ready devuelve 503 hasta que termina el precalentamiento, así
+el balanceador no manda tráfico a una instancia fría.
+
+Cada paso se registra con su duración y su error, si lo hubo.
+"""
+import time
+from contextlib import contextmanager
+
+STARTING = "starting"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class Readiness:
+    """Pasos del precalentamiento y estado listo/no listo de la instancia"""
+
+    def __init__(self):
+        self.state = STARTING
+        self.started_at = time.time()
+        self.ready_at = None
+        self.steps = {}
+        self.error = None
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    @contextmanager
+    def step(self, name):
+        """Registrar un paso del precalentamiento con su duración"""
+        self.state = WARMING
+        self.steps[name] = {"status": "running"}
+        start = time.perf_counter()
+        try:
+            yield self.steps[name]
+        except Exception as e:
+            self.steps[name].update(status="failed", error=str(e))
+            raise
+        else:
+            self.steps[name]["status"] = "done"
+        finally:
+            self.steps[name]["ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def mark_ready(self):
+        self.state = READY
+        self.ready_at = time.time()
+        print(f"Instancia lista en {self.ready_at - self.started_at:.2f}s")
+
+    def mark_failed(self, error):
+        self.state = FAILED
+        self.error = str(error)
+        print(f"Falló el precalentamiento: {error}")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "uptime_s": round(time.time() - self.started_at, 2),
+            "warmup_s": round(self.ready_at - self.started_at, 2) if self.ready_at else None,
+            "steps": self.steps,
+            "error": self.error,
+        }
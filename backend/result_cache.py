@@ -0,0 +1,105 @@
+"""Caché de resultados direccionado por contenido.
+
+Cada render se identifica por el hash de los bytes de la cara, la versión del
+template (GIF + anotaciones) y los parámetros del render. El archivo de salida
+se nombra con ese hash, así que un reintento o la misma selfie en otra sesión
+devuelven el artefacto ya existente sin volver a renderizar, y en disco no se
+guardan duplicados.
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from face_annotations import annotation_path
+from template_index import file_version
+
+# Subir cuando cambie la salida del pipeline para no servir resultados viejos
+RENDER_VERSION = 4
+
+
+def template_render_version(template_path):
+    """Versión de todo lo que del template afecta al render: GIF y anotaciones"""
+    stat = Path(template_path).stat()
+    version = file_version(stat.st_size, stat.st_mtime_ns)
+    try:
+        ann = annotation_path(template_path).stat()
+        version += "-" + file_version(ann.st_size, ann.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return version
+
+
+def face_digest(face_bytes):
+    """Hash de los bytes de la cara (se calcula una vez por subida)"""
+    return hashlib.sha256(face_bytes).digest()
+
+
+def result_key(face_bytes, template_id, template_version, params=None, face_hash=None):
+    """Hash que identifica un render (cara + template + parámetros)
+
+    Si ya se tiene ``face_hash`` (ver face_digest) no se vuelve a hashear la cara.
+    """
+    digest = hashlib.sha256()
+    digest.update(face_hash or face_digest(face_bytes))
+    meta = {
+        "render": RENDER_VERSION,
+        "template": template_id,
+        "template_version": template_version,
+        "params": params or {},
+    }
+    digest.update(json.dumps(meta, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def persist_stream(chunks, output_path):
+    """Reenviar los bloques de ``chunks`` guardándolos a la vez en ``output_path``
+
+    Se escribe a un temporal que sólo se renombra si el stream terminó
+    completo: si el cliente se desconecta a mitad no queda un archivo a medias.
+    """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class ResultCache:
+    """Busca resultados ya renderizados en OUTPUT_DIR por su hash"""
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path_for(self, key, extension="gif"):
+        return self.output_dir / f"{key}.{extension}"
+
+    def lookup(self, key, extension="gif"):
+        """Ruta del resultado si ya existe, o None (y cuenta el acierto/fallo)"""
+        path = self.path_for(key, extension)
+        found = path.exists()
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path if found else None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,331 @@
+"""Templates descritos como escenas declarativas.
+
+Una escena es un JSON (ver template_scenes/*.json) con el tamaño de diseño, la
+cantidad de frames, la duración, parámetros con valores por defecto y una
+lista de figuras. Cada atributo de una figura puede ser:
+
+- un valor fijo: ``[80, 50, 120, 90]``, ``"beige"``, ``3``
+- uno por frame, en ciclo: ``{"cycle": ["blue", "darkblue"]}``
+- keyframes con interpolación lineal: ``{"keys": [[0, [94, 50]], [5, [109, 50]]]}``
+- un parámetro de la escena: ``"$body"``
+
+Figuras: ``rectangle`` y ``ellipse`` (box, fill, outline, width), ``line``
+(points, fill, width) y ``arc`` (box, start, end, fill, width); todas aceptan
+``visible``. ``face`` nombra la figura cuya caja es la cabeza: de ahí salen
+las anotaciones de cara por frame. ``face_tilt`` (opcional, también animable)
+es la inclinación de la cabeza en grados, en sentido antihorario.
+
+Cada frame se dibuja de forma independiente, así que el renderer puede
+repartirlos entre procesos. Las variantes (otro tamaño u otros colores) se
+renderizan a pedido y se guardan en disco con su propia clave.
+"""
+import hashlib
+import json
+import os
+import re
+import uuid
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+from face_annotations import annotation_path, save_face_annotations
+
+SCENE_FORMAT_VERSION = 1
+MAX_VARIANT_SIDE = 800
+MIN_VARIANT_SIDE = 32
+DEFAULT_MAX_VARIANTS = int(os.getenv("SCENE_VARIANTS_MAX", "500"))
+
+SHAPES = {"rectangle", "ellipse", "line", "arc"}
+
+# Id de una variante renderizada: "<escena>@<clave>"
+VARIANT_ID = re.compile(r"^([a-z0-9_]+)@([0-9a-f]{12})$")
+
+
+class SceneError(ValueError):
+    """La escena o los parámetros de la variante no son válidos"""
+
+
+# ---------- evaluación de atributos ----------
+
+def _lerp(a, b, t):
+    if isinstance(a, list):
+        return [_lerp(x, y, t) for x, y in zip(a, b)]
+    return a + (b - a) * t
+
+
+def _round(value):
+    if isinstance(value, list):
+        return [_round(v) for v in value]
+    if isinstance(value, float):
+        return int(round(value))
+    return value
+
+
+def resolve_value(value, frame, params):
+    """Valor de un atributo en un frame concreto"""
+    if isinstance(value, dict):
+        if "cycle" in value:
+            return resolve_value(value["cycle"][frame % len(value["cycle"])], frame, params)
+        if "keys" in value:
+            keys = value["keys"]
+            if frame <= keys[0][0]:
+                return resolve_value(keys[0][1], frame, params)
+            for (f0, v0), (f1, v1) in zip(keys, keys[1:]):
+                if frame <= f1:
+                    v0, v1 = resolve_value(v0, frame, params), resolve_value(v1, frame, params)
+                    if isinstance(v0, str) or isinstance(v0, bool):
+                        # Colores y flags no se interpolan: cambian en el keyframe
+                        return v1 if frame == f1 else v0
+                    return _round(_lerp(v0, v1, (frame - f0) / (f1 - f0)))
+            return resolve_value(keys[-1][1], frame, params)
+        raise SceneError(f"Animación desconocida: {sorted(value)}")
+    if isinstance(value, str) and value.startswith("$"):
+        name = value[1:]
+        if name not in params:
+            raise SceneError(f"Parámetro no definido: {name}")
+        return params[name]
+    return value
+
+
+def _scale_coords(coords, sx, sy):
+    return [int(round(c * (sx if i % 2 == 0 else sy))) for i, c in enumerate(coords)]
+
+
+# ---------- render ----------
+
+def scene_size(scene, params):
+    """Tamaño de salida (ancho, alto) de una variante"""
+    return tuple(params.get("size") or scene["size"])
+
+
+def render_scene_frame(scene, params, frame):
+    """Dibujar un frame de la escena; devuelve (arreglo RGB, [x, y, ancho, alto, rotación] de la cara o None)"""
+    design_w, design_h = scene["size"]
+    width, height = scene_size(scene, params)
+    sx, sy = width / design_w, height / design_h
+    line_scale = min(sx, sy)
+
+    background = resolve_value(scene.get("background", "black"), frame, params)
+    img = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(img)
+    face_box = None
+
+    for shape in scene["shapes"]:
+        attr = lambda name, default=None: resolve_value(shape.get(name, default), frame, params)
+        if not attr("visible", True):
+            continue
+        kind = shape["type"]
+        line_width = max(1, int(round(attr("width", 1) * line_scale)))
+        if kind == "line":
+            draw.line(_scale_coords(attr("points"), sx, sy), fill=attr("fill"), width=line_width)
+            continue
+        box = _scale_coords(attr("box"), sx, sy)
+        if kind == "rectangle":
+            draw.rectangle(box, fill=attr("fill"), outline=attr("outline"), width=line_width)
+        elif kind == "ellipse":
+            draw.ellipse(box, fill=attr("fill"), outline=attr("outline"), width=line_width)
+        elif kind == "arc":
+            draw.arc(box, attr("start", 0), attr("end", 360), fill=attr("fill"), width=line_width)
+        if shape.get("id") is not None and shape.get("id") == scene.get("face"):
+            tilt = resolve_value(scene.get("face_tilt", 0), frame, params)
+            face_box = [box[0], box[1], box[2] - box[0], box[3] - box[1], tilt]
+
+    return np.asarray(img), face_box
+
+
+def render_scene(scene, params, map_fn=map):
+    """Dibujar todos los frames; ``map_fn`` permite repartirlos (p. ej. Executor.map)"""
+    n_frames = scene["frames"]
+    results = list(map_fn(render_scene_frame, [scene] * n_frames, [params] * n_frames, range(n_frames)))
+    return [frame for frame, _ in results], [box for _, box in results]
+
+
+def save_scene_gif(scene, params, frames, face_boxes, output_path):
+    """Escribir los frames como GIF (y sus anotaciones de cara, si la escena las define)"""
+    images = [Image.fromarray(frame) for frame in frames]
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{uuid.uuid4().hex}.tmp")
+    try:
+        images[0].save(
+            tmp_path,
+            format="GIF",
+            save_all=True,
+            append_images=images[1:],
+            duration=scene["duration"],
+            loop=scene.get("loop", 0),
+            optimize=True,
+        )
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    if scene.get("face") and all(box is not None for box in face_boxes):
+        save_face_annotations(output_path, scene_size(scene, params),
+                              [box[:4] for box in face_boxes], [box[4] for box in face_boxes])
+
+
+# ---------- validación ----------
+
+def validate_scene(scene):
+    """Comprobar la estructura básica de una escena; lanza SceneError"""
+    for key in ("id", "size", "frames", "duration", "shapes"):
+        if key not in scene:
+            raise SceneError(f"Falta '{key}' en la escena")
+    if scene.get("format", SCENE_FORMAT_VERSION) != SCENE_FORMAT_VERSION:
+        raise SceneError("Versión de formato de escena no soportada")
+    if int(scene["frames"]) < 1:
+        raise SceneError("La escena necesita al menos un frame")
+    for shape in scene["shapes"]:
+        if shape.get("type") not in SHAPES:
+            raise SceneError(f"Figura desconocida: {shape.get('type')}")
+    # Evaluar todos los frames con los parámetros por defecto detecta errores de sintaxis
+    params = default_params(scene)
+    for frame in range(scene["frames"]):
+        resolve_value(scene.get("face_tilt", 0), frame, params)
+        for shape in scene["shapes"]:
+            for value in shape.values():
+                resolve_value(value, frame, params)
+    return scene
+
+
+def default_params(scene):
+    return {"size": None, **scene.get("params", {})}
+
+
+def normalize_params(scene, raw):
+    """Parámetros de una variante validados y en forma canónica
+
+    ``raw`` puede traer ``size`` ("320" o "320x240") y cualquier color de
+    ``params`` de la escena. Los colores se normalizan a ``#rrggbb``.
+    """
+    params = default_params(scene)
+    for name, value in raw.items():
+        if value is None or value == "":
+            continue
+        if name == "size":
+            params["size"] = _parse_size(scene, str(value))
+        elif name in params:
+            try:
+                params[name] = "#%02x%02x%02x" % ImageColor.getrgb(str(value))[:3]
+            except ValueError:
+                raise SceneError(f"Color inválido para '{name}': {value}")
+        else:
+            raise SceneError(f"Parámetro desconocido: {name}")
+    if params["size"] == tuple(scene["size"]):
+        params["size"] = None
+    return params
+
+
+def _parse_size(scene, value):
+    design_w, design_h = scene["size"]
+    try:
+        if "x" in value:
+            width, height = (int(v) for v in value.lower().split("x", 1))
+        else:
+            # Un solo número: el lado mayor, conservando la proporción
+            side = int(value)
+            scale = side / max(design_w, design_h)
+            width, height = round(design_w * scale), round(design_h * scale)
+    except ValueError:
+        raise SceneError(f"Tamaño inválido: {value}")
+    if not (MIN_VARIANT_SIDE <= width <= MAX_VARIANT_SIDE and MIN_VARIANT_SIDE <= height <= MAX_VARIANT_SIDE):
+        raise SceneError(f"El tamaño debe estar entre {MIN_VARIANT_SIDE} y {MAX_VARIANT_SIDE} px")
+    return width, height
+
+
+def variant_key(scene, params):
+    """Clave estable de una variante: escena (su contenido) + parámetros"""
+    raw = json.dumps({"scene": scene, "params": params}, sort_keys=True).encode()
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+
+# ---------- biblioteca ----------
+
+class SceneLibrary:
+    """Escenas cargadas de un directorio y sus variantes renderizadas en disco"""
+
+    def __init__(self, scenes_dir, variants_dir, max_variants=DEFAULT_MAX_VARIANTS):
+        self.scenes_dir = Path(scenes_dir)
+        self.variants_dir = Path(variants_dir)
+        self.max_variants = max_variants
+        self.scenes = {}
+        self.rendered = 0
+        self.hits = 0
+
+    def load(self):
+        """Leer y validar las escenas de ``scenes_dir``"""
+        scenes = {}
+        for path in sorted(self.scenes_dir.glob("*.json")):
+            try:
+                scene = validate_scene(json.loads(path.read_text(encoding="utf-8")))
+            except (OSError, ValueError) as e:
+                print(f"Escena inválida {path.name}: {e}")
+                continue
+            scenes[scene["id"]] = scene
+        self.scenes = scenes
+        self.variants_dir.mkdir(parents=True, exist_ok=True)
+        return len(scenes)
+
+    def get(self, scene_id):
+        scene = self.scenes.get(scene_id)
+        if scene is None:
+            raise KeyError(scene_id)
+        return scene
+
+    def variant_id(self, scene_id, params):
+        return f"{scene_id}@{variant_key(self.get(scene_id), params)}"
+
+    def variant_path(self, variant_id):
+        return self.variants_dir / f"{variant_id}.gif"
+
+    def render_to(self, scene_id, params, output_path, map_fn=map):
+        """Renderizar una escena con ``params`` a ``output_path`` (con anotaciones)"""
+        scene = self.get(scene_id)
+        frames, face_boxes = render_scene(scene, params, map_fn)
+        save_scene_gif(scene, params, frames, face_boxes, output_path)
+        return output_path
+
+    def lookup(self, variant_id):
+        """Ruta de la variante si es un id válido y ya está en disco"""
+        match = VARIANT_ID.match(variant_id)
+        if not match or match.group(1) not in self.scenes:
+            return None
+        path = self.variant_path(variant_id)
+        if path.exists():
+            self.hits += 1
+            return path
+        return None
+
+    def store(self, variant_id, params, frames, face_boxes):
+        """Guardar una variante ya renderizada (GIF y anotaciones)"""
+        scene = self.get(variant_id.split("@", 1)[0])
+        path = self.variant_path(variant_id)
+        save_scene_gif(scene, params, frames, face_boxes, path)
+        self.rendered += 1
+        self._evict()
+        return path
+
+    def _evict(self):
+        """Borrar las variantes más viejas si hay más de ``max_variants``"""
+        variants = sorted(self.variants_dir.glob("*@*.gif"), key=lambda p: p.stat().st_mtime)
+        for old in variants[:max(0, len(variants) - self.max_variants)]:
+            old.unlink(missing_ok=True)
+            annotation_path(old).unlink(missing_ok=True)
+
+    def describe(self):
+        """Catálogo de escenas para la API"""
+        return [
+            {
+                "id": scene["id"],
+                "name": scene.get("name", scene["id"].replace("_", " ").title()),
+                "category": scene.get("category", "general"),
+                "size": scene["size"],
+                "frames": scene["frames"],
+                "duration_ms": scene["duration"] * scene["frames"],
+                "params": scene.get("params", {}),
+            }
+            for scene in self.scenes.values()
+        ]
+
+    def stats(self):
+        return {"scenes": len(self.scenes), "rendered": self.rendered, "hits": self.hits}
@@ -0,0 +1,95 @@
+"""Caché LRU en memoria de templates ya decodificados.
+
+La clave es (ruta, mtime, tamaño) del archivo, así que sobrescribir un template
+con /upload-template invalida la entrada vieja automáticamente: la nueva
+versión simplemente no coincide y la vieja termina saliendo por LRU.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from compositor import decode_template
+
+DEFAULT_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+
+def template_key(path):
+    """Clave de caché para la versión actual del archivo en disco"""
+    path = Path(path)
+    stat = path.stat()
+    return str(path.resolve()), stat.st_mtime_ns, stat.st_size
+
+
+class TemplateCache:
+    """LRU acotado por bytes de frames decodificados (no por número de entradas)"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes_in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Devolver el DecodedTemplate de ``path``, decodificándolo si hace falta"""
+        key = template_key(path)
+        with self._lock:
+            template = self._entries.get(key)
+            if template is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        # Decodificar fuera del lock para no bloquear otras peticiones
+        template = decode_template(path)
+        self._put(key, template)
+        return template
+
+    def _put(self, key, template):
+        with self._lock:
+            if key in self._entries:
+                return
+            # Quitar versiones anteriores del mismo archivo
+            for old_key in [k for k in self._entries if k[0] == key[0]]:
+                self.bytes_in_use -= self._entries.pop(old_key).nbytes
+            if template.nbytes > self.max_bytes:
+                return
+            self._entries[key] = template
+            self.bytes_in_use += template.nbytes
+            while self.bytes_in_use > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes_in_use -= evicted.nbytes
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Eliminar todas las versiones cacheadas de un template"""
+        resolved = str(Path(path).resolve())
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == resolved]:
+                self.bytes_in_use -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes_in_use = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes_in_use": self.bytes_in_use,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Instancia compartida por el proceso
+template_cache = TemplateCache()
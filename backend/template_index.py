@@ -0,0 +1,225 @@
+"""Índice persistente del catálogo de templates.
+
+Se construye una vez al arrancar (reutilizando lo guardado en disco para los
+archivos que no cambiaron) y se mantiene al día cuando se sube un template o
+cuando cambia el contenido de TEMPLATES_DIR. Las consultas del catálogo se
+responden desde memoria, sin recorrer el directorio.
+"""
+import hashlib
+import json
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from PIL import Image
+
+INDEX_FORMAT_VERSION = 1
+
+
+def file_version(file_size, mtime_ns):
+    """Identificador corto de la versión de un archivo en disco"""
+    raw = f"{file_size}:{mtime_ns}".encode()
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+
+@dataclass
+class TemplateEntry:
+    id: str
+    name: str
+    file_name: str
+    category: str
+    frame_count: int
+    width: int
+    height: int
+    duration_ms: int
+    file_size: int
+    mtime_ns: int
+
+    @property
+    def version(self):
+        return file_version(self.file_size, self.mtime_ns)
+
+    def to_public(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "thumbnail": f"/thumbnails/{self.id}?v={self.version}",
+            "preview": f"/thumbnails/{self.id}/preview?v={self.version}",
+            "gif_path": f"/templates/{self.file_name}?v={self.version}",
+            "category": self.category,
+            "frame_count": self.frame_count,
+            "width": self.width,
+            "height": self.height,
+            "duration_ms": self.duration_ms,
+            "file_size": self.file_size,
+            "version": self.version,
+        }
+
+
+def read_template_entry(path, category="general"):
+    """Leer los metadatos de un GIF sin decodificar los píxeles"""
+    stat = path.stat()
+    with Image.open(path) as im:
+        width, height = im.size
+        frame_count = getattr(im, "n_frames", 1)
+        duration_ms = 0
+        for i in range(frame_count):
+            im.seek(i)
+            duration_ms += im.info.get("duration", 0) or 0
+    return TemplateEntry(
+        id=path.stem,
+        name=path.stem.replace("_", " ").title(),
+        file_name=path.name,
+        category=category,
+        frame_count=frame_count,
+        width=width,
+        height=height,
+        duration_ms=duration_ms,
+        file_size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+    )
+
+
+class TemplateIndex:
+    """Catálogo de templates en memoria, respaldado por un archivo JSON"""
+
+    def __init__(self, templates_dir, index_path, default_categories=None):
+        self.templates_dir = Path(templates_dir)
+        self.index_path = Path(index_path)
+        self.default_categories = default_categories or {}
+        self._entries = {}
+        self._sorted = []
+        self._dir_mtime_ns = None
+        self._etag = '"empty"'
+        self._lock = threading.Lock()
+
+    # ---------- construcción y persistencia ----------
+
+    def _load_saved(self):
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if data.get("format") != INDEX_FORMAT_VERSION:
+            return {}
+        saved = {}
+        for raw in data.get("templates", []):
+            try:
+                entry = TemplateEntry(**raw)
+            except TypeError:
+                continue
+            saved[entry.id] = entry
+        return saved
+
+    def _save(self):
+        data = {
+            "format": INDEX_FORMAT_VERSION,
+            "templates": [asdict(entry) for entry in self._sorted],
+        }
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data), encoding="utf-8")
+        tmp_path.replace(self.index_path)
+
+    def _rebuild_views(self):
+        self._sorted = sorted(self._entries.values(), key=lambda e: e.id)
+        digest = hashlib.sha1()
+        for entry in self._sorted:
+            digest.update(f"{entry.id}:{entry.version}:{entry.category};".encode())
+        self._etag = f'"{digest.hexdigest()[:16]}"'
+
+    def load(self):
+        """Construir el índice al arrancar, reutilizando lo ya guardado en disco"""
+        with self._lock:
+            self._entries = self._load_saved()
+            self._scan()
+
+    def _scan(self):
+        """Sincronizar las entradas con el directorio (sólo relee lo que cambió)"""
+        try:
+            self._dir_mtime_ns = self.templates_dir.stat().st_mtime_ns
+        except OSError:
+            self._dir_mtime_ns = None
+        current = {}
+        for path in self.templates_dir.glob("*.gif"):
+            entry = self._entries.get(path.stem)
+            try:
+                stat = path.stat()
+                if (entry is None or entry.file_size != stat.st_size
+                        or entry.mtime_ns != stat.st_mtime_ns):
+                    category = entry.category if entry else self._default_category(path.stem)
+                    entry = read_template_entry(path, category)
+            except Exception as e:
+                print(f"Error indexando template {path.name}: {e}")
+                continue
+            current[entry.id] = entry
+        changed = current != self._entries
+        self._entries = current
+        self._rebuild_views()
+        if changed or not self.index_path.exists():
+            self._save()
+
+    def _default_category(self, template_id):
+        return self.default_categories.get(template_id, "general")
+
+    def refresh_if_stale(self):
+        """Re-escanear sólo si el directorio cambió (un stat por consulta)"""
+        try:
+            dir_mtime_ns = self.templates_dir.stat().st_mtime_ns
+        except OSError:
+            return
+        if dir_mtime_ns != self._dir_mtime_ns:
+            with self._lock:
+                self._scan()
+
+    def refresh(self):
+        with self._lock:
+            self._scan()
+
+    def update(self, path, category=None):
+        """Registrar (o actualizar) un template recién escrito en disco"""
+        path = Path(path)
+        with self._lock:
+            previous = self._entries.get(path.stem)
+            if category is None:
+                category = previous.category if previous else self._default_category(path.stem)
+            entry = read_template_entry(path, category)
+            self._entries[entry.id] = entry
+            self._rebuild_views()
+            self._save()
+        return entry
+
+    # ---------- consultas ----------
+
+    @property
+    def etag(self):
+        return self._etag
+
+    def query_etag(self, *params):
+        """ETag de una consulta concreta: versión del índice + parámetros"""
+        raw = f"{self._etag}:{params!r}".encode()
+        return f'"{hashlib.sha1(raw).hexdigest()[:16]}"'
+
+    def get(self, template_id):
+        return self._entries.get(template_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def query(self, category=None, prefix=None, offset=0, limit=None):
+        """Filtrar por categoría y prefijo de nombre; devuelve (total, página)"""
+        entries = self._sorted
+        if category:
+            entries = [e for e in entries if e.category == category]
+        if prefix:
+            prefix = prefix.lower()
+            entries = [
+                e for e in entries
+                if e.id.lower().startswith(prefix) or e.name.lower().startswith(prefix)
+            ]
+        total = len(entries)
+        end = None if limit is None else offset + limit
+        return total, entries[offset:end]
+
+    def categories(self):
+        return sorted({e.category for e in self._sorted})
@@ -0,0 +1,5 @@
+"""Los módulos del backend son planos: hacerlos importables desde los tests"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from compositor import decode_template
+from face_annotations import annotation_path, load_face_track
+from face_detector import detect_face_track, ensure_face_annotations, head_tilt, no_face_path, skin_mask
+
+SKIN = (255, 219, 172, 255)
+BACKGROUND = (0, 0, 128, 255)
+
+
+def head_frames(tilt=0.0, size=(30, 45), n_frames=6):
+    """Óvalo color piel que se desplaza sobre un fondo azul, rotado ``tilt`` grados (antihorario)"""
+    frames = []
+    for i in range(n_frames):
+        image = Image.new("RGBA", (200, 200), BACKGROUND)
+        head = Image.new("RGBA", (60, 60), (0, 0, 0, 0))
+        w, h = size
+        ImageDraw.Draw(head).ellipse([30 - w / 2, 30 - h / 2, 30 + w / 2, 30 + h / 2], fill=SKIN)
+        image.alpha_composite(head.rotate(tilt, resample=Image.BICUBIC), (70 + 3 * i, 60))
+        frames.append(np.asarray(image.convert("RGB")))
+    return np.stack(frames)
+
+
+def test_skin_mask_separates_skin_from_background():
+    frames = head_frames()
+    mask = skin_mask(frames)
+    assert mask[0, 90, 100]
+    assert not mask[0, 5, 5]
+
+
+def test_upright_head_has_no_rotation():
+    track = detect_face_track(head_frames())
+    assert track is not None
+    assert np.allclose(track.angles, 0.0, atol=2.0)
+    x, y, w, h = track.boxes[0]
+    assert h > w
+    assert abs(x + w / 2 - 100) <= 3 and abs(y + h / 2 - 90) <= 3
+
+
+def test_wide_head_has_no_rotation():
+    track = detect_face_track(head_frames(size=(45, 30)))
+    assert np.allclose(track.angles, 0.0, atol=2.0)
+
+
+@pytest.mark.parametrize("tilt", [15.0, -20.0, 35.0])
+def test_tilted_head_reports_its_tilt(tilt):
+    track = detect_face_track(head_frames(tilt))
+    assert np.allclose(track.angles, tilt, atol=2.5)
+
+
+def test_near_vertical_axis_does_not_flip_sign():
+    # Eje mayor a ±90° del eje x según el ruido: siempre es una cabeza derecha
+    angles = head_tilt(np.array([10.0, 10.0]), np.array([20.0, 20.0]), np.array([0.01, -0.01]))
+    assert np.allclose(angles, 0.0, atol=0.5)
+
+
+def test_no_skin_returns_none():
+    frames = np.zeros((3, 50, 50, 3), dtype=np.uint8)
+    assert detect_face_track(frames) is None
+
+
+class CountingCache:
+    def __init__(self):
+        self.loads = 0
+
+    def get(self, path):
+        self.loads += 1
+        return decode_template(path)
+
+
+def save_gif(path, frames):
+    images = [Image.fromarray(frame) for frame in frames]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=100, loop=0)
+
+
+def test_ensure_annotations_remembers_templates_without_face(tmp_path):
+    gif = tmp_path / "t.gif"
+    cache = CountingCache()
+    save_gif(gif, head_frames())
+    assert ensure_face_annotations(gif, cache).source == "detector"
+    assert annotation_path(gif).exists()
+
+    # Nueva versión sin cara: se borra la detección vieja y se anota la versión
+    save_gif(gif, np.full((4, 120, 120, 3), BACKGROUND[:3], dtype=np.uint8))
+    assert ensure_face_annotations(gif, cache) is None
+    assert not annotation_path(gif).exists()
+    assert no_face_path(gif).exists()
+    loads = cache.loads
+    assert ensure_face_annotations(gif, cache) is None
+    assert cache.loads == loads
+
+    # Otra versión con cara: se vuelve a detectar y la marca se va
+    save_gif(gif, head_frames(n_frames=4))
+    assert ensure_face_annotations(gif, cache).source == "detector"
+    assert load_face_track(gif) is not None
+    assert not no_face_path(gif).exists()
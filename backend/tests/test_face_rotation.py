@@ -0,0 +1,142 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from compositor import (
+    ALPHA_ONE, MAX_DETECTED_TILT, decode_template, elliptical_mask, face_boxes_for, iter_swap,
+    render_swap, warp_face, warp_faces, warp_grid
+)
+from face_annotations import FaceTrack, load_face_track, save_face_annotations, write_face_track
+from scenes import default_params, render_scene, save_scene_gif, validate_scene
+
+
+def write_template(path, n_frames=4, size=(120, 120)):
+    frames = [Image.new("RGB", size, (40 * i, 90, 160)) for i in range(n_frames)]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return path
+
+
+def apng_frames(data):
+    with Image.open(io.BytesIO(data)) as im:
+        frames = []
+        for i in range(im.n_frames):
+            im.seek(i)
+            frames.append(np.asarray(im.convert("RGB")))
+    return np.stack(frames)
+
+
+@pytest.fixture
+def template_path(tmp_path):
+    return write_template(tmp_path / "tilted.gif")
+
+
+def test_annotated_angles_are_returned_per_frame(template_path):
+    save_face_annotations(template_path, (120, 120), [[40, 30, 40, 40]] * 4, [0, 12, 0, -12])
+    boxes, angles = face_boxes_for(template_path, decode_template(template_path))
+    assert boxes.shape == (4, 4)
+    assert angles.tolist() == [0, 12, 0, -12]
+
+
+def test_detector_angles_are_clamped(template_path):
+    boxes = np.array([[40, 30, 40, 40]] * 4, dtype=np.int32)
+    angles = np.array([0, 45, -80, 5], dtype=np.float32)
+    write_face_track(template_path, FaceTrack(120, 120, boxes, angles, source="detector"))
+    _, result = face_boxes_for(template_path, decode_template(template_path))
+    assert result.tolist() == [0, MAX_DETECTED_TILT, -MAX_DETECTED_TILT, 5]
+
+
+def test_templates_without_annotations_are_not_rotated(template_path):
+    boxes, angles = face_boxes_for(template_path, decode_template(template_path))
+    assert len(boxes) == 4
+    assert not angles.any()
+
+
+def face_bytes(size=(64, 80)):
+    """Cara sintética con un degradado, para que la rotación se note"""
+    ys, xs = np.mgrid[0:size[1], 0:size[0]]
+    pixels = np.stack([xs * 255 // size[0], ys * 255 // size[1], np.full_like(xs, 128)], axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_warp_face_without_rotation_is_identity():
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)
+    alpha = elliptical_mask((40, 30))
+    warped_rgb, warped_alpha = warp_face(rgb, alpha, 0.0)
+    assert np.array_equal(warped_rgb, rgb)
+    assert np.array_equal(warped_alpha, alpha)
+
+
+def test_warp_face_quarter_turn_is_counterclockwise():
+    rng = np.random.default_rng(1)
+    rgb = rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)
+    alpha = elliptical_mask((40, 30))
+    warped_rgb, warped_alpha = warp_face(rgb, alpha, 90.0)
+    assert warped_rgb.shape == (40, 30, 3)
+    assert np.array_equal(warped_rgb, np.rot90(rgb))
+    assert np.array_equal(warped_alpha, np.rot90(alpha))
+
+
+def test_warp_grid_is_cached_per_size_and_angle():
+    warp_grid.cache_clear()
+    first = warp_grid((24, 24), 12.5)
+    assert warp_grid((24, 24), 12.5) is first
+    assert warp_grid.cache_info().hits == 1
+    index, weights, _ = first
+    assert (weights.sum(axis=1) == ALPHA_ONE).all()
+
+
+def test_warp_faces_keeps_box_centres():
+    rgb = np.zeros((40, 40, 3), dtype=np.uint8)
+    fitted = {(40, 40): (rgb, elliptical_mask((40, 40)))}
+    boxes = np.array([[10, 10, 40, 40], [10, 10, 40, 40]], dtype=np.int32)
+    faces, placed, keys = warp_faces(fitted, boxes, [0.0, 30.0])
+    assert keys == [(40, 40, 0.0), (40, 40, 30.0)]
+    assert placed[0].tolist() == [10, 10, 40, 40]
+    x, y, w, h = placed[1]
+    assert w > 40 and h > 40
+    assert abs((x + w / 2) - 30) <= 1 and abs((y + h / 2) - 30) <= 1
+
+
+def test_tilted_annotations_rotate_the_rendered_face(tmp_path):
+    face = face_bytes()
+    straight = write_template(tmp_path / "straight.gif")
+    tilted = write_template(tmp_path / "tilted.gif")
+    save_face_annotations(straight, (120, 120), [[40, 30, 40, 40]] * 4)
+    save_face_annotations(tilted, (120, 120), [[40, 30, 40, 40]] * 4, [0, 20, 0, -20])
+
+    # APNG no cuantiza: los frames son exactamente los compuestos
+    straight_frames = apng_frames(render_swap(face, straight, output_format="apng"))
+    tilted_frames = apng_frames(render_swap(face, tilted, output_format="apng"))
+    assert np.array_equal(straight_frames[0], tilted_frames[0])
+    assert np.array_equal(straight_frames[2], tilted_frames[2])
+    assert not np.array_equal(straight_frames[1], tilted_frames[1])
+    assert not np.array_equal(tilted_frames[1], tilted_frames[3])
+    # Fuera de la zona de la cara el template no cambia
+    assert np.array_equal(straight_frames[:, :20], tilted_frames[:, :20])
+
+
+def test_streamed_render_matches_full_render_with_rotation(tmp_path):
+    face = face_bytes()
+    tilted = write_template(tmp_path / "tilted.gif")
+    save_face_annotations(tilted, (120, 120), [[40, 30, 40, 40]] * 4, [0, 20, 0, -20])
+    assert b"".join(iter_swap(face, tilted)) == render_swap(face, tilted)
+
+
+def test_scene_face_tilt_is_written_to_annotations(tmp_path):
+    scene = {
+        "id": "tilt_test", "size": [80, 80], "frames": 3, "duration": 100,
+        "background": "blue", "face": "head", "face_tilt": {"cycle": [0, 10, -10]},
+        "shapes": [{"id": "head", "type": "ellipse", "fill": "beige", "box": [20, 20, 60, 60]}],
+    }
+    params = default_params(validate_scene(scene))
+    frames, face_boxes = render_scene(scene, params)
+    path = tmp_path / "tilt_test.gif"
+    save_scene_gif(scene, params, frames, face_boxes, path)
+    track = load_face_track(path)
+    assert track.angles.tolist() == [0, 10, -10]
+    assert track.boxes[0].tolist() == [20, 20, 40, 40]
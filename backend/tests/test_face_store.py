@@ -0,0 +1,101 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import face_store as face_store_module
+from compositor import FACE_MAX_SIDE, QUALITY_TIERS, PreparedFace, load_face, preprocess_face, render_swap
+from face_store import FaceStore, face_id_for
+
+
+def prepared(nbytes):
+    return PreparedFace(image=np.zeros(nbytes, dtype=np.uint8))
+
+
+def face_png(size=(900, 700)):
+    rng = np.random.default_rng(4)
+    pixels = rng.integers(0, 256, (size[1] // 10, size[0] // 10, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize(size, Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(face_store_module.time, "time", lambda: now[0])
+    return now
+
+
+def test_same_bytes_same_id():
+    assert face_id_for(b"\x01" * 32) == face_id_for(b"\x01" * 32)
+    assert len(face_id_for(b"\x01" * 32)) == 32
+
+
+def test_evicts_least_recently_used(clock):
+    store = FaceStore(max_bytes=250, ttl_seconds=60)
+    first = store.put(b"a" * 32, prepared(100))
+    second = store.put(b"b" * 32, prepared(100))
+    assert store.get(first.face_id) is first  # ahora "b" es el más viejo
+    store.put(b"c" * 32, prepared(100))
+    assert store.get(second.face_id) is None
+    assert store.get(first.face_id) is first
+    stats = store.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes_in_use"] == 200
+    assert stats["evictions"] == 1
+
+
+def test_too_large_face_is_not_kept(clock):
+    store = FaceStore(max_bytes=50, ttl_seconds=60)
+    stored = store.put(b"a" * 32, prepared(100))
+    assert stored.prepared.nbytes == 100
+    assert store.get(stored.face_id) is None
+    assert store.stats()["bytes_in_use"] == 0
+
+
+def test_entries_expire_after_last_use(clock):
+    store = FaceStore(max_bytes=1000, ttl_seconds=60)
+    stored = store.put(b"a" * 32, prepared(10))
+    clock[0] += 50
+    assert store.get(stored.face_id) is stored  # renueva el vencimiento
+    clock[0] += 50
+    assert store.get(stored.face_id) is stored
+    clock[0] += 61
+    assert store.get(stored.face_id) is None
+    stats = store.stats()
+    assert stats["expirations"] == 1
+    assert stats["bytes_in_use"] == 0
+
+
+def test_reupload_replaces_entry(clock):
+    store = FaceStore(max_bytes=1000, ttl_seconds=60)
+    store.put(b"a" * 32, prepared(10))
+    store.put(b"a" * 32, prepared(30))
+    assert store.stats()["entries"] == 1
+    assert store.stats()["bytes_in_use"] == 30
+
+
+def test_load_face_reduces_normalized_face():
+    data = face_png()
+    normalized = np.asarray(load_face(data))
+    assert max(normalized.shape[:2]) == FACE_MAX_SIDE
+    side = QUALITY_TIERS["preview"]["face_side"]
+    from_array = np.asarray(load_face(normalized, side))
+    assert max(from_array.shape[:2]) == side
+    assert np.array_equal(from_array, np.asarray(load_face(preprocess_face(data), side)))
+    assert np.array_equal(from_array, np.asarray(load_face(data, side)))
+
+
+@pytest.mark.parametrize("quality", ["preview", "full"])
+def test_face_id_renders_like_upload(tmp_path, quality):
+    template = tmp_path / "t.gif"
+    frames = [Image.new("RGB", (120, 120), (40 * i, 90, 160)) for i in range(3)]
+    frames[0].save(template, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    data = face_png()
+    face = preprocess_face(data, sizes=[(24, 24)])
+    uploaded = render_swap(data, template, output_format="apng", quality=quality)
+    by_id = render_swap(face, template, output_format="apng", quality=quality)
+    assert uploaded == by_id
@@ -0,0 +1,90 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from gif_encoder import (
+    MAX_TEMPLATE_COLORS, IndexedGifEncoder, PaletteMapper, build_template_palette, iter_indexed_gif,
+    pack_rgb
+)
+
+
+def palette_frames(n_frames=5, size=(24, 32)):
+    rng = np.random.default_rng(1)
+    colors = rng.integers(0, 256, (40, 3), dtype=np.uint8)
+    choice = rng.integers(0, len(colors), (n_frames, *size))
+    return colors[choice]
+
+
+def decode(data):
+    with Image.open(io.BytesIO(data)) as im:
+        frames = []
+        for i in range(im.n_frames):
+            im.seek(i)
+            frames.append(np.asarray(im.convert("RGB")))
+    return np.stack(frames)
+
+
+def test_palette_matches_sorted_unique_colors():
+    frames = palette_frames()
+    colors, indices = build_template_palette(frames)
+    expected, inverse = np.unique(pack_rgb(frames).ravel(), return_inverse=True)
+    assert np.array_equal(pack_rgb(colors), expected)
+    assert np.array_equal(indices.ravel(), inverse.ravel())
+    assert np.array_equal(colors[indices], frames)
+
+
+def test_palette_gives_up_on_too_many_colors():
+    rng = np.random.default_rng(2)
+    frames = rng.integers(0, 256, (3, 64, 64, 3), dtype=np.uint8)
+    assert build_template_palette(frames) == (None, None)
+
+
+def test_palette_gives_up_when_colors_accumulate_across_frames():
+    # Cada frame tiene pocos colores, pero entre todos pasan del límite
+    per_frame = MAX_TEMPLATE_COLORS // 2 + 1
+    values = np.arange(3 * per_frame, dtype=np.uint32)
+    frames = np.stack([
+        np.stack([values[i::3] & 255, values[i::3] >> 8, np.full(per_frame, 7)], axis=1)
+        .astype(np.uint8).reshape(1, per_frame, 3)
+        for i in range(3)
+    ])
+    assert build_template_palette(frames) == (None, None)
+    assert build_template_palette(frames[:1])[0] is not None
+
+
+def test_mapper_is_exact_for_palette_colors_and_nearest_otherwise():
+    palette = np.array([[0, 0, 0], [255, 255, 255], [200, 10, 10]], dtype=np.uint8)
+    mapper = PaletteMapper(palette)
+    assert list(mapper.map(palette)) == [0, 1, 2]
+    assert list(mapper.map(np.array([[250, 250, 250], [190, 20, 5]], dtype=np.uint8))) == [1, 2]
+
+
+def test_encoder_only_sends_changed_rectangle():
+    palette = np.array([[0, 0, 0], [255, 0, 0], [0, 255, 0]], dtype=np.uint8)
+    encoder = IndexedGifEncoder((20, 10), palette)
+    first = np.zeros((10, 20), dtype=np.uint8)
+    second = first.copy()
+    second[3:5, 6:9] = 1
+    second[4, 6] = 0  # igual al anterior dentro del rectángulo: transparente
+    encoder.frame(first, 100)
+    data = encoder.frame(second, 100)
+    # Descriptor de imagen: posición y tamaño del rectángulo que cambió
+    start = data.index(b",")
+    assert data[start + 1:start + 9] == bytes([6, 0, 3, 0, 3, 0, 2, 0])
+    assert encoder.transparent_index == len(palette)
+
+
+def test_encoded_gif_decodes_to_frames():
+    palette = np.array([[0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255]], dtype=np.uint8)
+    rng = np.random.default_rng(3)
+    base = rng.integers(0, len(palette), (12, 16)).astype(np.uint8)
+    frames = [base, base.copy(), base.copy(), base.copy()]
+    frames[1][2:6, 3:7] = 2
+    frames[3][0, 0] = 3
+    data = b"".join(iter_indexed_gif(frames, palette, [80, 80, 80, 80]))
+    decoded = decode(data)
+    assert len(decoded) == len(frames)
+    assert np.array_equal(decoded, palette[np.stack(frames)])
+    with Image.open(io.BytesIO(data)) as im:
+        assert im.info["loop"] == 0
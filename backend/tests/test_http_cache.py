@@ -0,0 +1,108 @@
+import asyncio
+import os
+
+import pytest
+from starlette.datastructures import Headers
+
+from http_cache import cached_file_response, etag_matches, file_etag, negotiate_media_type, parse_range
+
+
+def body(response):
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "out.gif"
+    path.write_bytes(bytes(range(100)))
+    return path
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=95-200", (95, 99)),
+    (" bytes=5-5 ", (5, 5)),
+    ("bytes=-", None),
+    ("items=0-9", None),
+    ("bytes=0-9,20-29", None),
+    ("bytes=50-10", None),
+    ("bytes=abc", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=100-200", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+@pytest.mark.parametrize("if_none_match, expected", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", "abc"', True),
+    ("*", True),
+    ('"abcd"', False),
+    ('"x", "y"', False),
+])
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, '"abc"') is expected
+
+
+def test_not_modified(data_file):
+    etag = file_etag(os.stat(data_file))
+    response = cached_file_response(Headers({"if-none-match": f'"other", {etag}'}), data_file)
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+def test_range_returns_partial_content(data_file):
+    response = cached_file_response(Headers({"range": "bytes=10-19"}), data_file, media_type="image/gif")
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 10-19/100"
+    assert response.headers["content-length"] == "10"
+    assert body(response) == bytes(range(10, 20))
+
+
+def test_unsatisfiable_range(data_file):
+    response = cached_file_response(Headers({"range": "bytes=200-"}), data_file)
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */100"
+
+
+@pytest.mark.parametrize("header", ["bytes=50-10", "bytes=x-y", "pages=1-2"])
+def test_invalid_range_is_ignored(data_file, header):
+    response = cached_file_response(Headers({"range": header}), data_file)
+    assert response.status_code == 200
+    assert "content-range" not in response.headers
+
+
+def test_if_range_with_current_etag_honours_range(data_file):
+    etag = file_etag(os.stat(data_file))
+    response = cached_file_response(Headers({"range": "bytes=-5", "if-range": etag}), data_file)
+    assert response.status_code == 206
+    assert body(response) == bytes(range(95, 100))
+
+
+@pytest.mark.parametrize("if_range", ['"stale"', "W/{etag}"])
+def test_if_range_mismatch_sends_whole_file(data_file, if_range):
+    etag = file_etag(os.stat(data_file))
+    headers = Headers({"range": "bytes=0-9", "if-range": if_range.format(etag=etag)})
+    response = cached_file_response(headers, data_file)
+    assert response.status_code == 200
+    assert "content-range" not in response.headers
+
+
+def test_negotiate_prefers_explicit_type():
+    offered = ["image/gif", "image/webp", "image/apng"]
+    assert negotiate_media_type("image/webp,image/*;q=0.8", offered) == "image/webp"
+    assert negotiate_media_type("image/*", offered) == "image/gif"
+    assert negotiate_media_type("image/gif;q=0, */*;q=0.1", offered) == "image/webp"
+    assert negotiate_media_type("text/html", offered) is None
+    assert negotiate_media_type(None, offered) == "image/gif"
@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from jobs import DONE, FAILED, JobManager, QueueFullError
+
+
+class Rejected(Exception):
+    status_code = 422
+    detail = "cara inválida"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_same_key_shares_one_render():
+    async def scenario():
+        manager = JobManager(max_concurrency=2)
+        calls = []
+        release = asyncio.Event()
+
+        async def work(job):
+            calls.append(job.id)
+            await release.wait()
+            return {"url": "/outputs/a.gif"}
+
+        first = manager.submit(work, key="k")
+        second = manager.submit(work, key="k")
+        other = manager.submit(work, key="other")
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first.wait(), other.wait())
+        return manager, calls, first, second, other
+
+    manager, calls, first, second, other = run(scenario())
+    assert second is first
+    assert other is not first
+    assert len(calls) == 2
+    assert first.status == DONE and first.result == {"url": "/outputs/a.gif"}
+    assert manager.stats()["coalesced"] == 1
+    assert manager.stats()["submitted"] == 2
+
+
+def test_key_is_released_when_job_finishes():
+    async def scenario():
+        manager = JobManager()
+
+        async def work(job):
+            return {}
+
+        first = manager.submit(work, key="k")
+        await first.wait()
+        return first, manager.submit(work, key="k")
+
+    first, second = run(scenario())
+    assert second is not first
+
+
+def test_failure_is_shared_and_releases_key():
+    async def scenario():
+        manager = JobManager()
+        cleaned = []
+
+        async def work(job):
+            await asyncio.sleep(0)
+            raise Rejected()
+
+        job = manager.submit(work, on_finish=lambda: cleaned.append(True), key="k")
+        assert manager.submit(work, key="k") is job
+        await job.wait()
+        return manager, job, cleaned
+
+    manager, job, cleaned = run(scenario())
+    assert job.status == FAILED
+    assert job.error == "cara inválida"
+    assert job.error_status == 422
+    assert cleaned == [True]
+    assert manager.active("k") is None
+
+
+def test_concurrency_is_bounded():
+    async def scenario():
+        manager = JobManager(max_concurrency=2)
+        running = 0
+        peak = 0
+
+        async def work(job):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return {}
+
+        jobs = [manager.submit(work) for _ in range(6)]
+        await asyncio.gather(*(job.wait() for job in jobs))
+        return peak, jobs
+
+    peak, jobs = run(scenario())
+    assert peak == 2
+    assert all(job.status == DONE for job in jobs)
+
+
+def test_queue_limit_does_not_count_coalesced_requests():
+    async def scenario():
+        manager = JobManager(max_concurrency=1, max_queued=1)
+        release = asyncio.Event()
+
+        async def work(job):
+            await release.wait()
+            return {}
+
+        job = manager.submit(work, key="k")
+        assert manager.submit(work, key="k") is job
+        with pytest.raises(QueueFullError):
+            manager.submit(work, key="other")
+        release.set()
+        await job.wait()
+
+    run(scenario())
+
+
+def test_finished_records_expire(monkeypatch):
+    import jobs as jobs_module
+
+    now = [1000.0]
+    monkeypatch.setattr(jobs_module.time, "time", lambda: now[0])
+
+    async def scenario():
+        manager = JobManager(ttl_seconds=60)
+
+        async def work(job):
+            return {}
+
+        job = manager.submit(work)
+        await job.wait()
+        cached = manager.finished_job({"url": "/outputs/b.gif"})
+        assert manager.get(job.id) is job
+        now[0] += 61
+        return manager, job, cached
+
+    manager, job, cached = run(scenario())
+    assert manager.get(job.id) is None
+    assert manager.get(cached.id) is None
+    assert manager.stats()["expired"] == 2
+
+
+def test_busy_does_not_count_as_coalesced():
+    async def scenario():
+        manager = JobManager()
+        release = asyncio.Event()
+
+        async def work(job):
+            await release.wait()
+            return {}
+
+        job = manager.submit(work, key="k")
+        assert manager.busy("k") and not manager.busy("other")
+        release.set()
+        await job.wait()
+        return manager
+
+    manager = run(scenario())
+    assert not manager.busy("k")
+    assert manager.stats()["coalesced"] == 0
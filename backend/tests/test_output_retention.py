@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+import pytest
+
+import output_retention as output_retention_module
+from output_retention import OutputRetention
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [10_000.0]
+    monkeypatch.setattr(output_retention_module.time, "time", lambda: now[0])
+    return now
+
+
+def write(path, size, mtime=None):
+    path.write_bytes(b"x" * size)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_scan_skips_temporary_files_and_orders_by_mtime(tmp_path):
+    write(tmp_path / "new.gif", 10, mtime=2000)
+    write(tmp_path / "old.gif", 20, mtime=1000)
+    write(tmp_path / ".render.gif", 5)
+    write(tmp_path / "half.gif.tmp", 5)
+    retention = OutputRetention(tmp_path, max_bytes=100, max_age_seconds=3600)
+    assert retention.scan() == 2
+    assert list(retention._entries) == ["old.gif", "new.gif"]
+    assert retention.stats()["bytes_in_use"] == 30
+
+
+def test_sweep_expires_unused_results(tmp_path, clock):
+    retention = OutputRetention(tmp_path, max_bytes=1000, max_age_seconds=100)
+    old = write(tmp_path / "old.gif", 10)
+    retention.record(old)
+    clock[0] += 60
+    fresh = write(tmp_path / "fresh.gif", 10)
+    retention.record(fresh)
+    clock[0] += 50
+    assert retention.sweep() == 1
+    assert not old.exists() and fresh.exists()
+    stats = retention.stats()
+    assert stats["expirations"] == 1
+    assert stats["bytes_freed"] == 10
+    assert stats["bytes_in_use"] == 10
+
+
+def test_touch_keeps_result_alive(tmp_path, clock):
+    retention = OutputRetention(tmp_path, max_bytes=1000, max_age_seconds=100)
+    path = write(tmp_path / "a.gif", 10)
+    retention.record(path)
+    clock[0] += 90
+    retention.touch("a.gif")
+    clock[0] += 90
+    assert retention.sweep() == 0
+    assert path.exists()
+
+
+def test_sweep_evicts_least_recently_used_over_budget(tmp_path, clock):
+    retention = OutputRetention(tmp_path, max_bytes=15, max_age_seconds=3600)
+    paths = [write(tmp_path / f"{name}.gif", 10) for name in "abc"]
+    for path in paths:
+        retention.record(path)
+        clock[0] += 1
+    retention.touch("a.gif")
+    assert retention.sweep() == 2
+    assert [path.exists() for path in paths] == [True, False, False]
+    assert retention.stats()["evictions"] == 2
+    assert retention.stats()["bytes_in_use"] == 10
+
+
+def test_rewrite_replaces_size(tmp_path, clock):
+    retention = OutputRetention(tmp_path, max_bytes=1000, max_age_seconds=3600)
+    path = write(tmp_path / "a.gif", 10)
+    retention.record(path)
+    write(path, 40)
+    retention.record(path)
+    assert retention.stats()["bytes_in_use"] == 40
+    assert retention.stats()["files"] == 1
+
+
+def test_sweep_tolerates_files_deleted_behind_its_back(tmp_path, clock):
+    retention = OutputRetention(tmp_path, max_bytes=1000, max_age_seconds=10)
+    path = write(tmp_path / "a.gif", 10)
+    retention.record(path)
+    path.unlink()
+    clock[0] += 20
+    assert retention.sweep() == 1
+    assert retention.stats()["bytes_in_use"] == 0
+    assert retention.stats()["bytes_freed"] == 0
+
+
+def test_touch_registers_unknown_file(tmp_path, clock):
+    retention = OutputRetention(tmp_path, max_bytes=1000, max_age_seconds=10)
+    write(tmp_path / "late.gif", 7)
+    retention.touch("late.gif")
+    retention.touch("missing.gif")
+    assert retention.stats()["files"] == 1
+    assert retention.stats()["bytes_in_use"] == 7
+
+
+def test_start_scans_and_sweeps_in_the_background(tmp_path):
+    old = write(tmp_path / "old.gif", 10, mtime=1000)
+    fresh = write(tmp_path / "fresh.gif", 10)
+    retention = OutputRetention(tmp_path, max_bytes=1000, max_age_seconds=3600, sweep_seconds=60)
+
+    async def scenario():
+        retention.start()
+        assert retention.stats()["sweeps"] == 0  # start() sólo programa la tarea
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if retention.stats()["sweeps"]:
+                break
+        await retention.stop()
+
+    asyncio.run(scenario())
+    assert not old.exists() and fresh.exists()
+    assert retention.stats()["files"] == 1
+    assert retention.stats()["sweeps"] == 1
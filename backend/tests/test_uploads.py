@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from uploads import (
+    CHUNK_SIZE, FACE_FORMATS, UploadLimitMiddleware, UploadRejected, read_limited, read_small,
+    sniff_image, spool_to_disk
+)
+
+PNG = b"\x89PNG\r\n\x1a\n"
+GIF = b"GIF89a"
+
+
+class FakeUpload:
+    """Lo mínimo de UploadFile: read(n) por bloques y el tamaño declarado"""
+
+    def __init__(self, data, size=None):
+        self.data = data
+        self.size = size
+        self.reads = 0
+
+    async def read(self, n=-1):
+        self.reads += 1
+        chunk, self.data = (self.data, b"") if n < 0 else (self.data[:n], self.data[n:])
+        return chunk
+
+
+def rejected(coro):
+    with pytest.raises(UploadRejected) as info:
+        asyncio.run(coro)
+    return info.value.status_code
+
+
+@pytest.mark.parametrize("head, kind", [
+    (b"\xff\xd8\xff\xe0", "jpeg"),
+    (PNG, "png"),
+    (b"GIF87a", "gif"),
+    (GIF, "gif"),
+    (b"RIFF\x00\x00\x00\x00WEBP", "webp"),
+    (b"BM", "bmp"),
+    (b"<svg", None),
+])
+def test_sniff_image(head, kind):
+    assert sniff_image(head) == kind
+
+
+def test_read_limited_returns_whole_file():
+    data = PNG + b"x" * (3 * CHUNK_SIZE)
+    assert asyncio.run(read_limited(FakeUpload(data), max_bytes=len(data))) == data
+
+
+def test_read_limited_rejects_by_declared_size_without_reading():
+    upload = FakeUpload(PNG, size=2048)
+    assert rejected(read_limited(upload, max_bytes=1024)) == 413
+    assert upload.reads == 0
+
+
+def test_read_limited_stops_at_limit():
+    upload = FakeUpload(PNG + b"x" * (10 * CHUNK_SIZE))
+    assert rejected(read_limited(upload, max_bytes=2 * CHUNK_SIZE)) == 413
+    assert upload.reads == 3
+
+
+def test_read_limited_rejects_wrong_type_on_first_chunk():
+    upload = FakeUpload(b"%PDF" + b"x" * (5 * CHUNK_SIZE))
+    assert rejected(read_limited(upload, allowed=FACE_FORMATS)) == 415
+    assert upload.reads == 1
+
+
+def test_read_limited_rejects_empty_file():
+    assert rejected(read_limited(FakeUpload(b""))) == 400
+
+
+def test_read_small():
+    assert asyncio.run(read_small(FakeUpload(b"{}"), max_bytes=10)) == b"{}"
+    assert rejected(read_small(FakeUpload(b"x" * 11), max_bytes=10)) == 413
+
+
+def test_spool_to_disk_moves_complete_file(tmp_path):
+    dest = tmp_path / "t.gif"
+    data = GIF + b"x" * (2 * CHUNK_SIZE)
+    assert asyncio.run(spool_to_disk(FakeUpload(data), dest, tmp_path)) == len(data)
+    assert dest.read_bytes() == data
+    assert [path.name for path in tmp_path.iterdir()] == ["t.gif"]
+
+
+def test_spool_to_disk_keeps_previous_file_on_rejection(tmp_path):
+    dest = tmp_path / "t.gif"
+    dest.write_bytes(b"previous")
+    upload = FakeUpload(GIF + b"x" * (4 * CHUNK_SIZE))
+    assert rejected(spool_to_disk(upload, dest, tmp_path, max_bytes=2 * CHUNK_SIZE)) == 413
+    assert rejected(spool_to_disk(FakeUpload(PNG), dest, tmp_path)) == 415
+    assert dest.read_bytes() == b"previous"
+    assert [path.name for path in tmp_path.iterdir()] == ["t.gif"]
+
+
+def test_spool_to_disk_validates_before_replacing(tmp_path):
+    dest = tmp_path / "t.gif"
+    dest.write_bytes(b"previous")
+    seen = []
+
+    def validate(path):
+        seen.append(path.read_bytes())
+        raise UploadRejected(400, "El archivo no es un GIF válido")
+
+    upload = FakeUpload(GIF + bytes(100))
+    assert rejected(spool_to_disk(upload, dest, tmp_path, validate=validate)) == 400
+    assert seen == [GIF + bytes(100)]
+    assert dest.read_bytes() == b"previous"
+    assert [path.name for path in tmp_path.iterdir()] == ["t.gif"]
+
+
+def call_middleware(limit, chunks, content_length=None, path="/upload"):
+    """Status de la respuesta y bytes que llegó a leer la app"""
+    sent = []
+    read = []
+
+    async def app(scope, receive, send):
+        while True:
+            message = await receive()
+            read.append(len(message.get("body", b"")))
+            if not message.get("more_body"):
+                break
+        # Como un parser multipart que falla con el cuerpo cortado
+        await send({"type": "http.response.start", "status": 400, "headers": []})
+        await send({"type": "http.response.body", "body": b"bad"})
+
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    headers = [] if content_length is None else [(b"content-length", str(content_length).encode())]
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+    asyncio.run(UploadLimitMiddleware(app, {"/upload": limit})(scope, receive, send))
+    return sent[0]["status"], sum(read)
+
+
+def test_middleware_rejects_declared_length_before_reading():
+    assert call_middleware(100, [b"x" * 50], content_length=500) == (413, 0)
+
+
+def test_middleware_counts_chunked_body():
+    status, read = call_middleware(100, [b"x" * 60, b"x" * 60, b"x" * 60])
+    assert status == 413
+    assert read == 60
+
+
+def test_middleware_passes_small_bodies_and_other_routes():
+    assert call_middleware(100, [b"x" * 60], content_length=60)[0] == 400
+    assert call_middleware(100, [b"x" * 500], path="/other") == (400, 500)
+
@@ -0,0 +1,128 @@
+import asyncio
+import signal
+import time
+
+import pytest
+
+import worker_pool
+from worker_pool import JobTimeoutError, SwapPool
+
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def stuck(seconds):
+    """Trabajo que no atiende SIGALRM, como uno trabado en código nativo"""
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+    try:
+        time.sleep(seconds)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGALRM})
+    return seconds
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def process_pool():
+    pools = []
+
+    def make(workers=1, job_timeout=1.0):
+        pool = SwapPool(workers=workers, job_timeout=job_timeout, max_tasks_per_worker=0)
+        pool.start()
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.shutdown()
+
+
+def test_queue_time_does_not_count_against_the_timeout(process_pool):
+    pool = process_pool(workers=1, job_timeout=1.0)
+
+    async def scenario():
+        await pool.run(nap, 0)  # levantar el worker antes de medir
+        return await asyncio.gather(*(pool.run(nap, 0.6) for _ in range(3)))
+
+    assert run(scenario()) == [0.6, 0.6, 0.6]
+    assert pool.timeouts == 0
+
+
+def test_slow_job_is_cut_by_the_worker_without_restarting(process_pool):
+    pool = process_pool(workers=1, job_timeout=0.5)
+
+    async def scenario():
+        with pytest.raises(JobTimeoutError):
+            await pool.run(nap, 5)
+        return await pool.run(nap, 0)
+
+    started = time.monotonic()
+    assert run(scenario()) == 0
+    assert time.monotonic() - started < 4
+    assert pool.timeouts == 1
+    assert pool.restarts == 0
+
+
+@pytest.mark.skipif(not hasattr(signal, "pthread_sigmask"), reason="requiere señales POSIX")
+def test_stuck_worker_does_not_kill_other_jobs(process_pool, monkeypatch):
+    # Con margen para que el pool nuevo levante sus procesos
+    monkeypatch.setattr(worker_pool, "STUCK_GRACE_S", 2.0)
+    pool = process_pool(workers=2, job_timeout=1.0)
+
+    async def scenario():
+        await asyncio.gather(pool.run(nap, 0.2), pool.run(nap, 0.2))
+        # El trabajo largo arranca justo después del trabado y termina bien
+        # aunque el pool se reemplace mientras corre
+        results = await asyncio.gather(pool.run(stuck, 6), pool.run(nap, 0.9), return_exceptions=True)
+        after = await pool.run(nap, 0)
+        return results, after
+
+    (stuck_result, other_result), after = run(scenario())
+    assert isinstance(stuck_result, JobTimeoutError)
+    assert other_result == 0.9
+    assert after == 0
+    assert pool.restarts == 1
+
+
+def test_thread_mode_times_out():
+    pool = SwapPool(workers=0, job_timeout=0.2)
+    pool.start()
+
+    async def scenario():
+        with pytest.raises(JobTimeoutError):
+            await pool.run(nap, 1)
+        return await pool.run(nap, 0)
+
+    assert run(scenario()) == 0
+    assert pool.stats()["timeouts"] == 1
+    assert pool.stats()["mode"] == "thread"
+
+
+def test_thread_mode_queue_depth_counts_only_waiting_jobs():
+    pool = SwapPool(workers=0, job_timeout=5)
+    pool.start()
+
+    async def scenario():
+        task = asyncio.ensure_future(pool.run(nap, 0.3))
+        await asyncio.sleep(0.1)
+        stats = pool.stats()
+        await task
+        return stats
+
+    stats = run(scenario())
+    assert stats["in_flight"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_render_to_file_removes_temp_file_on_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker_pool, "render_swap", lambda *args, **kwargs: b"GIF89a")
+    output = tmp_path / "out.gif"
+    output.mkdir()  # el rename final falla
+    with pytest.raises(OSError):
+        worker_pool.render_to_file(b"", tmp_path / "t.gif", output)
+    assert [path.name for path in tmp_path.iterdir()] == ["out.gif"]
@@ -0,0 +1,117 @@
+"""Miniaturas del catálogo de templates.
+
+La galería mostraba cada template con el GIF animado completo. Para cada
+versión de un template se generan, una sola vez, en el directorio de assets
+derivados:
+
+- una miniatura estática (primer frame, PNG con paleta, THUMB_SIDE px),
+- y una vista previa animada corta y de baja resolución (GIF, PREVIEW_SIDE px,
+  hasta PREVIEW_MAX_FRAMES frames).
+
+Los archivos llevan la versión en el nombre, así que un template re-subido
+genera los suyos y los viejos se borran.
+"""
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from PIL import Image, ImageSequence
+
+THUMB_SIDE = 128
+PREVIEW_SIDE = 96
+PREVIEW_MAX_FRAMES = 12
+THUMB_COLORS = 64
+
+STATIC = "static"
+PREVIEW = "preview"
+_EXTENSIONS = {STATIC: "png", PREVIEW: "gif"}
+
+
+def make_static_thumbnail(template_path, side=THUMB_SIDE):
+    """Primer frame reducido, como imagen con paleta"""
+    with Image.open(template_path) as im:
+        frame = im.convert("RGB")
+    frame.thumbnail((side, side), Image.LANCZOS)
+    return frame.quantize(colors=THUMB_COLORS, method=Image.Quantize.MEDIANCUT)
+
+
+def make_preview(template_path, side=PREVIEW_SIDE, max_frames=PREVIEW_MAX_FRAMES):
+    """Frames reducidos y espaciados para una animación corta: (frames, duraciones)"""
+    with Image.open(template_path) as im:
+        n_frames = getattr(im, "n_frames", 1)
+        step = max(1, -(-n_frames // max_frames))
+        default_duration = im.info.get("duration", 100) or 100
+        frames = []
+        durations = []
+        for i, frame in enumerate(ImageSequence.Iterator(im)):
+            if i % step:
+                continue
+            small = frame.convert("RGB")
+            small.thumbnail((side, side), Image.BILINEAR)
+            # Una sola paleta para toda la animación: frames más chicos y sin parpadeo
+            if frames:
+                small = small.quantize(palette=frames[0], dither=Image.Dither.NONE)
+            else:
+                small = small.quantize(colors=THUMB_COLORS, method=Image.Quantize.MEDIANCUT)
+            frames.append(small)
+            # La vista previa dura lo mismo que el original
+            durations.append((frame.info.get("duration", default_duration) or default_duration) * step)
+    return frames, durations
+
+
+class ThumbnailStore:
+    """Genera y guarda las miniaturas de cada versión de template"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.generated = 0
+
+    def path_for(self, template_id, version, kind=STATIC):
+        return self.directory / f"{template_id}.{version}.{kind}.{_EXTENSIONS[kind]}"
+
+    def ensure(self, template_path, version, kind=STATIC):
+        """Ruta de la miniatura, generándola si todavía no existe"""
+        template_path = Path(template_path)
+        path = self.path_for(template_path.stem, version, kind)
+        if path.exists():
+            return path
+        with self._lock:
+            if path.exists():
+                return path
+            tmp_path = path.with_name(f".{uuid.uuid4().hex}.tmp")
+            try:
+                if kind == STATIC:
+                    make_static_thumbnail(template_path).save(tmp_path, format="PNG", optimize=True)
+                else:
+                    frames, durations = make_preview(template_path)
+                    frames[0].save(
+                        tmp_path,
+                        format="GIF",
+                        save_all=True,
+                        append_images=frames[1:],
+                        duration=durations,
+                        loop=0,
+                    )
+                os.replace(tmp_path, path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            self.generated += 1
+            self._remove_old_versions(template_path.stem, version, kind)
+        return path
+
+    def ensure_all(self, template_path, version):
+        """Generar la miniatura estática y la vista previa de un template"""
+        return [self.ensure(template_path, version, kind) for kind in (STATIC, PREVIEW)]
+
+    def _remove_old_versions(self, template_id, version, kind):
+        current = self.path_for(template_id, version, kind).name
+        for old in self.directory.glob(f"{template_id}.*.{kind}.{_EXTENSIONS[kind]}"):
+            # El id no puede tener puntos de más: evita borrar los de otro template
+            if old.name != current and old.name.count(".") == current.count("."):
+                old.unlink(missing_ok=True)
+
+    def stats(self):
+        return {"generated": self.generated}
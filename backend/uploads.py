@@ -0,0 +1,197 @@
+"""Ingesta de archivos subidos: lectura por bloques, límites de tamaño y sniffing.
+
+- Las caras se leen por bloques a memoria y se decodifican desde ahí, sin
+  pasar por disco.
+- Los templates se vuelcan por bloques a un temporal (en el threadpool, sin
+  bloquear el event loop) y se mueven a su lugar con un rename atómico.
+- El tipo real se comprueba con los primeros bytes (no con el nombre ni el
+  content-type que manda el cliente) y se rechaza apenas llega el primer bloque.
+- UploadLimitMiddleware corta con 413 las peticiones demasiado grandes antes
+  de que se parsee el multipart.
+"""
+import os
+import uuid
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+
+MAX_FACE_BYTES = int(float(os.getenv("FACE_MAX_MB", "10")) * 1024 * 1024)
+MAX_TEMPLATE_BYTES = int(float(os.getenv("TEMPLATE_MAX_MB", "25")) * 1024 * 1024)
+MAX_ANNOTATION_BYTES = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Margen para los encabezados multipart y los demás campos del formulario
+MULTIPART_OVERHEAD = 64 * 1024
+
+FACE_FORMATS = {"jpeg", "png", "webp", "gif", "bmp"}
+TEMPLATE_FORMATS = {"gif"}
+
+
+class UploadRejected(Exception):
+    """El archivo subido no es aceptable; lleva el status HTTP a devolver"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_image(head):
+    """Formato de imagen según sus primeros bytes, o None si no se reconoce"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith(b"BM"):
+        return "bmp"
+    return None
+
+
+def _check_declared_size(upload, max_bytes):
+    size = getattr(upload, "size", None)
+    if size is not None and size > max_bytes:
+        raise UploadRejected(413, f"El archivo supera el máximo de {max_bytes // (1024 * 1024)} MB")
+
+
+def _check_format(head, allowed):
+    kind = sniff_image(head)
+    if kind not in allowed:
+        raise UploadRejected(415, f"Formato no soportado, se esperaba: {', '.join(sorted(allowed))}")
+    return kind
+
+
+async def read_limited(upload, max_bytes=MAX_FACE_BYTES, allowed=FACE_FORMATS):
+    """Leer un archivo subido a memoria por bloques, validando tipo y tamaño"""
+    _check_declared_size(upload, max_bytes)
+    chunks = []
+    total = 0
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if not chunks:
+            _check_format(chunk, allowed)
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadRejected(413, f"El archivo supera el máximo de {max_bytes // (1024 * 1024)} MB")
+        chunks.append(chunk)
+    if not chunks:
+        raise UploadRejected(400, "El archivo está vacío")
+    return b"".join(chunks)
+
+
+async def read_small(upload, max_bytes=MAX_ANNOTATION_BYTES):
+    """Leer un archivo chico (p. ej. JSON) con límite de tamaño"""
+    _check_declared_size(upload, max_bytes)
+    data = await upload.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise UploadRejected(413, "El archivo es demasiado grande")
+    return data
+
+
+async def spool_to_disk(upload, dest_path, tmp_dir, max_bytes=MAX_TEMPLATE_BYTES,
+                        allowed=TEMPLATE_FORMATS, validate=None):
+    """Volcar un archivo subido a disco por bloques y moverlo a ``dest_path``
+
+    ``validate(ruta_temporal)`` (opcional) corre en el threadpool con el
+    archivo completo y puede lanzar UploadRejected. El destino sólo se
+    reemplaza si el archivo pasó todas las validaciones; si no, sólo se
+    borra el temporal. Devuelve el tamaño escrito.
+    """
+    _check_declared_size(upload, max_bytes)
+    tmp_path = Path(tmp_dir) / f".{uuid.uuid4().hex}.upload"
+    handle = await run_in_threadpool(open, tmp_path, "wb")
+    total = 0
+    try:
+        while True:
+            chunk = await upload.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if total == 0:
+                _check_format(chunk, allowed)
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadRejected(413, f"El archivo supera el máximo de {max_bytes // (1024 * 1024)} MB")
+            await run_in_threadpool(handle.write, chunk)
+        if total == 0:
+            raise UploadRejected(400, "El archivo está vacío")
+        await run_in_threadpool(handle.close)
+        if validate is not None:
+            await run_in_threadpool(validate, tmp_path)
+        await run_in_threadpool(os.replace, tmp_path, dest_path)
+        return total
+    finally:
+        if not handle.closed:
+            await run_in_threadpool(handle.close)
+        tmp_path.unlink(missing_ok=True)
+
+
+class UploadLimitMiddleware:
+    """Rechazar con 413 los cuerpos que superan el límite de su ruta
+
+    Mira el Content-Length antes de que la app lea nada y, si el cliente no lo
+    manda (chunked), cuenta los bytes a medida que llegan.
+    """
+
+    def __init__(self, app, limits):
+        self.app = app
+        self.limits = limits  # {ruta: bytes máximos del cuerpo}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST":
+            return await self.app(scope, receive, send)
+        limit = self.limits.get(scope["path"])
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            return await self._reject(send)
+
+        received = 0
+        too_large = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    too_large = True
+                    raise UploadRejected(413, "El archivo es demasiado grande")
+            return message
+
+        async def guarded_send(message):
+            # Si el cuerpo se pasó del límite, la app responderá con algún
+            # error de parseo: se reemplaza por un 413 claro
+            nonlocal rejected
+            if too_large:
+                if message["type"] == "http.response.start":
+                    rejected = True
+                    await self._reject(send)
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadRejected:
+            if not rejected:
+                await self._reject(send)
+
+    async def _reject(self, send):
+        body = b'{"detail":"El archivo es demasiado grande"}'
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,333 @@
+"""Pool de procesos para el trabajo pesado de los swaps.
+
+Decodificar, componer y codificar son operaciones de CPU que no deben correr
+en el event loop de uvicorn: un swap largo congelaría /health y el catálogo
+para todos los demás clientes. Este módulo mantiene un ProcessPoolExecutor
+configurable con:
+
+- workers pre-calentados con el caché de templates,
+- timeout por trabajo contado desde que el worker lo empieza (no desde que
+  entra a la cola): el propio worker corta el trabajo con SIGALRM y, si
+  quedó trabado en código nativo, el pool se reemplaza y el viejo se cierra
+  cuando terminan sus otros trabajos,
+- reciclaje de workers cada N trabajos (limita fugas de memoria de Pillow),
+- métricas de cola: en espera, en curso, completados, fallidos y timeouts.
+
+Con SWAP_WORKERS=0 los trabajos corren en el threadpool de Starlette, útil
+para desarrollo local.
+"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from starlette.concurrency import run_in_threadpool
+
+from compositor import StageTimer, render_swap
+from template_cache import template_cache
+
+DEFAULT_WORKERS = int(os.getenv("SWAP_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+DEFAULT_JOB_TIMEOUT = float(os.getenv("SWAP_JOB_TIMEOUT", "30"))
+DEFAULT_MAX_TASKS_PER_WORKER = int(os.getenv("SWAP_WORKER_MAX_TASKS", "500"))
+
+# Margen sobre el timeout antes de dar por trabado a un worker que no se cortó solo
+STUCK_GRACE_S = float(os.getenv("SWAP_STUCK_GRACE", "5"))
+# Cada cuánto se revisa si un trabajo en cola ya empezó
+QUEUE_POLL_S = 0.1
+
+
+class JobTimeoutError(Exception):
+    """El trabajo superó el tiempo máximo permitido"""
+
+
+# ---------- funciones que corren dentro de los workers ----------
+
+def _warm_worker(template_paths):
+    """Inicializador: decodificar los templates populares en el caché del worker"""
+    for path in template_paths:
+        try:
+            template_cache.get(path)
+        except Exception as e:
+            print(f"Worker {os.getpid()}: no se pudo precargar {path}: {e}")
+
+
+def _run_with_deadline(timeout, fn, *args):
+    """Ejecutar ``fn(*args)`` en el worker, cortándolo ``timeout`` segundos después de empezar
+
+    El plazo corre desde acá, así el tiempo en cola no cuenta. Sin
+    setitimer (Windows) sólo queda el control del lado del servidor.
+    """
+    if not timeout or not hasattr(signal, "setitimer"):
+        return fn(*args)
+
+    def expire(signum, frame):
+        raise JobTimeoutError(f"El trabajo superó {timeout:.0f}s")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _worker_ping():
+    """Trabajo vacío: obliga a levantar (y precalentar) un worker"""
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def render_to_file(face_source, template_path, output_path, output_format="gif", quality="full"):
+    """Renderizar un swap y escribirlo a disco; devuelve los tiempos por etapa
+
+    Se escribe a un temporal y se renombra, así nadie ve un archivo a medias.
+    """
+    timer = StageTimer()
+    data = render_swap(face_source, template_path, timer, cache=template_cache,
+                       output_format=output_format, quality=quality)
+    with timer.stage("write"):
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            # También si el timeout (SIGALRM) corta la escritura
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    return timer.timings
+
+
+# ---------- lado del servidor ----------
+
+class SwapPool:
+    """Envoltura async sobre ProcessPoolExecutor con timeouts y métricas"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, job_timeout=DEFAULT_JOB_TIMEOUT,
+                 max_tasks_per_worker=DEFAULT_MAX_TASKS_PER_WORKER):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.warm_paths = []
+        self._executor = None
+        self._futures = {}  # executor -> futuros sin terminar
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._thread_running = 0  # modo threads: trabajos que ya tomó un thread
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.warmed_workers = 0
+
+    def start(self, warm_paths=()):
+        """Crear el pool; los workers se levantan precargando ``warm_paths``"""
+        self.warm_paths = [str(p) for p in warm_paths]
+        if self.workers > 0:
+            with self._lock:
+                self._executor = self._new_executor()
+
+    def _new_executor(self):
+        # max_tasks_per_child requiere "spawn" (no es compatible con fork)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_worker,
+            initargs=(self.warm_paths,),
+            max_tasks_per_child=self.max_tasks_per_worker or None,
+        )
+
+    async def warm(self, max_rounds=5):
+        """Esperar a que todos los workers estén levantados y con su caché cargado
+
+        El pool crea los procesos a medida que llegan trabajos; el
+        inicializador corre antes del primero, así que cuando cada worker
+        respondió un ping ya tiene los templates precargados.
+        """
+        if self._executor is None:
+            return 0
+        pids = set()
+        for _ in range(max_rounds):
+            pids.update(await asyncio.gather(*(self.run(_worker_ping) for _ in range(self.workers))))
+            if len(pids) >= self.workers:
+                break
+        self.warmed_workers = min(len(pids), self.workers)
+        return self.warmed_workers
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _replace(self, executor):
+        """Poner un pool nuevo en lugar de ``executor``; False si otro ya lo reemplazó"""
+        with self._lock:
+            if self._executor is not executor:
+                return False
+            self._executor = self._new_executor()
+            self.restarts += 1
+            return True
+
+    @staticmethod
+    def _terminate(executor):
+        # ProcessPoolExecutor no permite matar un trabajo en curso: hay que
+        # terminar sus procesos para liberar la CPU
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _restart(self, broken):
+        """Reemplazar un pool roto (sus procesos ya murieron)"""
+        if self._replace(broken):
+            self._terminate(broken)
+
+    def _retire(self, executor, stuck):
+        """Reemplazar el pool de un worker trabado sin cortar los demás trabajos
+
+        Los trabajos nuevos van al pool nuevo; el viejo se termina recién
+        cuando sus otros trabajos acabaron (o vencieron), y con él el
+        proceso trabado.
+        """
+        if not self._replace(executor):
+            return
+        with self._lock:
+            others = [f for f in self._futures.get(executor, ()) if f is not stuck]
+
+        def finish():
+            concurrent.futures.wait(others, timeout=self.job_timeout + STUCK_GRACE_S)
+            self._terminate(executor)
+
+        threading.Thread(target=finish, name="swap-pool-retire", daemon=True).start()
+
+    def _track(self, executor, future):
+        with self._lock:
+            self._futures.setdefault(executor, set()).add(future)
+
+        def forget(done):
+            with self._lock:
+                pending = self._futures.get(executor)
+                if pending is not None:
+                    pending.discard(done)
+                    if not pending and executor is not self._executor:
+                        del self._futures[executor]
+
+        future.add_done_callback(forget)
+
+    async def _wait(self, future, started_at, limit):
+        """Esperar ``future``; el plazo ``limit`` corre desde ``started_at()`` (None = todavía en cola)"""
+        while True:
+            start = started_at()
+            if start is None:
+                await asyncio.wait({future}, timeout=QUEUE_POLL_S)
+                if future.done():
+                    return future.result()
+                continue
+            remaining = start + limit - time.monotonic()
+            if remaining > 0:
+                await asyncio.wait({future}, timeout=remaining)
+            if future.done():
+                return future.result()
+            # Nadie va a leer el resultado: que no se avise como excepción perdida
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise asyncio.TimeoutError
+
+    async def run(self, fn, *args):
+        """Ejecutar ``fn(*args)`` en un worker, con timeout desde que empieza"""
+        self.in_flight += 1
+        try:
+            if self._executor is None:
+                result = await self._run_in_thread(fn, *args)
+            else:
+                executor = self._executor
+                future = executor.submit(_run_with_deadline, self.job_timeout, fn, *args)
+                self._track(executor, future)
+                started = []
+
+                def started_at():
+                    # Pasa a "running" al entrar a la cola de llamadas del pool,
+                    # a lo sumo un trabajo antes de que un worker lo tome (en un
+                    # pool recién creado, también mientras el worker arranca:
+                    # STUCK_GRACE_S tiene que cubrir ese arranque)
+                    if not started and future.running():
+                        started.append(time.monotonic())
+                    return started[0] if started else None
+
+                try:
+                    result = await self._wait(asyncio.wrap_future(future), started_at,
+                                              self.job_timeout + STUCK_GRACE_S)
+                except asyncio.TimeoutError:
+                    # El worker no se cortó solo: está trabado en código nativo
+                    if not future.cancel():
+                        self._retire(executor, future)
+                    raise
+                except BrokenProcessPool:
+                    self._restart(executor)
+                    raise
+        except (asyncio.TimeoutError, JobTimeoutError):
+            self.timeouts += 1
+            raise JobTimeoutError(f"El trabajo superó {self.job_timeout:.0f}s")
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        return result
+
+    async def _run_in_thread(self, fn, *args):
+        """Modo threads: el plazo corre desde que un thread del pool toma el trabajo
+
+        Un thread no se puede interrumpir: al vencer se responde timeout y el
+        render termina en segundo plano.
+        """
+        started = []
+
+        def call():
+            started.append(time.monotonic())
+            with self._lock:
+                self._thread_running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._thread_running -= 1
+
+        future = asyncio.ensure_future(run_in_threadpool(call))
+        return await self._wait(future, lambda: started[0] if started else None, self.job_timeout)
+
+    def stats(self):
+        workers = self.workers if self._executor is not None else 0
+        # En espera de un worker (o de un thread): en los dos modos, sin los que ya corren
+        if workers:
+            waiting = max(0, self.in_flight - workers)
+        else:
+            with self._lock:
+                waiting = max(0, self.in_flight - self._thread_running)
+        return {
+            "workers": workers,
+            "mode": "process" if workers else "thread",
+            "in_flight": self.in_flight,
+            "queue_depth": waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "warmed_workers": self.warmed_workers,
+            "warm_templates": len(self.warm_paths),
+            "job_timeout_s": self.job_timeout,
+            "max_tasks_per_worker": self.max_tasks_per_worker,
+        }
+
+
+# Instancia compartida por la app
+swap_pool = SwapPool()
@@ -60,6 +60,21 @@ function App() {
     }
   }
 
+  // Consultar un trabajo hasta que termine
+  const waitForJob = async (jobId) => {
+    while (true) {
+      const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`)
+      if (!response.ok) {
+        throw new Error(`Error HTTP: ${response.status}`)
+      }
+      const job = await response.json()
+      if (job.status === 'done' || job.status === 'failed') {
+        return job
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000))
+    }
+  }
+
   const handleSwapFace = async () => {
     if (!selectedTemplate) {
       setMessage('❌ Por favor selecciona un GIF template')
@@ -75,13 +90,15 @@ function App() {
     setMessage('🔄 Procesando tu GIF...')
 
     try {
-      const formData = new FormData()
-      
       const blob = await fetch(userImage).then(r => r.blob())
       const file = new File([blob], 'user_face.jpg', { type: 'image/jpeg' })
-      
+
+      // Una sola subida: la vista previa rápida y, detrás, la calidad completa
+      const formData = new FormData()
       formData.append('user_face', file)
       formData.append('gif_template', selectedTemplate)
+      formData.append('quality', 'preview')
+      formData.append('upgrade', 'true')
 
       const result = await fetch(`${API_BASE_URL}/simple-swap`, {
         method: 'POST',
@@ -91,14 +108,26 @@ function App() {
       if (!result.ok) {
         throw new Error(`Error HTTP: ${result.status}`)
       }
+      const preview = await result.json()
+      if (!preview.success) {
+        setMessage('❌ Error procesando el GIF: ' + (preview.message || 'Error desconocido'))
+        return
+      }
+      setResultGif(`${window.location.origin}${preview.result_url}`)
 
-      const data = await result.json()
-      
-      if (data.success) {
-        setResultGif(`${window.location.origin}${data.result_url}`)
+      if (!preview.upgrade) {
+        // El servidor no pudo encolar la versión completa: queda la vista previa
+        setMessage('✅ ¡Tu GIF está listo! (vista previa)')
+        return
+      }
+      setMessage('👀 Vista previa lista, generando la versión en alta calidad...')
+
+      const job = await waitForJob(preview.upgrade.job_id)
+      if (job.status === 'done') {
+        setResultGif(`${window.location.origin}${job.result_url}`)
         setMessage('✅ ¡Tu GIF está listo!')
       } else {
-        setMessage('❌ Error procesando el GIF: ' + (data.message || 'Error desconocido'))
+        setMessage('❌ Error procesando el GIF: ' + (job.error || 'Error desconocido'))
       }
     } catch (error) {
       console.error('❌ Error:', error)